@@ -6,19 +6,59 @@ import json
 import base64
 import socket
 import requests
+import random
+import sqlite3
+import threading
+import time
+import hashlib
+import struct
+import tempfile
+import contextlib
+import math
+import multiprocessing
+import unicodedata
+import heapq
+import bz2
+import gzip
+import numpy as np
+from array import array
+from bisect import bisect_left
+from html import escape
+from operator import sub
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import CancelledError, TimeoutError as FuturesTimeoutError
+from io import BytesIO, StringIO
 from datetime import datetime
-from flask import Flask, render_template_string, request
+from collections import OrderedDict, deque
+from xml.etree import ElementTree
+from flask import Flask, Request, Response, render_template_string, request, send_file, abort, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
-from PIL import Image
+from PIL import Image, ImageFilter, ImageOps
+try:
+    import resource
+except ImportError:
+    resource = None
 from PIL.ExifTags import TAGS, GPSTAGS
 from folium.plugins import MarkerCluster, HeatMap, MeasureControl, Fullscreen
+from folium.map import Layer
+from branca.element import Element, MacroElement
+from jinja2 import Template
 
 # === Enhanced EXIF Extractor Class ===
 class ExifGeoLocator:
-    def __init__(self, image_path):
+    def __init__(self, image_path, fast=True):
         self.image_path = image_path
+        self._gps = None
+        record = read_photo_geo(image_path) if fast else None
+        if record is not None:
+            self.exif = {}
+            self.lat, self.lon = record.lat, record.lon
+            self.metadata = record.metadata
+            return
+        
         self.exif = self.get_exif()
         self.lat, self.lon = self.extract_lat_lon()
         self.metadata = self.extract_metadata()
@@ -50,7 +90,8 @@ class ExifGeoLocator:
             readable = {}
             for tag_id, value in exif_data.items():
                 tag = TAGS.get(tag_id, tag_id)
-                readable[tag] = value
+                if tag != 'MakerNote':
+                    readable[tag] = value
             
             print(f"✅ Found {len(readable)} EXIF tags")
             if 'GPSInfo' in readable:
@@ -64,6 +105,11 @@ class ExifGeoLocator:
             return {}
     
     def get_gps_info(self):
+        if self._gps is None:
+            self._gps = self.parse_gps_info()
+        return self._gps
+    
+    def parse_gps_info(self):
         gps_info = self.exif.get("GPSInfo")
         if not gps_info:
             return None
@@ -147,156 +193,3532 @@ class ExifGeoLocator:
             else:
                 metadata['altitude'] = 'Unknown'
         else:
-            metadata['altitude'] = 'Unknown'
-        
-        return metadata
-    
-    def reverse_geocode(self):
-        if self.lat is None or self.lon is None:
-            return None
-        
-        geolocator = Nominatim(user_agent="smart_map_ui")
-        try:
-            location = geolocator.reverse((self.lat, self.lon), language="en", timeout=10)
-            return location.address if location else None
-        except (GeocoderTimedOut, GeocoderServiceError):
-            return None
+            metadata['altitude'] = 'Unknown'
+        
+        return metadata
+    
+    def reverse_geocode(self):
+        if self.lat is None or self.lon is None:
+            return None
+        
+        return reverse_geocode_many([(self.lat, self.lon)])[0]
+
+# === Fast EXIF Header Parser ===
+class PhotoGeoRecord:
+    """GPS position and camera metadata read from a photo's EXIF header"""
+    
+    __slots__ = ('lat', 'lon', 'metadata')
+    
+    def __init__(self, lat=None, lon=None, metadata=None):
+        self.lat = lat
+        self.lon = lon
+        self.metadata = metadata
+
+class ByteSource:
+    """Random access to a path, an in-memory buffer or a seekable stream"""
+    
+    def __init__(self, source):
+        self._file = None
+        self._owned = False
+        self._data = None
+        # set when a read ran past the end of an in-memory buffer, i.e. the buffer may be a truncated prefix;
+        # read_end is how long the buffer has to be for every read so far to succeed
+        self.short_read = False
+        self.read_end = 0
+        if isinstance(source, (bytes, bytearray)):
+            self._data = source
+        elif isinstance(source, memoryview):
+            self._data = bytes(source)
+        elif isinstance(source, (str, os.PathLike)):
+            self._file = open(source, 'rb')
+            self._owned = True
+        else:
+            self._file = source
+            self._start = source.tell()
+    
+    def read_at(self, offset, size):
+        if self._data is not None:
+            if offset + size > len(self._data):
+                self.short_read = True
+                self.read_end = max(self.read_end, offset + size)
+            return self._data[offset:offset + size]
+        self._file.seek(offset + (0 if self._owned else self._start))
+        return self._file.read(size)
+    
+    def close(self):
+        if self._owned:
+            self._file.close()
+        elif self._file is not None:
+            self._file.seek(self._start)
+
+EMPTY_PHOTO_METADATA = {'camera': 'Unknown', 'make': 'Unknown', 'datetime': 'Unknown', 'width': 'Unknown', 'height': 'Unknown', 'altitude': 'Unknown'}
+
+EXIF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+EXIF_IFD0_TAGS = {0x010F: 'make', 0x0110: 'camera', 0x0132: 'datetime', 0x8769: 'exif_ifd', 0x8825: 'gps_ifd'}
+EXIF_SUB_IFD_TAGS = {0xA002: 'width', 0xA003: 'height'}
+EXIF_GPS_TAGS = {1: 'lat_ref', 2: 'lat', 3: 'lon_ref', 4: 'lon', 5: 'alt_ref', 6: 'alt'}
+
+def read_ifd(src, base, offset, order, wanted):
+    """Decode only the wanted tags of one TIFF IFD"""
+    count_bytes = src.read_at(base + offset, 2)
+    if len(count_bytes) < 2:
+        return {}
+    count, = struct.unpack(order + 'H', count_bytes)
+    table = src.read_at(base + offset + 2, 12 * min(count, 512))
+    values = {}
+    for i in range(len(table) // 12):
+        tag, kind, n = struct.unpack(order + 'HHI', table[i * 12:i * 12 + 8])
+        name = wanted.get(tag)
+        if name is None or kind not in EXIF_TYPE_SIZES:
+            continue
+        size = EXIF_TYPE_SIZES[kind] * n
+        raw = table[i * 12 + 8:i * 12 + 12]
+        if size > 4:
+            raw = src.read_at(base + struct.unpack(order + 'I', raw)[0], size)
+        raw = raw[:size]
+        if len(raw) < size:
+            continue
+        if kind == 2:
+            values[name] = raw.split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+        elif kind in (5, 10):
+            parts = struct.unpack(order + ('I' if kind == 5 else 'i') * (2 * n), raw)
+            values[name] = tuple(num / den if den else 0.0 for num, den in zip(parts[::2], parts[1::2]))
+        elif kind in (1, 7):
+            values[name] = tuple(raw)
+        else:
+            values[name] = struct.unpack(order + {3: 'H', 4: 'I', 9: 'i'}[kind] * n, raw)
+        if kind != 2 and n == 1:
+            values[name] = values[name][0]
+    return values
+
+def parse_tiff_exif(src, base=0):
+    header = src.read_at(base, 8)
+    if header[:4] not in (b'II*\0', b'MM\0*'):
+        return None
+    order = '<' if header[:2] == b'II' else '>'
+    ifd0 = read_ifd(src, base, struct.unpack(order + 'I', header[4:8])[0], order, EXIF_IFD0_TAGS)
+    sub = read_ifd(src, base, ifd0['exif_ifd'], order, EXIF_SUB_IFD_TAGS) if isinstance(ifd0.get('exif_ifd'), int) else {}
+    gps = read_ifd(src, base, ifd0['gps_ifd'], order, EXIF_GPS_TAGS) if isinstance(ifd0.get('gps_ifd'), int) else {}
+    
+    record = PhotoGeoRecord(metadata={
+        'camera': ifd0.get('camera') or 'Unknown',
+        'make': ifd0.get('make') or 'Unknown',
+        'datetime': ifd0.get('datetime') or 'Unknown',
+        'width': sub.get('width', 'Unknown'),
+        'height': sub.get('height', 'Unknown'),
+        'altitude': 'Unknown'
+    })
+    
+    def decimal(dms, ref):
+        if not isinstance(dms, tuple) or len(dms) != 3 or ref not in ('N', 'S', 'E', 'W'):
+            return None
+        value = dms[0] + dms[1] / 60.0 + dms[2] / 3600.0
+        return -value if ref in ('S', 'W') else value
+    
+    lat = decimal(gps.get('lat'), gps.get('lat_ref'))
+    lon = decimal(gps.get('lon'), gps.get('lon_ref'))
+    if lat is not None and lon is not None:
+        record.lat, record.lon = lat, lon
+    if isinstance(gps.get('alt'), float):
+        below_sea_level = gps.get('alt_ref') == 1
+        record.metadata['altitude'] = f"{-gps['alt'] if below_sea_level else gps['alt']:.1f}m"
+    return record
+
+def find_jpeg_exif(src):
+    """Bytes of the TIFF block inside the JPEG APP1 Exif segment, stopping before any pixel data"""
+    pos = 2
+    while True:
+        marker = src.read_at(pos, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        kind, length = marker[1], struct.unpack('>H', marker[2:4])[0]
+        # a length below 2 cannot cover its own field; reading on would go backwards or past the segment
+        if kind in (0xDA, 0xD9) or length < 2:
+            return None
+        if kind == 0xE1:
+            segment = src.read_at(pos + 4, length - 2)
+            if segment[:6] == b'Exif\0\0':
+                return segment[6:]
+        pos += 2 + length
+
+def iter_boxes(src, start, end):
+    pos = start
+    while end is None or pos + 8 <= end:
+        header = src.read_at(pos, 16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack('>Q', header[8:16])
+            header_size = 16
+        elif size == 0:
+            size = (end - pos) if end is not None else 1 << 62
+        if size < header_size:
+            return
+        yield kind, pos + header_size, pos + size
+        pos += size
+
+def find_heic_exif(src):
+    """Bytes of the TIFF block of the 'Exif' item of a HEIF/HEIC file, via its meta/iinf/iloc boxes"""
+    meta = next(((body, end) for kind, body, end in iter_boxes(src, 0, None) if kind == b'meta'), None)
+    if meta is None:
+        return None
+    exif_item, locations = None, {}
+    for kind, body, end in iter_boxes(src, meta[0] + 4, meta[1]):
+        data = src.read_at(body, end - body)
+        version = data[0]
+        if kind == b'iinf':
+            pos = 6 if version == 0 else 8
+            for info_kind, info_body, info_end in iter_boxes(ByteSource(data), pos, len(data)):
+                info = data[info_body:info_end]
+                if info_kind != b'infe' or info[0] < 2:
+                    continue
+                id_size = 2 if info[0] == 2 else 4
+                item_id = int.from_bytes(info[4:4 + id_size], 'big')
+                if info[4 + id_size + 2:4 + id_size + 6] == b'Exif':
+                    exif_item = item_id
+        elif kind == b'iloc':
+            offset_size, length_size = data[4] >> 4, data[4] & 15
+            base_size, index_size = data[5] >> 4, (data[5] & 15 if version in (1, 2) else 0)
+            id_size = 2 if version < 2 else 4
+            pos = 6
+            count = int.from_bytes(data[pos:pos + id_size], 'big')
+            pos += id_size
+            for _ in range(count):
+                item_id = int.from_bytes(data[pos:pos + id_size], 'big')
+                pos += id_size + (2 if version in (1, 2) else 0) + 2
+                base_offset = int.from_bytes(data[pos:pos + base_size], 'big')
+                pos += base_size
+                extents = int.from_bytes(data[pos:pos + 2], 'big')
+                pos += 2
+                for extent in range(extents):
+                    pos += index_size
+                    extent_offset = int.from_bytes(data[pos:pos + offset_size], 'big')
+                    pos += offset_size
+                    extent_length = int.from_bytes(data[pos:pos + length_size], 'big')
+                    pos += length_size
+                    if extent == 0:
+                        locations[item_id] = (base_offset + extent_offset, extent_length)
+    if exif_item not in locations:
+        return None
+    offset, length = locations[exif_item]
+    item = src.read_at(offset, length)
+    # the item starts with a 4-byte offset from its own end to the TIFF header
+    skip = 4 + struct.unpack('>I', item[:4])[0]
+    return item[skip:]
+
+def read_photo_geo(source):
+    """PhotoGeoRecord from the EXIF header of a JPEG, HEIC/HEIF or TIFF, without decoding pixels.
+    
+    Accepts a path, bytes, a seekable binary stream or a ByteSource. Returns
+    None when the container is not recognised or its header is malformed, so
+    callers can fall back to Pillow; a record with lat/lon None means no GPS tags.
+    """
+    src = source if isinstance(source, ByteSource) else ByteSource(source)
+    try:
+        head = src.read_at(0, 12)
+        if head[:2] == b'\xff\xd8':
+            tiff = find_jpeg_exif(src)
+            return parse_tiff_exif(ByteSource(tiff)) if tiff else PhotoGeoRecord(metadata=dict(EMPTY_PHOTO_METADATA))
+        if head[:4] in (b'II*\0', b'MM\0*'):
+            return parse_tiff_exif(src)
+        if head[4:8] == b'ftyp':
+            tiff = find_heic_exif(src)
+            return parse_tiff_exif(ByteSource(tiff)) if tiff else PhotoGeoRecord(metadata=dict(EMPTY_PHOTO_METADATA))
+        return None
+    except (struct.error, IndexError, KeyError, ValueError, OSError):
+        return None
+    finally:
+        src.close()
+
+def benchmark_exif(count=200, size=(6000, 4000)):
+    """Compare the header parser with the Pillow-based ExifGeoLocator path on a synthetic GPS-tagged JPEG"""
+    exif = Image.Exif()
+    exif[0x010F] = 'Canon'
+    exif[0x0110] = 'EOS R5'
+    exif[0x0132] = '2024:05:01 10:00:00'
+    gps = exif.get_ifd(0x8825)
+    gps.update({1: 'N', 2: (35.0, 41.0, 22.2), 3: 'E', 4: (139.0, 41.0, 30.1), 5: b'\0', 6: 40.5})
+    buffer = BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, format='JPEG', quality=90, exif=exif)
+    
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as f:
+        f.write(buffer.getvalue())
+        path = f.name
+    try:
+        timings = {}
+        for label, read in (('pillow', lambda: ExifGeoLocator(path, fast=False)), ('header', lambda: read_photo_geo(path))):
+            with contextlib.redirect_stdout(StringIO()):
+                started = time.perf_counter()
+                for _ in range(count):
+                    result = read()
+                timings[label] = (time.perf_counter() - started) / count
+            print(f"⏱️ {label:>6}: {timings[label] * 1e6:8.1f}µs per photo ({result.lat:.5f}, {result.lon:.5f})")
+        print(f"🚀 Header parser is {timings['pillow'] / timings['header']:.1f}x faster ({size[0]}x{size[1]} JPEG, {len(buffer.getvalue()) // 1024}KB)")
+    finally:
+        os.remove(path)
+
+if getattr(sys, 'frozen', False):
+    base_path = os.path.dirname(sys.executable)
+else:
+    base_path = os.path.dirname(os.path.abspath(__file__))
+
+tile_folder = os.path.join(base_path, 'tiles')
+mbtiles_path = os.environ.get('MAP_MBTILES_PATH', os.path.join(base_path, 'tiles.mbtiles'))
+tile_backend = os.environ.get('MAP_TILE_BACKEND', 'auto')
+tile_max_age = int(os.environ.get('MAP_TILE_MAX_AGE', 7 * 24 * 3600))
+tile_cache_bytes = int(os.environ.get('MAP_TILE_CACHE_MB', 256)) * 1024 * 1024
+tile_index_refresh = int(os.environ.get('MAP_TILE_INDEX_REFRESH', 300))
+tile_overzoom_levels = int(os.environ.get('MAP_TILE_OVERZOOM', 4))
+tile_prefetch_workers = int(os.environ.get('MAP_PREFETCH_WORKERS', 4))
+tile_prefetch_budget = int(os.environ.get('MAP_PREFETCH_BUDGET_MB', 16)) * 1024 * 1024
+tile_prefetch_radius = int(os.environ.get('MAP_PREFETCH_RADIUS', 2))
+# about what the byte budget buys at typical tile sizes; maps with thousands of markers are cut to this many tiles
+tile_prefetch_max_tiles = int(os.environ.get('MAP_PREFETCH_MAX_TILES', 1024))
+
+geocode_cache_path = os.environ.get('MAP_GEOCODE_CACHE_PATH', os.path.join(base_path, 'geocode_cache.sqlite'))
+geocode_cache_entries = int(os.environ.get('MAP_GEOCODE_CACHE_ENTRIES', 100000))
+geocode_cache_ttl = int(os.environ.get('MAP_GEOCODE_CACHE_TTL', 30 * 24 * 3600))
+geocode_negative_ttl = int(os.environ.get('MAP_GEOCODE_NEGATIVE_TTL', 24 * 3600))
+# 4 decimals is ~11m, close enough that photos from the same spot share an address
+reverse_geocode_precision = int(os.environ.get('MAP_REVERSE_GEOCODE_PRECISION', 4))
+# public Nominatim allows 1 request/s; raise MAP_GEOCODER_RPS for a self-hosted instance
+nominatim_domain = os.environ.get('MAP_NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')
+nominatim_scheme = os.environ.get('MAP_NOMINATIM_SCHEME', 'https')
+geocode_rate = float(os.environ.get('MAP_GEOCODER_RPS', 1))
+geocode_workers = int(os.environ.get('MAP_GEOCODE_WORKERS', 4))
+geocode_timeout = float(os.environ.get('MAP_GEOCODE_TIMEOUT', 10))
+# a batch of places returns whatever resolved within this many seconds
+geocode_deadline = float(os.environ.get('MAP_GEOCODE_DEADLINE', 60))
+gazetteer_path = os.environ.get('MAP_GAZETTEER_PATH', os.path.join(base_path, 'gazetteer.sqlite'))
+geocoder_mode = os.environ.get('MAP_GEOCODER', 'offline-first')
+reverse_geocode_max_km = float(os.environ.get('MAP_REVERSE_GEOCODE_MAX_KM', 50))
+# 'haversine' takes milliseconds for 100k points and is off by up to 0.5%; 'ellipsoid' matches geopy's
+# geodesic but is about 10x slower, more on global point sets where near-antipodal pairs go to geopy
+distance_method = os.environ.get('MAP_DISTANCE_METHOD', 'haversine')
+roads_path = os.environ.get('MAP_ROADS_PATH', os.path.join(base_path, 'roads'))
+# markers farther than this from any road keep the straight-line estimate
+route_snap_km = float(os.environ.get('MAP_ROUTE_SNAP_KM', 2))
+route_access_kmh = float(os.environ.get('MAP_ROUTE_ACCESS_KMH', 20))
+# junctions one map's routing search may settle (a few hundred ms); markers not reached by then keep the straight-line estimate
+route_max_settled = int(os.environ.get('MAP_ROUTE_MAX_SETTLED', 25000))
+# route vertices that would move the drawn line by less than this many pixels are skipped at each zoom
+line_tolerance_px = float(os.environ.get('MAP_LINE_TOLERANCE_PX', 1))
+photo_cache_bytes = int(os.environ.get('MAP_PHOTO_CACHE_MB', 64)) * 1024 * 1024
+# offline mode asks /clusters for the visible markers instead of embedding one per point above this many
+cluster_threshold = int(os.environ.get('MAP_CLUSTER_THRESHOLD', 2000))
+cluster_max_zoom = int(os.environ.get('MAP_CLUSTER_MAX_ZOOM', 16))
+cluster_cache_bytes = int(os.environ.get('MAP_CLUSTER_CACHE_MB', 256)) * 1024 * 1024
+max_form_points = int(os.environ.get('MAP_MAX_FORM_POINTS', 1000000))
+# heatmap tiles keep the look of the old client-side HeatMap(radius=25, min_opacity=0.3)
+heatmap_radius = float(os.environ.get('MAP_HEATMAP_RADIUS', 25))
+heatmap_min_opacity = float(os.environ.get('MAP_HEATMAP_MIN_OPACITY', 0.3))
+heatmap_cache_bytes = int(os.environ.get('MAP_HEATMAP_CACHE_MB', 128)) * 1024 * 1024
+user_location_ttl = int(os.environ.get('MAP_LOCATION_TTL', 3600))
+# a failed detection is retried at most this often, so offline requests do not each wait on it
+user_location_retry = int(os.environ.get('MAP_LOCATION_RETRY', 60))
+thumbnail_size = int(os.environ.get('MAP_THUMBNAIL_SIZE', 200))
+# webp previews are roughly a third smaller than jpeg at the same quality
+thumbnail_format = os.environ.get('MAP_THUMBNAIL_FORMAT', 'jpeg')
+thumbnail_quality = int(os.environ.get('MAP_THUMBNAIL_QUALITY', 80))
+image_workers = int(os.environ.get('MAP_IMAGE_WORKERS', os.cpu_count() or 4))
+# uploads are parsed while they stream in; past its header a photo is either dropped or written to disk
+stream_uploads = os.environ.get('MAP_STREAM_UPLOADS', '1') != '0'
+upload_header_bytes = int(os.environ.get('MAP_UPLOAD_HEADER_KB', 256)) * 1024
+upload_memory_bytes = int(os.environ.get('MAP_UPLOAD_MEMORY_MB', 8)) * 1024 * 1024
+upload_file_max_bytes = int(os.environ.get('MAP_UPLOAD_FILE_MAX_MB', 100)) * 1024 * 1024
+upload_request_max_bytes = int(os.environ.get('MAP_UPLOAD_MAX_MB', 2048)) * 1024 * 1024
+
+# === Tile Stores ===
+class DirectoryTileStore:
+    """Tiles stored as {root}/{z}/{x}/{y}.png, one file per tile"""
+    
+    deduplicated = False
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def path(self, z, x, y, encoding='png'):
+        return os.path.join(self.root, str(z), str(x), f"{y}.{encoding}")
+    
+    def get(self, z, x, y, encoding='png'):
+        try:
+            with open(self.path(z, x, y, encoding), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def read(self, z, x, y, encoding='png'):
+        """(data, stat_result) of one tile file, or None"""
+        try:
+            with open(self.path(z, x, y, encoding), 'rb') as f:
+                return f.read(), os.fstat(f.fileno())
+        except OSError:
+            return None
+    
+    def zoom_levels(self):
+        if not os.path.exists(self.root):
+            print(f"⚠️ Tiles folder not found: {self.root}")
+            return []
+        
+        levels = [d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)) and d.isdigit()]
+        if not levels:
+            print(f"⚠️ No zoom folders found in: {self.root}")
+        else:
+            print(f"✅ Found zoom levels: {', '.join(sorted(levels))}")
+        return levels
+    
+    def columns(self):
+        for z in self.zoom_levels():
+            zoom_dir = os.path.join(self.root, z)
+            for x in os.listdir(zoom_dir):
+                if x.isdigit() and os.path.isdir(os.path.join(zoom_dir, x)):
+                    yield int(z), int(x)
+    
+    def rows(self, z, x):
+        column_dir = os.path.join(self.root, str(z), str(x))
+        return [int(n[:-4]) for n in os.listdir(column_dir) if n.endswith('.png') and n[:-4].isdigit()]
+    
+    def read_column(self, z, x):
+        tiles = [(y, self.get(z, x, y)) for y in self.rows(z, x)]
+        return [(y, data) for y, data in tiles if data is not None]
+
+class MBTilesTileStore:
+    """Packed MBTiles (SQLite) tile store, read through SQLite's mmap I/O.
+    
+    Files written with import-mbtiles --dedup use the content-addressed
+    MBTiles layout: map (z, x, y -> tile_id), images (tile_id -> blob) and a
+    tiles view joining the two.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.deduplicated = self._connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='map'"
+        ).fetchone() is not None
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # one read-only connection per server thread; sqlite3 connections are not shareable
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            conn.execute(f"PRAGMA mmap_size={os.path.getsize(self.path)}")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, z, x, y, encoding='png'):
+        if encoding != 'png':
+            return None
+        # MBTiles rows are TMS, so y is flipped relative to the XYZ scheme Leaflet requests
+        row = self._connection().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (z, x, (1 << z) - 1 - y)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def get_id(self, z, x, y):
+        row = self._connection().execute(
+            "SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (z, x, (1 << z) - 1 - y)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def get_blob(self, tile_id):
+        row = self._connection().execute("SELECT tile_data FROM images WHERE tile_id=?", (tile_id,)).fetchone()
+        return row[0] if row else None
+    
+    def keys(self):
+        table = 'map' if self.deduplicated else 'tiles'
+        for z, x, row in self._connection().execute(f"SELECT zoom_level, tile_column, tile_row FROM {table}"):
+            yield z, x, (1 << z) - 1 - row
+
+def mbtiles_complete(path):
+    """False for an import-mbtiles file whose import has not finished; other MBTiles files count as complete"""
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            tables = {name for name, in conn.execute("SELECT name FROM sqlite_master")}
+            if 'import_progress' not in tables:
+                return 'tiles' in tables
+            return conn.execute("SELECT 1 FROM metadata WHERE name='import_complete'").fetchone() is not None
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+
+def open_tile_store():
+    if tile_backend == 'mbtiles':
+        try:
+            if not os.path.exists(mbtiles_path):
+                raise FileNotFoundError(f"{mbtiles_path} does not exist")
+            store = MBTilesTileStore(mbtiles_path)
+            print(f"📦 Using MBTiles tile store: {mbtiles_path}")
+            return store
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ MAP_TILE_BACKEND=mbtiles but the MBTiles file cannot be opened ({e}); serving {tile_folder} instead")
+    elif tile_backend == 'auto' and os.path.exists(mbtiles_path):
+        if mbtiles_complete(mbtiles_path):
+            print(f"📦 Using MBTiles tile store: {mbtiles_path}")
+            return MBTilesTileStore(mbtiles_path)
+        # a partial import would hide tiles still on disk
+        print(f"⚠️ {mbtiles_path} is an unfinished import; serving {tile_folder} until import-mbtiles completes")
+    return DirectoryTileStore(tile_folder)
+
+def read_column_hashed(source, z, x):
+    return [(y, data, hashlib.md5(data).hexdigest()) for y, data in source.read_column(z, x)]
+
+def hash_column(source, z, x):
+    # sizes and hashes only: a report over the whole tree must not hold every tile in memory
+    return [(y, len(data), hashlib.md5(data).hexdigest()) for y, data in source.read_column(z, x)]
+
+def import_tiles_to_mbtiles(src_root, dest_path, workers=8, dedup=False):
+    """Pack a {z}/{x}/{y}.png tree into an MBTiles file.
+    
+    Columns are read in parallel and committed one transaction per column,
+    together with a progress row, so an interrupted import resumes where it
+    stopped. With dedup, each distinct tile image is stored once under its
+    MD5 and coordinates only reference it.
+    """
+    source = DirectoryTileStore(src_root)
+    conn = sqlite3.connect(dest_path)
+    existing = conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+    if existing and (existing[0] == 'view') != dedup:
+        print(f"❌ {dest_path} already uses the {'deduplicated' if existing[0] == 'view' else 'plain'} layout; rerun {'with' if existing[0] == 'view' else 'without'} --dedup")
+        conn.close()
+        return
+    
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+    if dedup:
+        conn.execute("CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)")
+        conn.execute("CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)")
+        conn.execute(
+            "CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+            "map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id"
+        )
+    else:
+        conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    conn.execute("CREATE TABLE IF NOT EXISTS import_progress (zoom_level INTEGER, tile_column INTEGER, PRIMARY KEY (zoom_level, tile_column))")
+    conn.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)", [
+        ('name', 'Offline Map'), ('type', 'baselayer'), ('version', '1'), ('format', 'png')
+    ])
+    # cleared until every column is in, so the server does not pick up a half-written file
+    conn.execute("DELETE FROM metadata WHERE name='import_complete'")
+    conn.commit()
+    
+    done = set(conn.execute("SELECT zoom_level, tile_column FROM import_progress"))
+    pending = [c for c in source.columns() if c not in done]
+    print(f"📦 Importing {len(pending)} tile columns ({len(done)} already done) into {dest_path}")
+    
+    read_column = read_column_hashed if dedup else DirectoryTileStore.read_column
+    started = time.time()
+    imported = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        columns = iter(pending)
+        while True:
+            while len(in_flight) < workers * 4:
+                column = next(columns, None)
+                if column is None:
+                    break
+                in_flight[pool.submit(read_column, source, *column)] = column
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                z, x = in_flight.pop(future)
+                tiles = future.result()
+                with conn:
+                    if dedup:
+                        conn.executemany("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)", [(tile_id, data) for _, data, tile_id in tiles])
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                            [(z, x, (1 << z) - 1 - y, tile_id) for y, _, tile_id in tiles]
+                        )
+                    else:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                            [(z, x, (1 << z) - 1 - y, data) for y, data in tiles]
+                        )
+                    conn.execute("INSERT INTO import_progress (zoom_level, tile_column) VALUES (?, ?)", (z, x))
+                imported += len(tiles)
+        
+    min_zoom, max_zoom = conn.execute(f"SELECT MIN(zoom_level), MAX(zoom_level) FROM {'map' if dedup else 'tiles'}").fetchone()
+    with conn:
+        if min_zoom is not None:
+            conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", [
+                ('minzoom', str(min_zoom)), ('maxzoom', str(max_zoom))
+            ])
+        conn.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES ('import_complete', '1')")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    
+    elapsed = time.time() - started
+    print(f"✅ Imported {imported} tiles in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.0f} tiles/s)")
+    if dedup:
+        conn = sqlite3.connect(dest_path)
+        coordinates, = conn.execute("SELECT COUNT(*) FROM map").fetchone()
+        blobs, = conn.execute("SELECT COUNT(*) FROM images").fetchone()
+        conn.close()
+        print(f"🧬 {coordinates} tiles share {blobs} unique images ({coordinates / max(blobs, 1):.1f}x dedup)")
+
+def dedup_report(root, workers=8):
+    """Hash every tile in a directory tree and report how many are byte-identical"""
+    source = DirectoryTileStore(root)
+    per_zoom = {}
+    blob_refs = {}
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        columns = iter(source.columns())
+        while True:
+            while len(in_flight) < workers * 4:
+                column = next(columns, None)
+                if column is None:
+                    break
+                in_flight[pool.submit(hash_column, source, *column)] = column[0]
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                z = in_flight.pop(future)
+                stats = per_zoom.setdefault(z, {'tiles': 0, 'bytes': 0, 'blobs': {}})
+                for _, size, tile_id in future.result():
+                    stats['tiles'] += 1
+                    stats['bytes'] += size
+                    stats['blobs'][tile_id] = size
+                    blob_refs[tile_id] = blob_refs.get(tile_id, (0, size))[0] + 1, size
+    
+    print(f"{'zoom':>6} {'tiles':>10} {'unique':>10} {'bytes':>12} {'unique bytes':>13} {'ratio':>7}")
+    for z in sorted(per_zoom):
+        stats = per_zoom[z]
+        unique_bytes = sum(stats['blobs'].values())
+        print(f"{z:>6} {stats['tiles']:>10} {len(stats['blobs']):>10} {stats['bytes']:>12} {unique_bytes:>13} {stats['tiles'] / max(len(stats['blobs']), 1):>6.1f}x")
+    
+    tiles = sum(stats['tiles'] for stats in per_zoom.values())
+    total_bytes = sum(stats['bytes'] for stats in per_zoom.values())
+    unique_bytes = sum(size for _, size in blob_refs.values())
+    print(f"🧬 {tiles} tiles, {len(blob_refs)} unique images ({tiles / max(len(blob_refs), 1):.1f}x dedup); "
+          f"{total_bytes} -> {unique_bytes} bytes ({1 - unique_bytes / max(total_bytes, 1):.1%} saved) in {time.time() - started:.1f}s")
+    for tile_id, (refs, size) in sorted(blob_refs.items(), key=lambda item: -item[1][0])[:5]:
+        if refs > 1:
+            print(f"   {tile_id}: {refs} copies of {size} bytes")
+
+def drop_page_cache(path):
+    # best effort: evicts file pages only; directory and inode caches need root to drop
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def benchmark_tile_stores(src_root, packed_path, samples=2000):
+    """Time random tile lookups against the directory tree and the MBTiles file"""
+    directory = DirectoryTileStore(src_root)
+    packed = MBTilesTileStore(packed_path)
+    keys = []
+    for z, x in directory.columns():
+        keys.extend((z, x, y) for y in directory.rows(z, x))
+    if not keys:
+        print(f"⚠️ No tiles found in: {src_root}")
+        return
+    keys = random.sample(keys, min(samples, len(keys)))
+    
+    for label, store in (('directory', directory), ('mbtiles', packed)):
+        if store is directory:
+            for z, x, y in keys:
+                drop_page_cache(directory.path(z, x, y))
+        else:
+            drop_page_cache(packed_path)
+        started = time.perf_counter()
+        missing = sum(1 for key in keys if store.get(*key) is None)
+        elapsed = time.perf_counter() - started
+        print(f"⏱️ {label:>9}: {len(keys)} lookups in {elapsed * 1000:.1f}ms ({elapsed / len(keys) * 1e6:.1f}µs/tile, {missing} missing)")
+
+# === Tile Recompression ===
+def recompressed_stats(source_path, dest_path):
+    """(source, dest) stat results when dest is at least as new as source, else None"""
+    try:
+        source_stat, dest_stat = os.stat(source_path), os.stat(dest_path)
+    except OSError:
+        return None
+    return (source_stat, dest_stat) if dest_stat.st_mtime_ns >= source_stat.st_mtime_ns else None
+
+def recompress_column(root, z, x, encoding, quality):
+    """Recompress one tile column; runs in a worker process.
+    
+    The source PNGs are never modified. 'webp' writes {y}.webp next to each
+    PNG, served to clients that accept WebP. 'png8' writes a palette-quantized
+    (lossy) {y}.png8, served in place of the PNG, and stores the original
+    bytes whenever quantizing does not make the tile smaller. Tiles whose
+    output is newer than their PNG are skipped, so reruns only redo tiles
+    that changed. A tile that cannot be read or written is reported and
+    left to the PNG; the rest of the column carries on.
+    """
+    store = DirectoryTileStore(root)
+    count = bytes_in = bytes_out = failed = 0
+    for y in store.rows(z, x):
+        dest = store.path(z, x, y, encoding)
+        current = recompressed_stats(store.path(z, x, y), dest)
+        if current is not None:
+            count += 1
+            bytes_in += current[0].st_size
+            bytes_out += current[1].st_size
+            continue
+        tmp_path = dest + '.tmp'
+        try:
+            data = store.get(z, x, y)
+            if data is None:
+                continue
+            out = recompress_tile(data, encoding, quality)
+            with open(tmp_path, 'wb') as f:
+                f.write(out)
+            os.replace(tmp_path, dest)
+        except Exception as e:
+            print(f"⚠️ Could not recompress {store.path(z, x, y)}: {e}")
+            failed += 1
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            continue
+        count += 1
+        bytes_in += len(data)
+        bytes_out += len(out)
+    return z, x, count, bytes_in, bytes_out, failed
+
+def recompress_tile(data, encoding, quality):
+    """One PNG tile's bytes re-encoded as 'webp' or 'png8'"""
+    img = Image.open(BytesIO(data))
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    buffer = BytesIO()
+    if encoding == 'webp':
+        img.convert('RGBA' if has_alpha else 'RGB').save(buffer, format='WEBP', quality=quality, lossless=quality >= 100, method=4)
+    else:
+        # quality picks the palette size: 100 -> 256 colours, 50 -> 128, never below 16
+        colors = max(16, min(256, quality * 256 // 100))
+        if has_alpha:
+            img = img.convert('RGBA').quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        else:
+            img = img.convert('RGB').quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+        img.save(buffer, format='PNG', optimize=True)
+    
+    out = buffer.getvalue()
+    # a palette that does not save anything is not worth its loss
+    if encoding == 'png8' and len(out) >= len(data):
+        return data
+    return out
+
+def recompress_tiles(root, encoding, quality, workers):
+    """Recompress the whole tile tree on a process pool, recording each finished column for the size report"""
+    checkpoint = sqlite3.connect(os.path.join(root, '.recompress.sqlite'))
+    checkpoint.execute("CREATE TABLE IF NOT EXISTS done (encoding TEXT, zoom_level INTEGER, tile_column INTEGER, tiles INTEGER, bytes_in INTEGER, bytes_out INTEGER, PRIMARY KEY (encoding, zoom_level, tile_column))")
+    # every column is visited: tiles already recompressed are skipped by mtime, tiles changed since are redone
+    print(f"🗜️ Recompressing tile columns to {encoding} (quality {quality})")
+    
+    started = time.time()
+    tiles = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        columns = DirectoryTileStore(root).columns()
+        while True:
+            while len(in_flight) < workers * 4:
+                column = next(columns, None)
+                if column is None:
+                    break
+                in_flight.add(pool.submit(recompress_column, root, *column, encoding, quality))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                z, x, count, bytes_in, bytes_out, column_failed = future.result()
+                with checkpoint:
+                    checkpoint.execute("INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?, ?)", (encoding, z, x, count, bytes_in, bytes_out))
+                tiles += count
+                failed += column_failed
+    elapsed = time.time() - started
+    print(f"✅ Checked {tiles} tiles in {elapsed:.1f}s ({tiles / max(elapsed, 1e-9):.0f} tiles/s)")
+    if failed:
+        print(f"⚠️ {failed} tiles could not be recompressed and are served as PNG; rerun to retry them")
+    
+    print(f"{'zoom':>6} {'tiles':>10} {'before':>12} {'after':>12} {'saved':>7}")
+    for z, count, bytes_in, bytes_out in checkpoint.execute(
+        "SELECT zoom_level, SUM(tiles), SUM(bytes_in), SUM(bytes_out) FROM done WHERE encoding=? GROUP BY zoom_level ORDER BY zoom_level", (encoding,)
+    ):
+        saved = 1 - bytes_out / bytes_in if bytes_in else 0.0
+        print(f"{z:>6} {count:>10} {bytes_in:>12} {bytes_out:>12} {saved:>6.1%}")
+    checkpoint.close()
+
+# === In-Memory Caches ===
+class LRUByteCache:
+    """Thread-safe LRU cache bounded by the total size of its values, not their count"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.resident_bytes += size
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.resident_bytes -= evicted_size
+                self.evictions += 1
+    
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+# === Tile Presence Index ===
+def tile_to_lat_lon(z, x, y):
+    n = 1 << z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat, lon
+
+def lat_lon_to_tile(lat, lon, z):
+    n = 1 << z
+    lat = min(max(lat, -85.0511), 85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+class TileIndex:
+    """Which (z, x, y) tiles exist, kept as one sorted row array per tile column.
+    
+    The index is persisted next to the tiles. For a directory store each
+    column is keyed by its directory mtime, so a refresh only relists the
+    columns that changed; an MBTiles file is rebuilt only when the file
+    or its write-ahead log changes.
+    """
+    
+    def __init__(self, store, index_path):
+        self.store = store
+        self.index_path = index_path
+        self._columns = {}
+        # bumped whenever a refresh finds changed columns, so callers can key misses by it
+        self.generation = 0
+    
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            conn = sqlite3.connect(self.index_path)
+            columns = {}
+            for z, x, signature, rows in conn.execute("SELECT zoom_level, tile_column, signature, tile_rows FROM columns"):
+                column_rows = array('I')
+                column_rows.frombytes(rows)
+                columns.setdefault(z, {})[x] = (signature, column_rows)
+            conn.close()
+            self._columns = columns
+        except sqlite3.Error as e:
+            print(f"⚠️ Ignoring unreadable tile index {self.index_path}: {e}")
+    
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("CREATE TABLE columns (zoom_level INTEGER, tile_column INTEGER, signature INTEGER, tile_rows BLOB, PRIMARY KEY (zoom_level, tile_column))")
+        conn.executemany("INSERT INTO columns VALUES (?, ?, ?, ?)", (
+            (z, x, signature, rows.tobytes())
+            for z, zoom_columns in self._columns.items()
+            for x, (signature, rows) in zoom_columns.items()
+        ))
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, self.index_path)
+    
+    def refresh(self):
+        """Bring the index up to date; returns the number of columns that were rescanned"""
+        if isinstance(self.store, MBTilesTileStore):
+            columns, rescanned = self._scan_mbtiles()
+        else:
+            columns, rescanned = self._scan_directory()
+        # swap in one assignment so request threads never see a half-built index
+        self._columns = columns
+        if rescanned:
+            self.generation += 1
+        return rescanned
+    
+    def _scan_directory(self):
+        root = self.store.root
+        columns = {}
+        rescanned = 0
+        if not os.path.isdir(root):
+            return columns, rescanned
+        
+        for zoom_name in os.listdir(root):
+            zoom_dir = os.path.join(root, zoom_name)
+            if not zoom_name.isdigit() or not os.path.isdir(zoom_dir):
+                continue
+            z = int(zoom_name)
+            known = self._columns.get(z, {})
+            zoom_columns = {}
+            with os.scandir(zoom_dir) as entries:
+                for entry in entries:
+                    if not entry.name.isdigit() or not entry.is_dir():
+                        continue
+                    x = int(entry.name)
+                    signature = entry.stat().st_mtime_ns
+                    cached = known.get(x)
+                    if cached and cached[0] == signature:
+                        zoom_columns[x] = cached
+                    else:
+                        zoom_columns[x] = (signature, array('I', sorted(self.store.rows(z, x))))
+                        rescanned += 1
+            if zoom_columns:
+                columns[z] = zoom_columns
+        return columns, rescanned
+    
+    def _scan_mbtiles(self):
+        # writers in WAL mode leave the main file's mtime alone until a checkpoint
+        signature = max(os.stat(path).st_mtime_ns for path in (self.store.path, self.store.path + '-wal') if os.path.exists(path))
+        known = {column[0] for zoom_columns in self._columns.values() for column in zoom_columns.values()}
+        if known == {signature}:
+            return self._columns, 0
+        
+        columns = {}
+        for z, x, y in self.store.keys():
+            zoom_columns = columns.setdefault(z, {})
+            if x not in zoom_columns:
+                zoom_columns[x] = (signature, array('I'))
+            zoom_columns[x][1].append(y)
+        for zoom_columns in columns.values():
+            for _, rows in zoom_columns.values():
+                rows[:] = array('I', sorted(rows))
+        return columns, sum(len(zoom_columns) for zoom_columns in columns.values())
+    
+    def contains(self, z, x, y):
+        column = self._columns.get(z, {}).get(x)
+        if column is None:
+            return False
+        rows = column[1]
+        i = bisect_left(rows, y)
+        return i < len(rows) and rows[i] == y
+    
+    def zoom_levels(self):
+        return sorted(z for z, zoom_columns in self._columns.items() if any(rows for _, rows in zoom_columns.values()))
+    
+    def tile_count(self):
+        return sum(len(rows) for zoom_columns in self._columns.values() for _, rows in zoom_columns.values())
+    
+    def bounds(self):
+        """(south, west, north, east) covering every indexed tile at any zoom"""
+        south, west, north, east = 90.0, 180.0, -90.0, -180.0
+        for z, zoom_columns in self._columns.items():
+            xs = [x for x, (_, rows) in zoom_columns.items() if rows]
+            if not xs:
+                continue
+            top = min(rows[0] for _, rows in zoom_columns.values() if rows)
+            bottom = max(rows[-1] for _, rows in zoom_columns.values() if rows)
+            zoom_north, zoom_west = tile_to_lat_lon(z, min(xs), top)
+            zoom_south, zoom_east = tile_to_lat_lon(z, max(xs) + 1, bottom + 1)
+            south, west = min(south, zoom_south), min(west, zoom_west)
+            north, east = max(north, zoom_north), max(east, zoom_east)
+        if south > north:
+            return None
+        return south, west, north, east
+    
+    def stats(self):
+        return {
+            'zoom_levels': self.zoom_levels(),
+            'tiles': self.tile_count(),
+            'columns': sum(len(zoom_columns) for zoom_columns in self._columns.values()),
+            'bounds': self.bounds()
+        }
+    
+    def start_watcher(self, interval):
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.refresh():
+                        self.save()
+                except Exception as e:
+                    print(f"⚠️ Tile index refresh failed: {e}")
+        
+        threading.Thread(target=watch, name='tile-index-watcher', daemon=True).start()
+
+def open_tile_index(store):
+    if isinstance(store, MBTilesTileStore):
+        index_path = store.path + '.index'
+    else:
+        index_path = os.path.join(store.root, '.tile_index.sqlite')
+    
+    index = TileIndex(store, index_path)
+    started = time.time()
+    index.load()
+    rescanned = index.refresh()
+    levels = index.zoom_levels()
+    if not levels:
+        print("⚠️ No tiles found for the offline map")
+        return index
+    
+    print(f"✅ Found zoom levels: {', '.join(map(str, levels))} ({index.tile_count()} tiles, {rescanned} columns rescanned in {time.time() - started:.1f}s)")
+    if rescanned:
+        try:
+            index.save()
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️ Could not save tile index {index_path}: {e}")
+    return index
+
+# opened by open_services() rather than at import
+tile_store = None
+tile_index = None
+tile_cache = LRUByteCache(tile_cache_bytes)
+# recompressed encodings known to be missing, kept apart so they count neither as tiles nor as hits in tile_cache
+encoding_misses = LRUByteCache(4 * 1024 * 1024)
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key so the work runs once"""
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def run(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+        
+        try:
+            call.set_result(fn())
+        except Exception as e:
+            call.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+tile_flights = SingleFlight()
+
+def tile_etag(stat_result):
+    # size + mtime only, so every tile host serving a copy of the same tree agrees on the tag
+    return f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+def cache_tile(key, data):
+    tile = (data, hashlib.md5(data).hexdigest())
+    tile_cache.put(key, tile, len(data))
+    return tile
+
+def read_stored_tile(key, z, x, y, encoding='png'):
+    # directory tiles carry the size/mtime tag serve_tile sends when it streams the file itself
+    if isinstance(tile_store, DirectoryTileStore):
+        if encoding != 'png' and recompressed_stats(tile_store.path(z, x, y), tile_store.path(z, x, y, encoding)) is None:
+            return None
+        found = tile_store.read(z, x, y, encoding)
+        if found is None:
+            return None
+        data, stat_result = found
+        tile = (data, tile_etag(stat_result))
+        tile_cache.put(key, tile, len(data))
+        return tile
+    data = tile_store.get(z, x, y, encoding)
+    return cache_tile(key, data) if data is not None else None
+
+def load_shared_tile(z, x, y):
+    # deduplicated stores cache by content hash, so one blob serves every coordinate that shares it
+    tile_id = tile_store.get_id(z, x, y)
+    if tile_id is None:
+        return None
+    key = ('blob', tile_id)
+    tile = tile_cache.get(key)
+    if tile is None:
+        data = tile_store.get_blob(tile_id)
+        if data is None:
+            return None
+        tile = (data, tile_id)
+        tile_cache.put(key, tile, len(data))
+    return tile
+
+def load_tile(z, x, y, encoding='png'):
+    """Return (data, etag) for a tile, or None, going through the tile cache.
+    
+    Tiles missing from the index are synthesized from their ancestor or
+    children; concurrent requests for the same missing tile share one render.
+    Synthesized tiles are cached per index generation, so a refresh that
+    finds real tiles (or a new MBTiles file) retires them. Other encodings
+    (the .webp and .png8 files of recompress_tiles) are only served when
+    the recompressed file exists.
+    """
+    if encoding != 'png':
+        key = (z, x, y, encoding)
+        tile = tile_cache.get(key)
+        if tile is not None:
+            return tile
+        # misses are remembered per index generation, so files added since the last refresh are picked up
+        miss_key = key + (tile_index.generation,)
+        if encoding_misses.get(miss_key) is not None:
+            return None
+        tile = read_stored_tile(key, z, x, y, encoding) if tile_index.contains(z, x, y) else None
+        if tile is not None:
+            return tile
+        encoding_misses.put(miss_key, True, 64)
+        return None
+    
+    if not tile_index.contains(z, x, y):
+        key = (z, x, y, 'synthesized', tile_index.generation)
+        tile = tile_cache.get(key)
+        if tile is not None:
+            return tile
+        return tile_flights.run(key, lambda: synthesize_tile(z, x, y, key))
+    
+    if tile_store.deduplicated:
+        return load_shared_tile(z, x, y)
+    
+    key = (z, x, y)
+    tile = tile_cache.get(key)
+    if tile is not None:
+        return tile
+    return read_stored_tile(key, z, x, y)
+
+def encode_png(img):
+    buffer = BytesIO()
+    img.save(buffer, format='PNG', optimize=False)
+    return buffer.getvalue()
+
+def upscale_ancestor(ancestor, depth, x, y):
+    # crop the 1/2**depth square of the ancestor that covers (x, y) and blow it up to full size
+    tile = load_tile(*ancestor)
+    if tile is None:
+        return None
+    img = Image.open(BytesIO(tile[0]))
+    size = img.width
+    span = size >> depth
+    if span < 1:
+        return None
+    left = (x - (ancestor[1] << depth)) * span
+    top = (y - (ancestor[2] << depth)) * span
+    img = img.convert('RGBA').crop((left, top, left + span, top + span))
+    return encode_png(img.resize((size, size), Image.Resampling.BICUBIC))
+
+def downsample_children(children):
+    canvas = None
+    for i, child in enumerate(children):
+        tile = load_tile(*child) if tile_index.contains(*child) else None
+        if tile is None:
+            continue
+        img = Image.open(BytesIO(tile[0])).convert('RGBA')
+        if canvas is None:
+            size = img.width
+            canvas = Image.new('RGBA', (size * 2, size * 2), (0, 0, 0, 0))
+        canvas.paste(img, ((i % 2) * size, (i // 2) * size))
+    if canvas is None:
+        return None
+    return encode_png(canvas.resize((size, size), Image.Resampling.LANCZOS))
+
+def synthesize_tile(z, x, y, key):
+    """Build a missing tile from its four children or its nearest ancestor, and cache it under key"""
+    children = [(z + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+    present = sum(1 for child in children if tile_index.contains(*child))
+    
+    data = None
+    if present == 4:
+        data = downsample_children(children)
+    else:
+        for depth in range(1, min(tile_overzoom_levels, z) + 1):
+            ancestor = (z - depth, x >> depth, y >> depth)
+            if tile_index.contains(*ancestor):
+                data = upscale_ancestor(ancestor, depth, x, y)
+                break
+        if data is None and present:
+            data = downsample_children(children)
+    
+    if data is None:
+        return None
+    return cache_tile(key, data)
+
+# === Tile Prefetch ===
+class PrefetchJob:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.bytes_read = 0
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+    
+    def charge(self, size):
+        with self._lock:
+            self.bytes_read += size
+            return self.bytes_read < self.budget_bytes
+    
+    def active(self):
+        return not self.cancelled.is_set() and self.bytes_read < self.budget_bytes
+
+class TilePrefetcher:
+    """Warm the tile cache around the initial viewport of a freshly generated map.
+    
+    Each prefetch cancels the previous one, so only the latest map competes
+    for disk; a job queues at most max_tiles tiles and stops early once it
+    has read its byte budget.
+    """
+    
+    def __init__(self, workers, budget_bytes, radius, max_tiles):
+        self.budget_bytes = budget_bytes
+        self.radius = radius
+        self.max_tiles = max_tiles
+        self.jobs = 0
+        self.cancelled = 0
+        self.tiles_warmed = 0
+        self.bytes_read = 0
+        self._job = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile-prefetch')
+    
+    def keys_for(self, points, zoom):
+        """Up to max_tiles distinct tiles around the points at zoom, then at zoom - 1 and zoom + 1.
+        
+        Points in the same tile share one centre. Each zoom is laid out ring
+        by ring across all the centres, so when the cap cuts the list short
+        every point still has the tiles nearest to it.
+        """
+        min_zoom, max_zoom = offline_zoom_range()
+        keys = {}
+        for z in (zoom, zoom - 1, zoom + 1):
+            if z < min_zoom or z > max_zoom:
+                continue
+            n = 1 << z
+            centres = list(dict.fromkeys(lat_lon_to_tile(lat, lon, z) for lat, lon in points))
+            for d in range(self.radius + 1):
+                ring = [(dx, dy) for dx in range(-d, d + 1) for dy in range(-d, d + 1) if max(abs(dx), abs(dy)) == d]
+                for cx, cy in centres:
+                    for dx, dy in ring:
+                        if 0 <= cy + dy < n:
+                            keys.setdefault((z, (cx + dx) % n, cy + dy), None)
+                            if len(keys) >= self.max_tiles:
+                                return list(keys)
+        return list(keys)
+    
+    def prefetch(self, points, zoom):
+        if not tile_index.zoom_levels():
+            return
+        job = PrefetchJob(self.budget_bytes)
+        with self._lock:
+            if self._job is not None and self._job.active():
+                self._job.cancelled.set()
+                self.cancelled += 1
+            self._job = job
+            self.jobs += 1
+        for key in self.keys_for(points, zoom):
+            self._pool.submit(self._warm, job, key)
+    
+    def _warm(self, job, key):
+        if not job.active() or tile_cache.contains(key):
+            return
+        try:
+            tile = load_tile(*key)
+        except Exception as e:
+            print(f"⚠️ Prefetch of tile {key} failed: {e}")
+            return
+        if tile is None:
+            return
+        job.charge(len(tile[0]))
+        with self._lock:
+            self.tiles_warmed += 1
+            self.bytes_read += len(tile[0])
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'jobs': self.jobs,
+                'cancelled': self.cancelled,
+                'tiles_warmed': self.tiles_warmed,
+                'bytes_read': self.bytes_read,
+                'budget_bytes': self.budget_bytes,
+                'max_tiles': self.max_tiles
+            }
+
+tile_prefetcher = TilePrefetcher(tile_prefetch_workers, tile_prefetch_budget, tile_prefetch_radius, tile_prefetch_max_tiles)
+
+app = Flask(__name__)
+
+def tile_response(data, etag, mimetype='image/png'):
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = tile_max_age
+    response.vary.add('Accept')
+    return response.make_conditional(request)
+
+def tile_url_template():
+    return f"{request.host_url}tiles/{{z}}/{{x}}/{{y}}.png"
+
+def offline_zoom_range():
+    # one level below the shallowest tiles and a few past the deepest are synthesized on demand
+    levels = tile_index.zoom_levels()
+    return max(levels[0] - 1, 0), levels[-1] + tile_overzoom_levels
+
+def offline_map_options():
+    """Zoom range and max bounds for an offline map, taken from the tile index"""
+    min_zoom, max_zoom = offline_zoom_range()
+    south, west, north, east = tile_index.bounds()
+    return {
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'max_bounds': True,
+        'min_lat': south,
+        'max_lat': north,
+        'min_lon': west,
+        'max_lon': east
+    }
+
+def clamp_to_tiles(location, zoom):
+    south, west, north, east = tile_index.bounds()
+    min_zoom, max_zoom = offline_zoom_range()
+    lat = min(max(location[0], south), north)
+    lon = min(max(location[1], west), east)
+    return [lat, lon], min(max(zoom, min_zoom), max_zoom)
+
+def add_offline_tile_layer(m):
+    min_zoom, max_zoom = offline_zoom_range()
+    south, west, north, east = tile_index.bounds()
+    folium.raster_layers.TileLayer(
+        tiles=tile_url_template(),
+        attr='Offline Tiles',
+        name='Offline Map',
+        overlay=False,
+        control=False,
+        min_zoom=min_zoom,
+        max_zoom=max_zoom,
+        bounds=[[south, west], [north, east]]
+    ).add_to(m)
+
+# === Connectivity ===
+class ConnectivityMonitor:
+    """Background thread that keeps an online/offline flag current.
+    
+    Request handlers read the flag without blocking. Probes run every
+    interval seconds while online; while offline the delay doubles up to
+    max_backoff. Listeners registered with subscribe() are called with the
+    new state on every transition.
+    """
+    
+    def __init__(self, targets, interval, max_backoff, timeout):
+        self.targets = targets
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.online = None
+        self.probes = 0
+        self.failed_probes = 0
+        self.last_probe = None
+        self.last_change = None
+        self.transitions = deque(maxlen=50)
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._started = False
+    
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+    
+    def probe(self):
+        for host, port in self.targets:
+            try:
+                socket.create_connection((host, port), timeout=self.timeout).close()
+                return True
+            except OSError:
+                continue
+        return False
+    
+    def check(self):
+        online = self.probe()
+        with self._lock:
+            self.probes += 1
+            self.failed_probes += 0 if online else 1
+            self.last_probe = time.time()
+            changed = online != self.online
+            if changed:
+                self.online = online
+                self.last_change = self.last_probe
+                self.transitions.append({'time': self.last_probe, 'online': online})
+        if changed:
+            print("✅ Internet connection detected" if online else "⚠️ No internet connection")
+            for callback in self._listeners:
+                try:
+                    callback(online)
+                except Exception as e:
+                    print(f"⚠️ Connectivity listener failed: {e}")
+        return online
+    
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        
+        def watch():
+            delay = self.interval
+            while True:
+                time.sleep(delay)
+                delay = self.interval if self.check() else min(delay * 2, self.max_backoff)
+        
+        threading.Thread(target=watch, name='connectivity-monitor', daemon=True).start()
+    
+    def is_online(self):
+        # the first caller pays for one probe; after that the answer is always cached
+        if self.online is None:
+            self.check()
+            self.start()
+        return self.online
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'online': self.online,
+                'probes': self.probes,
+                'failed_probes': self.failed_probes,
+                'last_probe': self.last_probe,
+                'last_change': self.last_change,
+                'transitions': list(self.transitions)
+            }
+
+def parse_probe_targets(value):
+    targets = []
+    for target in value.split(','):
+        host, _, port = target.strip().rpartition(':')
+        if host and port.isdigit():
+            targets.append((host, int(port)))
+    return targets
+
+connectivity = ConnectivityMonitor(
+    parse_probe_targets(os.environ.get('MAP_PROBE_TARGETS', '8.8.8.8:53,1.1.1.1:53')),
+    float(os.environ.get('MAP_PROBE_INTERVAL', 15)),
+    float(os.environ.get('MAP_PROBE_MAX_BACKOFF', 120)),
+    float(os.environ.get('MAP_PROBE_TIMEOUT', 3))
+)
+
+def check_internet_connection():
+    return connectivity.is_online()
+
+# === Geocoding ===
+class GeocodeCache:
+    """On-disk cache of geocoder answers with TTLs, negative entries and LRU eviction"""
+    
+    MISSING = object()
+    
+    def __init__(self, path, max_entries, ttl, negative_ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key):
+        """The cached value (None for a cached 'not found'), or GeocodeCache.MISSING"""
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT value, expires FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None or row[1] < now:
+            with self._lock:
+                self.misses += 1
+            return self.MISSING
+        with conn:
+            conn.execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0]) if row[0] is not None else None
+    
+    def put(self, key, value):
+        now = time.time()
+        ttl = self.ttl if value is not None else self.negative_ttl
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value) if value is not None else None, now + ttl, now)
+            )
+        with self._lock:
+            self._puts += 1
+            sweep = self._puts % 100 == 0
+        if sweep:
+            self.evict()
+    
+    def evict(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+            count, = conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)", (excess,))
+                with self._lock:
+                    self.evictions += excess
+    
+    def stats(self):
+        count, = self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': count,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all threads"""
+    
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next - now)
+            self._next = max(now, self._next) + self.interval
+        if delay:
+            time.sleep(delay)
+
+geocode_cache = None
+geolocator = Nominatim(user_agent="smart_map_ui", domain=nominatim_domain, scheme=nominatim_scheme, timeout=geocode_timeout)
+geocode_limiter = RateLimiter(geocode_rate)
+geocode_pool = ThreadPoolExecutor(max_workers=geocode_workers, thread_name_prefix='geocode')
+
+def normalize_place(place):
+    return ', '.join(' '.join(part.split()) for part in place.casefold().split(',') if part.strip())
+
+def geocode_place(place, cached_only=False):
+    """(lat, lon) for a place name, or None if it does not exist.
+    
+    Answers are cached across requests and restarts. Timeouts and service
+    errors propagate and are not cached, so the next request retries. With
+    cached_only, a cache miss returns None without asking Nominatim.
+    """
+    key = f"fwd:{normalize_place(place)}"
+    cached = geocode_cache.get(key)
+    if cached is not GeocodeCache.MISSING:
+        return tuple(cached) if cached else None
+    if cached_only:
+        return None
+    
+    geocode_limiter.acquire()
+    location = geolocator.geocode(place)
+    coords = (location.latitude, location.longitude) if location else None
+    geocode_cache.put(key, coords)
+    return coords
+
+# === Offline Gazetteer ===
+def normalize_name(name):
+    # accent- and case-insensitive, punctuation folded to spaces: "Saint-Étienne" -> "saint etienne"
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(' ' if c in "-.'’" else c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.split())
+
+class Gazetteer:
+    """Offline place-name lookup over an index built by build_gazetteer()"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+    
+    def lookup(self, place):
+        """(lat, lon) of the most populous place matching 'Name[, Region][, Country]', or None"""
+        parts = [normalize_name(p) for p in place.split(',')]
+        parts = [p for p in parts if p]
+        if not parts:
+            return None
+        conn = self._connection()
+        
+        countries, regions = set(), set()
+        for qualifier in parts[1:]:
+            country = conn.execute("SELECT code FROM countries WHERE key=?", (qualifier,)).fetchone()
+            if country:
+                countries.add(country[0])
+            regions.update(code for code, in conn.execute("SELECT code FROM admin1 WHERE key=?", (qualifier,)))
+        
+        for lat, lon, country, admin1 in conn.execute(
+            "SELECT p.lat, p.lon, p.country, p.admin1 FROM names n JOIN places p ON p.id = n.place_id "
+            "WHERE n.key=? ORDER BY n.population DESC LIMIT 100", (parts[0],)
+        ):
+            if countries and country not in countries:
+                continue
+            if regions and f"{country}.{admin1}" not in regions:
+                continue
+            return lat, lon
+        return None
+    
+    def stats(self):
+        conn = self._connection()
+        return {
+            'places': conn.execute("SELECT COUNT(*) FROM places").fetchone()[0],
+            'names': conn.execute("SELECT COUNT(*) FROM names").fetchone()[0],
+            'index_bytes': os.path.getsize(self.path)
+        }
+
+def build_gazetteer(source, dest, countries_file=None, admin1_file=None):
+    """Build the offline geocoder index from a GeoNames-style TSV dump (e.g. cities500.txt).
+    
+    countryInfo.txt and admin1CodesASCII.txt from the same dump are optional;
+    without them only ISO country codes work as qualifiers ("Paris, FR").
+    """
+    started = time.time()
+    tmp_path = dest + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE places (id INTEGER PRIMARY KEY, name TEXT, country TEXT, admin1 TEXT, feature_class TEXT, lat REAL, lon REAL, population INTEGER)")
+    conn.execute("CREATE TABLE names (key TEXT, population INTEGER, place_id INTEGER)")
+    conn.execute("CREATE TABLE countries (key TEXT, code TEXT)")
+    conn.execute("CREATE TABLE admin1 (key TEXT, code TEXT, name TEXT)")
+    conn.execute("CREATE TABLE country_names (code TEXT PRIMARY KEY, name TEXT)")
+    
+    places = names = 0
+    country_codes = set()
+    with open(source, encoding='utf-8') as f:
+        batch_places, batch_names = [], []
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 15 or line.startswith('#'):
+                continue
+            place_id, name, ascii_name, alternates = int(fields[0]), fields[1], fields[2], fields[3]
+            population = int(fields[14] or 0)
+            batch_places.append((place_id, name, fields[8], fields[10], fields[6], float(fields[4]), float(fields[5]), population))
+            keys = {normalize_name(n) for n in [name, ascii_name] + alternates.split(',') if n and len(n) <= 64}
+            keys.discard('')
+            batch_names.extend((key, population, place_id) for key in keys)
+            country_codes.add(fields[8])
+            if len(batch_places) >= 10000:
+                conn.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch_places)
+                conn.executemany("INSERT INTO names VALUES (?, ?, ?)", batch_names)
+                places += len(batch_places)
+                names += len(batch_names)
+                batch_places, batch_names = [], []
+        conn.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch_places)
+        conn.executemany("INSERT INTO names VALUES (?, ?, ?)", batch_names)
+        places += len(batch_places)
+        names += len(batch_names)
+    
+    conn.executemany("INSERT INTO countries VALUES (?, ?)", [(code.casefold(), code) for code in country_codes if code])
+    if countries_file:
+        with open(countries_file, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if line.startswith('#') or len(fields) < 5:
+                    continue
+                conn.executemany("INSERT INTO countries VALUES (?, ?)", [
+                    (normalize_name(fields[1]), fields[0]), (normalize_name(fields[4]), fields[0])
+                ])
+                conn.execute("INSERT OR REPLACE INTO country_names VALUES (?, ?)", (fields[0], fields[4]))
+    if admin1_file:
+        with open(admin1_file, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 3:
+                    continue
+                conn.executemany("INSERT INTO admin1 VALUES (?, ?, ?)", [
+                    (normalize_name(fields[1]), fields[0], fields[1]), (normalize_name(fields[2]), fields[0], fields[1])
+                ])
+    
+    conn.execute("CREATE INDEX names_key ON names (key, population DESC)")
+    conn.execute("CREATE INDEX countries_key ON countries (key)")
+    conn.execute("CREATE INDEX admin1_key ON admin1 (key)")
+    conn.execute("CREATE INDEX admin1_code ON admin1 (code)")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp_path, dest)
+    
+    elapsed = time.time() - started
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else 0
+    print(f"✅ Gazetteer built in {elapsed:.1f}s: {places} places, {names} names, "
+          f"index {os.path.getsize(dest) / 1024 / 1024:.1f}MB on disk, peak RSS {peak_mb:.0f}MB")
+    
+    gazetteer = Gazetteer(dest)
+    with contextlib.closing(sqlite3.connect(dest)) as conn:
+        sample = [row[0] for row in conn.execute("SELECT name FROM places ORDER BY population DESC LIMIT 1000")]
+    if sample:
+        started = time.perf_counter()
+        for name in sample:
+            gazetteer.lookup(name)
+        print(f"⏱️ Lookup: {(time.perf_counter() - started) / len(sample) * 1e6:.0f}µs per place")
+
+def open_gazetteer():
+    if not os.path.exists(gazetteer_path):
+        if geocoder_mode == 'offline':
+            print(f"⚠️ MAP_GEOCODER=offline but {gazetteer_path} does not exist; place search finds nothing until build-gazetteer has run")
+        return None
+    gazetteer = Gazetteer(gazetteer_path)
+    stats = gazetteer.stats()
+    print(f"📚 Offline gazetteer: {stats['places']} places ({stats['index_bytes'] / 1024 / 1024:.1f}MB)")
+    return gazetteer
+
+gazetteer = None
+
+def resolve_place(place):
+    """Geocode one place with the configured mix of gazetteer and Nominatim.
+    
+    MAP_GEOCODER: 'offline' (gazetteer only), 'offline-first' (gazetteer,
+    then Nominatim for misses while the connectivity monitor reports a
+    network), 'online-first' (Nominatim, then gazetteer on failure or miss)
+    or 'online' (Nominatim only). Without a gazetteer, offline mode finds
+    nothing rather than going to the network and the other modes go to
+    Nominatim, but only to its cache while there is no network.
+    """
+    if gazetteer is None:
+        if geocoder_mode == 'offline':
+            return None
+        return geocode_place(place, cached_only=geocoder_mode != 'online' and not connectivity.is_online())
+    mode = geocoder_mode
+    if mode in ('offline', 'offline-first'):
+        coords = gazetteer.lookup(place)
+        if coords or mode == 'offline':
+            return coords
+        if not connectivity.is_online():
+            # a new lookup could only time out, but earlier Nominatim answers are still good
+            return geocode_place(place, cached_only=True)
+    
+    try:
+        coords = geocode_place(place)
+    except Exception:
+        if mode == 'online-first':
+            return gazetteer.lookup(place)
+        raise
+    if coords is None and mode == 'online-first':
+        return gazetteer.lookup(place)
+    return coords
+
+# === Offline Reverse Geocoding ===
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; arguments broadcast like NumPy arrays"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+class SpatialGrid:
+    """Points bucketed into fixed lat/lon cells for batched nearest-neighbour queries"""
+    
+    def __init__(self, lat, lon, cell_deg=0.5):
+        self.cell = cell_deg
+        self.rows = int(math.ceil(180 / cell_deg))
+        self.cols = int(math.ceil(360 / cell_deg))
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        r, c = self._cell_of(lat, lon)
+        self.order = np.argsort(r * self.cols + c, kind='stable')
+        self.cell_ids = (r * self.cols + c)[self.order]
+        self.lat = lat[self.order]
+        self.lon = lon[self.order]
+    
+    def __len__(self):
+        return len(self.lat)
+    
+    def _cell_of(self, lat, lon):
+        r = np.clip(((lat + 90.0) / self.cell).astype(np.int64), 0, self.rows - 1)
+        c = ((lon + 180.0) / self.cell).astype(np.int64) % self.cols
+        return r, c
+    
+    def _block(self, r, c, ring):
+        """Sorted-array positions of every point within ring cells of (r, c)"""
+        rows = np.arange(max(r - ring, 0), min(r + ring, self.rows - 1) + 1)
+        cols = np.arange(c - ring, c + ring + 1) % self.cols
+        if 2 * ring + 1 >= self.cols:
+            cols = np.arange(self.cols)
+        ids = (rows[:, None] * self.cols + cols[None, :]).ravel()
+        starts = np.searchsorted(self.cell_ids, ids, side='left')
+        lengths = np.searchsorted(self.cell_ids, ids, side='right') - starts
+        # expand the (start, length) runs into one flat array of positions
+        return np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    
+    def nearest(self, lat, lon, max_km=np.inf):
+        """(indices into the original points, distances in km) for each query point.
+        
+        With max_km the search stops widening once it has covered that radius;
+        queries with nothing that close may get index -1 or a farther point.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        best = np.full(len(lat), -1, dtype=np.int64)
+        best_km = np.full(len(lat), np.inf)
+        if not len(self):
+            return best, best_km
+        
+        r, c = self._cell_of(lat, lon)
+        keys = r * self.cols + c
+        pending = np.arange(len(lat))
+        ring = 1
+        while len(pending):
+            if min(2 * ring + 1, self.rows) * min(2 * ring + 1, self.cols) >= len(self):
+                # a block with more cells than there are points costs more than checking every point
+                d = haversine_km(lat[pending, None], lon[pending, None], self.lat[None, :], self.lon[None, :])
+                j = d.argmin(axis=1)
+                best[pending] = self.order[j]
+                best_km[pending] = d[np.arange(len(pending)), j]
+                break
+            
+            unresolved = []
+            # queries in the same cell share one candidate block and one distance matrix
+            for key in np.unique(keys[pending]):
+                group = pending[keys[pending] == key]
+                candidates = self._block(int(r[group[0]]), int(c[group[0]]), ring)
+                if len(candidates):
+                    d = haversine_km(lat[group, None], lon[group, None], self.lat[None, candidates], self.lon[None, candidates])
+                    j = d.argmin(axis=1)
+                    best[group] = self.order[candidates[j]]
+                    best_km[group] = d[np.arange(len(group)), j]
+                # anything nearer than the edge of the searched block is guaranteed to be the nearest
+                edge_km = self._edge_km(lat[group], lon[group], int(r[group[0]]), int(c[group[0]]), ring)
+                unresolved.append(group[(best_km[group] > edge_km) & (edge_km < max_km)])
+            pending = np.concatenate(unresolved)
+            # past the grid's extent every side of the block is already open
+            ring = min(ring * 2, max(self.rows, self.cols))
+        return best, best_km
+    
+    def _edge_km(self, lat, lon, r, c, ring):
+        """Distance from each query to the nearest side of its block that does not reach the grid's edge"""
+        edge_km = np.full(len(lat), np.inf)
+        if r + ring < self.rows - 1:
+            edge_km = np.minimum(edge_km, EARTH_RADIUS_KM * np.radians((r + ring + 1) * self.cell - 90.0 - lat))
+        if r - ring > 0:
+            edge_km = np.minimum(edge_km, EARTH_RADIUS_KM * np.radians(lat + 90.0 - (r - ring) * self.cell))
+        if 2 * ring + 1 < self.cols:
+            # reaching a point east or west of the block means crossing one of its bounding meridians;
+            # the nearest point of a meridian is asin(cos(lat) sin(dlon)) away, or the pole past 90 degrees
+            offset = (lon + 180.0) % 360.0 - c * self.cell
+            delta = np.minimum(offset + ring * self.cell, (ring + 1) * self.cell - offset)
+            reach = np.cos(np.radians(lat)) * np.sin(np.radians(np.minimum(delta, 90.0)))
+            edge_km = np.minimum(edge_km, EARTH_RADIUS_KM * np.arcsin(np.clip(reach, 0.0, 1.0)))
+        return edge_km
+
+class ReverseGeocoder:
+    """Nearest populated place from the gazetteer, loaded once into a SpatialGrid"""
+    
+    def __init__(self, gazetteer, max_km):
+        self.gazetteer = gazetteer
+        self.max_km = max_km
+        conn = gazetteer._connection()
+        rows = conn.execute("SELECT id, lat, lon FROM places WHERE feature_class='P'").fetchall()
+        if not rows:
+            rows = conn.execute("SELECT id, lat, lon FROM places").fetchall()
+        ids, lat, lon = zip(*rows) if rows else ((), (), ())
+        self.ids = np.array(ids, dtype=np.int64)
+        self.grid = SpatialGrid(np.array(lat), np.array(lon))
+    
+    def reverse_many(self, coords):
+        """Labels ('Place, Region, Country') for every (lat, lon) in one call; None when too far from any place"""
+        if not len(coords):
+            return []
+        points = np.asarray(coords, dtype=np.float64)
+        idx, km = self.grid.nearest(points[:, 0], points[:, 1], max_km=self.max_km)
+        conn = self.gazetteer._connection()
+        labels = []
+        for i, distance in zip(idx, km):
+            if i < 0 or distance > self.max_km:
+                labels.append(None)
+                continue
+            name, region, country = conn.execute(
+                "SELECT p.name, a.name, COALESCE(c.name, p.country) FROM places p "
+                "LEFT JOIN admin1 a ON a.code = p.country || '.' || p.admin1 "
+                "LEFT JOIN country_names c ON c.code = p.country WHERE p.id=?", (int(self.ids[i]),)
+            ).fetchone()
+            labels.append(', '.join(part for part in (name, region, country) if part))
+        return labels
+
+def open_reverse_geocoder():
+    if gazetteer is None:
+        return None
+    started = time.time()
+    geocoder = ReverseGeocoder(gazetteer, reverse_geocode_max_km)
+    print(f"🧭 Offline reverse geocoder: {len(geocoder.grid)} places indexed in {time.time() - started:.1f}s")
+    return geocoder
+
+reverse_geocoder = None
+
+def reverse_geocode_many(coords):
+    """Addresses for a batch of coordinates, offline in one vectorized pass when possible.
+    
+    Follows MAP_GEOCODER like resolve_place(); points the gazetteer cannot
+    label fall back to the cached Nominatim lookup unless mode is 'offline',
+    and only to its cache while 'offline-first' has no network. Without a
+    gazetteer every point goes to that lookup, cache only while offline
+    unless mode is 'online'.
+    """
+    if reverse_geocoder is None:
+        if geocoder_mode == 'offline':
+            return [None] * len(coords)
+        cached_only = geocoder_mode != 'online' and not connectivity.is_online()
+        return [reverse_geocode_coords(lat, lon, cached_only) for lat, lon in coords]
+    mode = geocoder_mode
+    labels = [None] * len(coords)
+    cached_only = False
+    if mode in ('offline', 'offline-first'):
+        labels = reverse_geocoder.reverse_many(coords)
+        if mode == 'offline':
+            return labels
+        cached_only = None in labels and not connectivity.is_online()
+    
+    for i, (lat, lon) in enumerate(coords):
+        if labels[i] is None:
+            labels[i] = reverse_geocode_coords(lat, lon, cached_only)
+    if mode == 'online-first' and None in labels:
+        missing = [i for i, label in enumerate(labels) if label is None]
+        for i, label in zip(missing, reverse_geocoder.reverse_many([coords[i] for i in missing])):
+            labels[i] = label
+    return labels
+
+def geocode_places(places):
+    """Resolve a list of place names concurrently under the geocoder rate limit.
+    
+    Duplicates (after normalization) are looked up once. Returns
+    [(place, coords or None, error or None)] in input order; one failing
+    place never fails the others, and places still queued after
+    MAP_GEOCODE_DEADLINE seconds are reported as timed out.
+    """
+    futures = {}
+    for place in places:
+        key = normalize_place(place)
+        if key and key not in futures:
+            futures[key] = geocode_pool.submit(resolve_place, place)
+    
+    deadline = time.monotonic() + geocode_deadline
+    results = []
+    for place in places:
+        key = normalize_place(place)
+        if not key:
+            continue
+        try:
+            results.append((place, futures[key].result(timeout=max(deadline - time.monotonic(), 0)), None))
+        except (FuturesTimeoutError, CancelledError):
+            # not started yet: drop it so it does not hold up the rate limiter for the next request
+            futures[key].cancel()
+            print(f"⚠️ Geocoding '{place}' timed out")
+            results.append((place, None, 'timed out'))
+        except Exception as e:
+            print(f"⚠️ Geocoding '{place}' failed: {e}")
+            results.append((place, None, str(e)))
+    return results
+
+def reverse_geocode_coords(lat, lon, cached_only=False):
+    """Address for a coordinate, or None; nearby photos share a cache entry"""
+    key = f"rev:{lat:.{reverse_geocode_precision}f},{lon:.{reverse_geocode_precision}f}"
+    cached = geocode_cache.get(key)
+    if cached is not GeocodeCache.MISSING:
+        return cached
+    if cached_only:
+        return None
+    
+    try:
+        geocode_limiter.acquire()
+        location = geolocator.reverse((lat, lon), language="en", timeout=geocode_timeout)
+    except (GeocoderTimedOut, GeocoderServiceError):
+        return None
+    
+    address = location.address if location else None
+    geocode_cache.put(key, address)
+    return address
+
+# === Batch Distances ===
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+def vincenty_km(lat1, lon1, lat2, lon2, tolerance=1e-12, max_iterations=200):
+    """Distance in km on the WGS-84 ellipsoid (inverse Vincenty); arguments broadcast like NumPy arrays.
+    
+    Agrees with geopy's geodesic to well under a millimetre. The few nearly
+    antipodal pairs Vincenty cannot solve are handed to geopy one by one.
+    This is the opt-in MAP_DISTANCE_METHOD=ellipsoid accuracy mode; the
+    default is haversine_km.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (lat1, lon1, lat2, lon2)))
+    f = WGS84_F
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    L = np.radians(lon2 - lon1)
+    sinU1, cosU1, sinU2, cosU2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+    
+    def iterate(lam, sinU1, cosU1, sinU2, cosU2):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+        cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # equatorial lines have cos2_alpha == 0 and no defined cos(2 sigma_m)
+            cos_2sm = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+        return sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm
+    
+    # only pairs that have not converged yet are carried into the next iteration
+    flat = [v.ravel() for v in (L, sinU1, cosU1, sinU2, cosU2)]
+    lam_flat = flat[0].copy()
+    active = np.arange(lam_flat.size)
+    for _ in range(max_iterations):
+        L_a, trig = flat[0][active], [v[active] for v in flat[1:]]
+        sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm = iterate(lam_flat[active], *trig)
+        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        updated = L_a + (1 - C) * f * sin_alpha * (
+            sigma + C * sin_sigma * (cos_2sm + C * cos_sigma * (-1 + 2 * cos_2sm ** 2))
+        )
+        moving = np.abs(updated - lam_flat[active]) > tolerance
+        lam_flat[active] = updated
+        active = active[moving]
+        if not active.size:
+            break
+    # near-antipodal pairs either never converge or settle on |lambda| > pi
+    failed = np.union1d(active, np.flatnonzero(np.abs(lam_flat) > np.pi))
+    sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm = iterate(lam_flat.reshape(L.shape), sinU1, cosU1, sinU2, cosU2)
+    
+    u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sm + B / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sm ** 2) - B / 6 * cos_2sm * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sm ** 2)
+    ))
+    km = WGS84_B * A * (sigma - delta_sigma)
+    if failed.size:
+        km = np.array(km)
+        for i in failed:
+            km.flat[i] = geodesic((lat1.flat[i], lon1.flat[i]), (lat2.flat[i], lon2.flat[i])).kilometers
+    return km
+
+DISTANCE_FUNCTIONS = {'haversine': haversine_km, 'ellipsoid': vincenty_km}
+
+def as_lat_lon(points):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return points[:, 0], points[:, 1]
+
+def distances_from(origin, points, method=None):
+    """km from one (lat, lon) origin to each of points, as a 1-D array in input order"""
+    lat, lon = as_lat_lon(points)
+    return DISTANCE_FUNCTIONS[method or distance_method](origin[0], origin[1], lat, lon)
+
+def distance_matrix(origins, points, method=None):
+    """km from every origin (rows) to every point (columns)"""
+    lat1, lon1 = as_lat_lon(origins)
+    lat2, lon2 = as_lat_lon(points)
+    return DISTANCE_FUNCTIONS[method or distance_method](lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+def distance_summary(distances):
+    distances = np.asarray(distances, dtype=np.float64)
+    if not distances.size:
+        return {'count': 0, 'total': 0.0, 'mean': 0.0, 'median': 0.0, 'min': 0.0, 'max': 0.0}
+    return {
+        'count': int(distances.size),
+        'total': float(distances.sum()),
+        'mean': float(distances.mean()),
+        'median': float(np.median(distances)),
+        'min': float(distances.min()),
+        'max': float(distances.max())
+    }
+
+def benchmark_distances(count=100000):
+    """Time both distance modes against per-point geopy calls on random points"""
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(-80, 80, count), rng.uniform(-180, 180, count)])
+    origin = (36.75, 3.06)
+    
+    sample = points[:min(count, 2000)]
+    started = time.perf_counter()
+    reference = np.array([geodesic(origin, tuple(p)).kilometers for p in sample])
+    per_point = (time.perf_counter() - started) / len(sample)
+    print(f"⏱️ geopy geodesic: {per_point * count * 1000:9.1f}ms for {count} points (extrapolated)")
+    
+    for method in DISTANCE_FUNCTIONS:
+        started = time.perf_counter()
+        km = distances_from(origin, points, method)
+        distance_summary(km)
+        elapsed = time.perf_counter() - started
+        error = np.abs(km[:len(sample)] - reference).max()
+        print(f"⏱️ {method:>14}: {elapsed * 1000:9.1f}ms for {count} points, max error {error * 1000:.3f}m")
+
+# === Offline Routing ===
+# km/h by OSM highway class when a way has no usable maxspeed; other classes are not driveable
+ROAD_SPEEDS = {
+    'motorway': 110, 'motorway_link': 60, 'trunk': 90, 'trunk_link': 50,
+    'primary': 70, 'primary_link': 45, 'secondary': 60, 'secondary_link': 40,
+    'tertiary': 50, 'tertiary_link': 35, 'unclassified': 40, 'residential': 30,
+    'living_street': 10, 'service': 20, 'road': 30
+}
+ROAD_FILES = ('lat', 'lon', 'indptr', 'targets', 'seconds', 'edge_shape', 'edge_reversed',
+              'shape_indptr', 'shape_lat', 'shape_lon', 'shape_km', 'landmarks_from', 'landmarks_to')
+
+def parse_maxspeed(value):
+    try:
+        if value.endswith('mph'):
+            return float(value[:-3]) * 1.609
+        return float(value)
+    except (AttributeError, ValueError):
+        return None
+
+def iter_osm(path, tag):
+    """Yield each top-level <tag> element of an .osm/.osm.gz/.osm.bz2 file, clearing as it goes"""
+    opener = bz2.open if path.endswith('.bz2') else gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        context = ElementTree.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in ('node', 'way', 'relation'):
+                if elem.tag == tag:
+                    yield elem
+                root.clear()
+
+def wanted_nodes(wanted, ids, lat, lon):
+    """The (ids, lat, lon) of a batch of nodes whose id is in the sorted array wanted"""
+    ids = np.array(ids, dtype=np.int64)
+    if not len(wanted):
+        return ids[:0], np.zeros(0), np.zeros(0)
+    keep = wanted[np.minimum(np.searchsorted(wanted, ids), len(wanted) - 1)] == ids
+    return ids[keep], np.array(lat)[keep], np.array(lon)[keep]
+
+def read_osm_roads(path, batch_size=1 << 20):
+    """Driveable ways and the coordinates of the nodes they use, as flat arrays.
+
+    Returns (way_indptr, refs, kmh, direction) and (node_ids, lat, lon):
+    way i is refs[way_indptr[i]:way_indptr[i + 1]], direction is 1 for one-way
+    along the node order, -1 against it and 0 for both ways, and node_ids is
+    sorted. Two passes, with nodes filtered a batch at a time, keep memory to
+    the road nodes instead of every node.
+    """
+    refs, way_indptr, kmh, direction = array('q'), array('q', [0]), array('d'), array('b')
+    for way in iter_osm(path, 'way'):
+        tags = {t.get('k'): t.get('v') for t in way.iter('tag')}
+        highway = tags.get('highway')
+        if highway not in ROAD_SPEEDS or tags.get('access') in ('no', 'private') or tags.get('area') == 'yes':
+            continue
+        way_refs = [int(nd.get('ref')) for nd in way.iter('nd')]
+        if len(way_refs) < 2:
+            continue
+        oneway = tags.get('oneway')
+        if oneway in ('yes', '1', 'true'):
+            way_direction = 1
+        elif oneway == '-1':
+            way_direction = -1
+        elif oneway is None and (highway in ('motorway', 'motorway_link') or tags.get('junction') == 'roundabout'):
+            way_direction = 1
+        else:
+            way_direction = 0
+        refs.extend(way_refs)
+        way_indptr.append(len(refs))
+        kmh.append(parse_maxspeed(tags.get('maxspeed')) or ROAD_SPEEDS[highway])
+        direction.append(way_direction)
+    refs = np.array(refs, dtype=np.int64)
+    wanted = np.unique(refs)
+
+    found = []
+    batch = (array('q'), array('d'), array('d'))
+    for node in iter_osm(path, 'node'):
+        batch[0].append(int(node.get('id')))
+        batch[1].append(float(node.get('lat')))
+        batch[2].append(float(node.get('lon')))
+        if len(batch[0]) >= batch_size:
+            found.append(wanted_nodes(wanted, *batch))
+            batch = (array('q'), array('d'), array('d'))
+    found.append(wanted_nodes(wanted, *batch))
+    node_ids, lat, lon = (np.concatenate(column) for column in zip(*found))
+    order = np.argsort(node_ids, kind='stable')
+    ways = (np.array(way_indptr, dtype=np.int64), refs, np.array(kmh), np.array(direction, dtype=np.int8))
+    return ways, (node_ids[order], lat[order], lon[order])
+
+def csr(n, sources, *columns):
+    """Sort edge columns by source node into compressed sparse rows"""
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+    return (indptr,) + tuple(column[order] for column in columns)
+
+def reachable(indptr, targets, source):
+    """Boolean mask of nodes reachable from source, by vectorized breadth-first search"""
+    seen = np.zeros(len(indptr) - 1, dtype=bool)
+    seen[source] = True
+    frontier = np.array([source])
+    while len(frontier):
+        starts = indptr[frontier]
+        lengths = indptr[frontier + 1] - starts
+        positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        frontier = np.unique(targets[positions])
+        frontier = frontier[~seen[frontier]]
+        seen[frontier] = True
+    return seen
+
+def shortest_times(indptr, targets, seconds, source):
+    """Dijkstra from source over the whole graph; seconds to every node"""
+    indptr, targets, seconds = indptr.tolist(), targets.tolist(), seconds.tolist()
+    dist = [math.inf] * (len(indptr) - 1)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for i in range(indptr[u], indptr[u + 1]):
+            nd = d + seconds[i]
+            v = targets[i]
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return np.array(dist)
+
+def import_roads(source, dest, landmarks=8):
+    """Build the routing graph from an OSM XML extract into dest/ as memory-mappable .npy arrays.
+
+    Ways are split at junctions so only junctions become graph nodes and
+    each edge keeps its full polyline as a shape. The graph is cut down to
+    its largest strongly connected part, so every snapped point can reach
+    every other. ALT landmark tables (drive time from and to a handful of
+    far-apart nodes) are precomputed for goal-directed queries.
+    """
+    started = time.time()
+    (way_indptr, refs, way_kmh, way_direction), (node_ids, all_lat, all_lon) = read_osm_roads(source)
+    print(f"🛣️ Read {len(way_kmh)} driveable ways over {len(node_ids)} nodes in {time.time() - started:.1f}s")
+
+    # node ids -> positions in node_ids; refs missing from the extract drop out of their way
+    at = np.minimum(np.searchsorted(node_ids, refs), max(len(node_ids) - 1, 0))
+    present = node_ids[at] == refs if len(node_ids) else np.zeros(len(refs), dtype=bool)
+    way_of = np.repeat(np.arange(len(way_kmh)), np.diff(way_indptr))
+    # way ends are junctions even when no other way touches them
+    ends = np.r_[way_indptr[:-1], way_indptr[1:] - 1]
+    ends = ends[present[ends]]
+    uses = np.bincount(at[present], minlength=len(node_ids)) + np.bincount(at[ends], minlength=len(node_ids))
+    nodes, way_of = at[present], way_of[present]
+    del refs, at, present
+
+    # ways are split at every junction; consecutive splits of one way bound an edge and its shape
+    new_way = way_of[1:] != way_of[:-1]
+    split = np.flatnonzero(np.r_[True, new_way] | np.r_[new_way, True] | (uses[nodes] > 1))
+    first, last = split[:-1], split[1:]
+    same_way = way_of[first] == way_of[last]
+    first, last = first[same_way], last[same_way]
+    closed = nodes[first] == nodes[last]
+    first, last = first[~closed], last[~closed]
+
+    lengths = last - first + 1
+    shape_indptr = np.zeros(len(first) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=shape_indptr[1:])
+    positions = np.arange(shape_indptr[-1]) + np.repeat(first - shape_indptr[:-1], lengths)
+    shape_lat, shape_lon = all_lat[nodes[positions]], all_lon[nodes[positions]]
+    step_km = haversine_km(shape_lat[:-1], shape_lon[:-1], shape_lat[1:], shape_lon[1:])
+    # reduceat over each shape's first point; the step leaving a shape's last point is never included
+    shape_km = np.add.reduceat(np.append(step_km, 0.0), shape_indptr[:-1]) - np.append(step_km, 0.0)[shape_indptr[1:] - 1]
+
+    junctions, ends = np.unique(np.r_[nodes[first], nodes[last]], return_inverse=True)
+    u, v = ends[:len(first)], ends[len(first):]
+    shapes = np.arange(len(first))
+    segment_direction, segment_kmh = way_direction[way_of[first]], way_kmh[way_of[first]]
+    forward, backward = segment_direction != -1, segment_direction != 1
+    edge_from, edge_to = np.r_[u[forward], v[backward]], np.r_[v[forward], u[backward]]
+    edge_shape = np.r_[shapes[forward], shapes[backward]]
+    edge_reversed = np.r_[np.zeros(forward.sum(), dtype=bool), np.ones(backward.sum(), dtype=bool)]
+    edge_seconds = shape_km[edge_shape] / np.r_[segment_kmh[forward], segment_kmh[backward]] * 3600
+    node_lat, node_lon = all_lat[junctions], all_lon[junctions]
+    del nodes, way_of, uses, all_lat, all_lon
+    if not len(junctions):
+        print(f"❌ No driveable roads in {source}; {dest} was not written")
+        return
+
+    # keep the strongly connected component of the best-connected of a few seeds
+    n = len(junctions)
+    indptr, targets = csr(n, edge_from, edge_to)
+    rev_indptr, rev_targets = csr(n, edge_to, edge_from)
+    rng = np.random.default_rng(0)
+    keep = np.zeros(n, dtype=bool)
+    for seed in rng.choice(n, size=min(n, 5), replace=False):
+        component = reachable(indptr, targets, seed) & reachable(rev_indptr, rev_targets, seed)
+        if component.sum() > keep.sum():
+            keep = component
+        if keep.sum() > n // 2:
+            break
+    renumber = np.cumsum(keep) - 1
+    kept_edges = keep[edge_from] & keep[edge_to]
+    edge_from, edge_to = renumber[edge_from[kept_edges]], renumber[edge_to[kept_edges]]
+    edge_seconds = edge_seconds[kept_edges]
+    n = int(keep.sum())
+    indptr, targets, seconds, edge_shape, edge_reversed = csr(
+        n, edge_from, edge_to, edge_seconds, edge_shape[kept_edges], edge_reversed[kept_edges]
+    )
+    rev_indptr, rev_targets, rev_seconds = csr(n, edge_to, edge_from, edge_seconds)
+    print(f"🔗 Graph: {n} junctions, {len(targets)} directed edges ({len(junctions) - n} junctions off the main network dropped)")
+
+    # farthest-point landmarks: each new one is the node worst covered by those chosen so far
+    landmarks_from = np.empty((landmarks, n), dtype=np.float32)
+    landmarks_to = np.empty((landmarks, n), dtype=np.float32)
+    coverage = shortest_times(indptr, targets, seconds, int(rng.integers(n)))
+    for k in range(landmarks):
+        landmark = int(np.argmax(coverage))
+        landmarks_from[k] = shortest_times(indptr, targets, seconds, landmark)
+        landmarks_to[k] = shortest_times(rev_indptr, rev_targets, rev_seconds, landmark)
+        coverage = landmarks_from[k] if k == 0 else np.minimum(coverage, landmarks_from[k])
+
+    os.makedirs(dest, exist_ok=True)
+    arrays = {
+        'lat': node_lat[keep].astype(np.float32), 'lon': node_lon[keep].astype(np.float32),
+        'indptr': indptr, 'targets': targets.astype(np.int32), 'seconds': seconds.astype(np.float32),
+        'edge_shape': edge_shape.astype(np.int32), 'edge_reversed': edge_reversed,
+        'shape_indptr': shape_indptr, 'shape_lat': shape_lat.astype(np.float32), 'shape_lon': shape_lon.astype(np.float32),
+        'shape_km': shape_km.astype(np.float32),
+        # stored one row per node, so a search reads a node's bounds for every landmark in one place
+        'landmarks_from': np.ascontiguousarray(landmarks_from.T), 'landmarks_to': np.ascontiguousarray(landmarks_to.T)
+    }
+    for name in ROAD_FILES:
+        np.save(os.path.join(dest, name + '.npy'), arrays[name])
+    size = sum(os.path.getsize(os.path.join(dest, name + '.npy')) for name in ROAD_FILES)
+    print(f"✅ Road network written to {dest} ({size / 1024 / 1024:.1f}MB) in {time.time() - started:.1f}s")
+
+class RoadNetwork:
+    """Routing graph written by import_roads(), memory-mapped from its .npy arrays"""
+
+    def __init__(self, path):
+        for name in ROAD_FILES:
+            # plain ndarray views of the mapping: slicing a memmap object per row is several times slower
+            setattr(self, name, np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')))
+        if self.landmarks_from.shape[0] != len(self):
+            # imports from before the tables were stored one row per node
+            self.landmarks_from, self.landmarks_to = self.landmarks_from.T, self.landmarks_to.T
+        # ~1km cells: junctions are far denser than gazetteer places
+        self.grid = SpatialGrid(self.lat, self.lon, cell_deg=0.01)
+        self.searches = 0
+        self.settled = 0
+
+    def __len__(self):
+        return len(self.lat)
+
+    def route_many(self, origin, points):
+        """Drive (seconds, km, [(lat, lon), ...]) from origin to each point in one search.
+
+        A* toward one group of nearby goals at a time (see goal_groups), with
+        an ALT potential that bounds the time to the nearest goal of the group
+        (still consistent). The search stops once every goal is settled or
+        route_max_settled nodes are; goals not reached by then get None, as do
+        points farther than route_snap_km from a road, and keep the
+        straight-line estimate. The potential is only worked out for nodes the
+        search reaches.
+        """
+        lat = np.array([origin[0]] + [p[0] for p in points])
+        lon = np.array([origin[1]] + [p[1] for p in points])
+        nodes, snap_km = self.grid.nearest(lat, lon, max_km=route_snap_km)
+        snapped = (nodes >= 0) & (snap_km <= route_snap_km)
+        if not snapped[0]:
+            return [None] * len(points)
+        source = int(nodes[0])
+        goals = sorted({int(nodes[i + 1]) for i in range(len(points)) if snapped[i + 1]})
+        if not goals:
+            return [None] * len(points)
+
+        dist, parent, done = self.search(source, self.goal_groups(source, goals), route_max_settled)
+        routes = []
+        for i, point in enumerate(points):
+            node = int(nodes[i + 1])
+            if not snapped[i + 1] or node not in done:
+                routes.append(None)
+                continue
+            routes.append(self.trace(node, parent, dist[node], origin, point, float(snap_km[0] + snap_km[i + 1])))
+        return routes
+
+    def goal_groups(self, source, goals):
+        """Split goals into groups that one potential bounds tightly, nearest group first.
+
+        The potential toward a set of goals only bounds the time to the nearest
+        of them, so for goals spread around the source it is little better than
+        none and the search grows into a Dijkstra over most of the graph. A goal
+        joins the first group whose anchor, the group's first goal, is within an
+        eighth of the anchor's own straight-line distance from the source.
+        """
+        lat, lon = self.lat[goals].astype(np.float64), self.lon[goals].astype(np.float64)
+        from_source = haversine_km(float(self.lat[source]), float(self.lon[source]), lat, lon)
+        groups, anchors = [], []
+        for i in np.argsort(from_source, kind='stable').tolist():
+            if anchors:
+                near = haversine_km(lat[i], lon[i], lat[anchors], lon[anchors]) <= np.maximum(from_source[anchors] / 8, route_snap_km)
+                if near.any():
+                    groups[int(np.argmax(near))].append(goals[i])
+                    continue
+            anchors.append(i)
+            groups.append([goals[i]])
+        return groups
+
+    def search(self, source, groups, budget):
+        """A* from source aimed at each group of goals in turn; (dist, parent, settled nodes).
+
+        Moving on to the next group swaps in that group's potential and re-keys
+        the open nodes only: with any consistent potential the nodes already
+        settled keep their final times, so each group carries on from where the
+        last one stopped and the whole call settles no more than one Dijkstra.
+        """
+        landmarks_from, landmarks_to = self.landmarks_from, self.landmarks_to
+        indptr, targets, seconds = self.indptr, self.targets, self.seconds
+        dist = {source: 0.0}
+        parent = {source: (-1, -1)}
+        done = set()
+        heap = [(0.0, source)]
+        for group in groups:
+            remaining = set(group) - done
+            if not remaining:
+                continue
+            if len(done) >= budget:
+                break
+            # per landmark, the bound toward the group's closest goal: cost stays O(landmarks) however many goals there are
+            nearest_from = landmarks_from[group].min(axis=0)
+            farthest_to = landmarks_to[group].max(axis=0)
+            # the open nodes are re-keyed in one vectorized pass; nodes reached later get theirs one at a time
+            reached = np.array(sorted({v for _, v in heap} - done), dtype=np.int64)
+            h = np.maximum(
+                (nearest_from - landmarks_from[reached]).max(axis=1, initial=0.0),
+                (landmarks_to[reached] - farthest_to).max(axis=1, initial=0.0)
+            ).tolist()
+            reached = reached.tolist()
+            bounds = dict(zip(reached, h))
+            heap = [(dist[v] + hv, v) for v, hv in zip(reached, h)]
+            heapq.heapify(heap)
+            nearest_from, farthest_to = nearest_from.tolist(), farthest_to.tolist()
+
+            def potential(v):
+                # lower bound on the drive time from v to the nearest goal of the group
+                h = bounds.get(v)
+                if h is None:
+                    h = max(0.0, *map(sub, nearest_from, landmarks_from[v].tolist()), *map(sub, landmarks_to[v].tolist(), farthest_to))
+                    bounds[v] = h
+                return h
+
+            while heap and remaining and len(done) < budget:
+                _, u = heapq.heappop(heap)
+                if u in done:
+                    continue
+                done.add(u)
+                remaining.discard(u)
+                du = dist[u]
+                start, end = int(indptr[u]), int(indptr[u + 1])
+                for edge, v, w in zip(range(start, end), targets[start:end].tolist(), seconds[start:end].tolist()):
+                    nd = du + w
+                    if nd < dist.get(v, math.inf):
+                        dist[v] = nd
+                        parent[v] = (u, edge)
+                        heapq.heappush(heap, (nd + potential(v), v))
+        self.searches += 1
+        self.settled += len(done)
+        return dist, parent, done
+
+    def trace(self, node, parent, seconds, origin, point, access_km):
+        """Walk the parent edges back from node into (seconds, km, polyline)"""
+        legs = []
+        km = access_km
+        while parent[node][0] >= 0:
+            node, edge = parent[node]
+            shape = int(self.edge_shape[edge])
+            a, b = int(self.shape_indptr[shape]), int(self.shape_indptr[shape + 1])
+            leg = list(zip(self.shape_lat[a:b].tolist(), self.shape_lon[a:b].tolist()))
+            # shapes are stored in way order; edges driven against it walk the shape backwards
+            legs.append(leg[::-1] if self.edge_reversed[edge] else leg)
+            km += float(self.shape_km[shape])
+        line = [tuple(origin)] + [p for leg in reversed(legs) for p in leg] + [tuple(point)]
+        # the stretch between each point and its snapped junction is driven at access speed
+        return seconds + access_km / route_access_kmh * 3600, km, line
+
+    def stats(self):
+        return {
+            'junctions': len(self),
+            'edges': len(self.targets),
+            'searches': self.searches,
+            'settled_per_search': self.settled / self.searches if self.searches else 0.0
+        }
+
+def open_road_network():
+    if not os.path.exists(os.path.join(roads_path, 'indptr.npy')):
+        return None
+    started = time.time()
+    network = RoadNetwork(roads_path)
+    print(f"🛣️ Offline road network: {len(network)} junctions loaded in {time.time() - started:.1f}s")
+    return network
+
+road_network = None
+
+def route_many(origin, points):
+    """Road routes from origin to each point, all None when no road network is installed"""
+    if road_network is None or not len(points):
+        return [None] * len(points)
+    return road_network.route_many(origin, points)
+
+def describe_drive(distance, route):
+    """Popup text for the drive to a marker: routed when possible, else the old straight-line guess"""
+    if route is None:
+        return f"~{int(distance / 60 * 60)} min (straight line)"
+    seconds, km, _ = route
+    return f"{int(round(seconds / 60))} min by road ({km:.1f} km)"
+
+# === Route Geometry ===
+WEB_MERCATOR_M_PER_PX = 156543.03392
+MAX_LINE_ZOOM = 22
+
+def line_importance(points):
+    """Douglas-Peucker significance of every vertex, in metres.
+
+    A vertex is dropped by simplification at any tolerance at or above its
+    value, so one pass serves every zoom level. Each split scores all the
+    interior points of its span with one vectorized distance computation.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    importance = np.zeros(n)
+    importance[0] = importance[-1] = np.inf
+    if n < 3:
+        return importance
+    # local equirectangular metres are plenty for deciding which vertices matter
+    y = points[:, 0] * 110540.0
+    x = points[:, 1] * 111320.0 * np.cos(np.radians(points[:, 0].mean()))
+
+    spans = [(0, n - 1, np.inf)]
+    while spans:
+        first, last, ceiling = spans.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length:
+            d = np.abs(px * dy - py * dx) / length
+        else:
+            d = np.hypot(px, py)
+        split = first + 1 + int(d.argmax())
+        # a vertex can never outrank the split that exposed it, which keeps zoom filtering monotonic
+        importance[split] = min(float(d.max()), ceiling)
+        spans.append((first, split, importance[split]))
+        spans.append((split, last, importance[split]))
+    return importance
 
-if getattr(sys, 'frozen', False):
-    base_path = os.path.dirname(sys.executable)
-else:
-    base_path = os.path.dirname(os.path.abspath(__file__))
+def line_min_zooms(points, tolerance_px=None):
+    """Lowest zoom at which each vertex moves the line by more than tolerance_px"""
+    tolerance_px = tolerance_px or line_tolerance_px
+    importance = line_importance(points)
+    lat = np.radians(np.asarray(points, dtype=np.float64)[:, 0].mean())
+    with np.errstate(divide='ignore'):
+        zoom = np.ceil(np.log2(tolerance_px * WEB_MERCATOR_M_PER_PX * math.cos(lat) / importance))
+    return np.clip(np.nan_to_num(zoom, nan=0.0, neginf=0.0), 0, MAX_LINE_ZOOM + 1).astype(int)
 
-tile_folder = os.path.join(base_path, 'tiles')
+def encode_polyline(points, precision=5):
+    """Google encoded-polyline string for [(lat, lon), ...]"""
+    scaled = np.round(np.asarray(points, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    chunks = []
+    for value in ((deltas << 1) ^ (deltas >> 63)).tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+# shared by every EncodedPolyLine of a map and added to its script once
+POLYLINE_DECODER = """
+    function decodeMapPolyline(encoded, precision) {
+        var points = [], index = 0, lat = 0, lng = 0, factor = Math.pow(10, precision);
+        while (index < encoded.length) {
+            var values = [0, 0];
+            for (var k = 0; k < 2; k++) {
+                var shift = 0, result = 0, byte;
+                do {
+                    byte = encoded.charCodeAt(index++) - 63;
+                    result |= (byte & 0x1f) << shift;
+                    shift += 5;
+                } while (byte >= 0x20);
+                values[k] = (result & 1) ? ~(result >> 1) : (result >> 1);
+            }
+            lat += values[0];
+            lng += values[1];
+            points.push([lat / factor, lng / factor]);
+        }
+        return points;
+    }
+"""
+
+class EncodedPolyLine(MacroElement):
+    """A polyline shipped as an encoded string plus one zoom level per vertex.
+
+    The browser decodes it once and on every zoom draws only the vertices
+    that are visible at that scale, so long routes stay small in the saved
+    HTML and cheap to render when zoomed out.
+    """
 
-if os.path.exists(tile_folder):
-    zoom_levels = [d for d in os.listdir(tile_folder) if os.path.isdir(os.path.join(tile_folder, d)) and d.isdigit()]
-    if not zoom_levels:
-        print(f"⚠️ No zoom folders found in: {tile_folder}")
-        zoom_levels = []
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function (map) {
+                var points = decodeMapPolyline({{ this.encoded|tojson }}, {{ this.precision }});
+                var levels = {{ this.levels|tojson }};
+                var line = L.polyline([], {{ this.options|tojson }}).addTo(map);
+                {% if this.popup %}line.bindPopup({{ this.popup|tojson }});{% endif %}
+                function redraw() {
+                    var zoom = map.getZoom();
+                    line.setLatLngs(points.filter(function (p, i) { return levels.charCodeAt(i) - 63 <= zoom; }));
+                }
+                map.on('zoomend', redraw);
+                redraw();
+                return line;
+            })({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, points, popup=None, precision=5, **options):
+        super().__init__()
+        self._name = 'EncodedPolyLine'
+        self.encoded = encode_polyline(points, precision)
+        self.levels = ''.join(chr(63 + z) for z in line_min_zooms(points).tolist())
+        self.precision = precision
+        self.popup = popup
+        self.options = options
+
+    def render(self, **kwargs):
+        # a fixed child name: every line replaces the same decoder instead of adding its own
+        self.get_root().script.add_child(Element(POLYLINE_DECODER), name='decode_map_polyline')
+        super().render(**kwargs)
+
+def add_line(m, points, color, weight, opacity, popup=None):
+    """Draw a marker line: a plain PolyLine for a straight segment, encoded and zoom-simplified for a route"""
+    if len(points) <= 2:
+        folium.PolyLine(locations=points, color=color, weight=weight, opacity=opacity, popup=popup).add_to(m)
     else:
-        print(f"✅ Found zoom levels: {', '.join(sorted(zoom_levels))}")
-else:
-    print(f"⚠️ Tiles folder not found: {tile_folder}")
-    zoom_levels = []
+        EncodedPolyLine(points, popup=popup, color=color, weight=weight, opacity=opacity).add_to(m)
 
-app = Flask(__name__)
+def benchmark_lines(vertices=20000):
+    """Saved-map size for a long synthetic route drawn as a PolyLine versus an EncodedPolyLine"""
+    rng = np.random.default_rng(0)
+    steps = rng.normal(0, 1, (vertices, 2)).cumsum(axis=0) * 0.0005
+    points = (np.array([36.75, 3.06]) + steps).tolist()
+    for label, draw in (('PolyLine', lambda m: folium.PolyLine(points, color='#667eea').add_to(m)),
+                        ('encoded', lambda m: EncodedPolyLine(points, color='#667eea').add_to(m))):
+        started = time.perf_counter()
+        m = folium.Map(location=points[0], zoom_start=12)
+        draw(m)
+        size = len(m.get_root().render())
+        print(f"⏱️ {label:>8}: {size / 1024:8.1f}KB map HTML, built in {(time.perf_counter() - started) * 1000:.0f}ms")
+    zooms = line_min_zooms(points)
+    for zoom in (6, 10, 14, 18):
+        print(f"   zoom {zoom:>2}: {int((zooms <= zoom).sum())} of {vertices} vertices drawn")
 
-def check_internet_connection():
-    try:
-        socket.create_connection(("8.8.8.8", 53), timeout=3)
-        print("✅ Internet connection detected")
-        return True
-    except OSError:
-        print("⚠️ No internet connection")
-        return False
+# === User Location ===
+def locate_with_ipapi():
+    response = requests.get('https://ipapi.co/json/', timeout=5)
+    if response.status_code == 200:
+        data = response.json()
+        lat = data.get('latitude')
+        lon = data.get('longitude')
+        city = data.get('city', 'Unknown')
+        region = data.get('region', 'Unknown')
+        country = data.get('country_name', 'Unknown')
+        
+        if lat and lon:
+            return (lat, lon, f"{city}, {region}, {country}")
+    return None
 
-def get_user_location():
-    print("\n🌍 Attempting to detect your real location...")
-    
-    try:
-        print("🔍 Trying ipapi.co...")
-        response = requests.get('https://ipapi.co/json/', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            lat = data.get('latitude')
-            lon = data.get('longitude')
+def locate_with_ip_api():
+    response = requests.get('http://ip-api.com/json/', timeout=5)
+    if response.status_code == 200:
+        data = response.json()
+        if data.get('status') == 'success':
+            lat = data.get('lat')
+            lon = data.get('lon')
             city = data.get('city', 'Unknown')
-            region = data.get('region', 'Unknown')
-            country = data.get('country_name', 'Unknown')
+            region = data.get('regionName', 'Unknown')
+            country = data.get('country', 'Unknown')
             
             if lat and lon:
-                print(f"✅ Location detected: {city}, {region}, {country}")
-                print(f"📍 Coordinates: {lat}, {lon}")
                 return (lat, lon, f"{city}, {region}, {country}")
-    except Exception as e:
-        print(f"❌ ipapi.co failed: {e}")
-    
-    try:
-        print("🔍 Trying ip-api.com...")
-        response = requests.get('http://ip-api.com/json/', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 'success':
-                lat = data.get('lat')
-                lon = data.get('lon')
-                city = data.get('city', 'Unknown')
-                region = data.get('regionName', 'Unknown')
-                country = data.get('country', 'Unknown')
-                
-                if lat and lon:
-                    print(f"✅ Location detected: {city}, {region}, {country}")
-                    print(f"📍 Coordinates: {lat}, {lon}")
-                    return (lat, lon, f"{city}, {region}, {country}")
-    except Exception as e:
-        print(f"❌ ip-api.com failed: {e}")
-    
+    return None
+
+def locate_with_ipinfo():
+    response = requests.get('https://ipinfo.io/json', timeout=5)
+    if response.status_code == 200:
+        data = response.json()
+        loc = data.get('loc', '').split(',')
+        city = data.get('city', 'Unknown')
+        region = data.get('region', 'Unknown')
+        country = data.get('country', 'Unknown')
+        
+        if len(loc) == 2:
+            return (float(loc[0]), float(loc[1]), f"{city}, {region}, {country}")
+    return None
+
+ip_location_providers = [
+    ('ipapi.co', locate_with_ipapi),
+    ('ip-api.com', locate_with_ip_api),
+    ('ipinfo.io', locate_with_ipinfo)
+]
+
+def race_ip_location():
+    """Query every provider at once and return the first usable answer"""
+    print("\n🌍 Attempting to detect your real location...")
+    pool = ThreadPoolExecutor(max_workers=len(ip_location_providers), thread_name_prefix='ip-location')
+    futures = {pool.submit(locate): name for name, locate in ip_location_providers}
     try:
-        print("🔍 Trying ipinfo.io...")
-        response = requests.get('https://ipinfo.io/json', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            loc = data.get('loc', '').split(',')
-            city = data.get('city', 'Unknown')
-            region = data.get('region', 'Unknown')
-            country = data.get('country', 'Unknown')
-            
-            if len(loc) == 2:
-                lat, lon = float(loc[0]), float(loc[1])
-                print(f"✅ Location detected: {city}, {region}, {country}")
-                print(f"📍 Coordinates: {lat}, {lon}")
-                return (lat, lon, f"{city}, {region}, {country}")
-    except Exception as e:
-        print(f"❌ ipinfo.io failed: {e}")
+        for future in as_completed(futures, timeout=6):
+            name = futures[future]
+            try:
+                location = future.result()
+            except Exception as e:
+                print(f"❌ {name} failed: {e}")
+                continue
+            if location:
+                print(f"✅ Location detected via {name}: {location[2]}")
+                print(f"📍 Coordinates: {location[0]}, {location[1]}")
+                return location
+    except FuturesTimeoutError:
+        pass
+    finally:
+        # losers are dropped; requests already on the wire finish within their own timeout
+        pool.shutdown(wait=False, cancel_futures=True)
     
     print("⚠️ Could not detect location")
     return None
 
-def get_gps_from_image(image_path):
+def parse_location_override(value):
+    if not value:
+        return None
+    parts = value.split(',', 2)
+    try:
+        return (float(parts[0]), float(parts[1]), parts[2].strip() if len(parts) > 2 else "Configured Location")
+    except (ValueError, IndexError):
+        print(f"⚠️ Ignoring invalid MAP_USER_LOCATION: {value}")
+        return None
+
+user_location_override = parse_location_override(os.environ.get('MAP_USER_LOCATION'))
+user_location_state = {'value': None, 'fetched': 0.0, 'refreshing': False}
+user_location_lock = threading.Lock()
+location_flights = SingleFlight()
+
+def refresh_user_location():
+    location = location_flights.run('user', race_ip_location)
+    with user_location_lock:
+        # keep serving the last good answer if a refresh fails
+        if location is not None or user_location_state['value'] is None:
+            user_location_state['value'] = location
+        user_location_state['fetched'] = time.time()
+        user_location_state['refreshing'] = False
+    return user_location_state['value']
+
+def get_user_location():
+    """(lat, lon, label) of this server, memoized.
+    
+    MAP_USER_LOCATION ('lat,lon[,label]') skips detection entirely. A stale
+    answer is returned immediately while a background thread refreshes it;
+    only the very first call waits for the provider race.
+    """
+    if user_location_override:
+        return user_location_override
+    
+    with user_location_lock:
+        value = user_location_state['value']
+        age = time.time() - user_location_state['fetched']
+        ttl = user_location_ttl if value is not None else user_location_retry
+        if age < ttl:
+            return value
+        if value is not None:
+            if not user_location_state['refreshing']:
+                user_location_state['refreshing'] = True
+                threading.Thread(target=refresh_user_location, name='ip-location-refresh', daemon=True).start()
+            return value
+    
+    return refresh_user_location()
+
+# === Thumbnails ===
+image_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix='image')
+
+THUMBNAIL_MIMETYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+def make_thumbnail(source, size=None, encoding=None, quality=None):
+    """Encode a small preview of a photo, returns (bytes, mimetype).
+    
+    JPEGs are decoded at reduced DCT scale (1/2 to 1/8) via draft() and other
+    formats are shrunk with an integer reduce(), so a 50MP photo never gets
+    decoded at full resolution. What is left is at most a few times the
+    target size, so a bilinear resample is enough and the image is resized,
+    rotated and encoded without further copies.
+    """
+    size = size or thumbnail_size
+    encoding = (encoding or thumbnail_format).lower()
+    quality = quality or thumbnail_quality
+    
+    with Image.open(source) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        else:
+            factor = min(img.size) // (2 * size)
+            if factor > 1:
+                img = img.reduce(factor)
+        img.thumbnail((size, size), Image.Resampling.BILINEAR, reducing_gap=None)
+        ImageOps.exif_transpose(img, in_place=True)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        
+        buffer = BytesIO()
+        if encoding == 'webp':
+            # method 1 is within 2% of method 4's size at a third of the time on a 200px image
+            img.save(buffer, format='WEBP', quality=quality, method=1)
+        else:
+            img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue(), THUMBNAIL_MIMETYPES.get(encoding, 'image/jpeg')
+
+def legacy_thumbnail(source):
+    """The previous full-decode LANCZOS path, kept for benchmark_thumbnails"""
+    with Image.open(source) as img:
+        img.load()
+        img.thumbnail((200, 200), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue(), 'image/jpeg'
+
+def benchmark_thumbnails(count=10, sizes=((6000, 4000), (8160, 6120))):
+    """Time thumbnail generation on synthetic 24MP and 50MP JPEGs"""
+    for width, height in sizes:
+        # blurred noise compresses like a photo; raw noise would make entropy decoding dominate
+        base = Image.effect_noise((width // 10, height // 10), 64).convert('RGB')
+        photo = base.filter(ImageFilter.GaussianBlur(2)).resize((width, height), Image.Resampling.BICUBIC)
+        buffer = BytesIO()
+        photo.save(buffer, format='JPEG', quality=90)
+        data = buffer.getvalue()
+        print(f"\n📷 {width}x{height} JPEG, {len(data) // 1024}KB")
+        
+        baseline = None
+        for label, build in (('full decode', legacy_thumbnail),
+                             ('draft jpeg', lambda f: make_thumbnail(f, encoding='jpeg')),
+                             ('draft webp', lambda f: make_thumbnail(f, encoding='webp'))):
+            started = time.perf_counter()
+            for _ in range(count):
+                thumb, _mimetype = build(BytesIO(data))
+            elapsed = (time.perf_counter() - started) / count
+            baseline = baseline or elapsed
+            print(f"⏱️ {label:>11}: {elapsed * 1000:7.1f}ms  {len(thumb):6d} bytes  {baseline / elapsed:5.1f}x")
+
+def get_gps_from_image(image_path, with_address=True, image_buffer=None):
+    """GPS, metadata and thumbnail of a photo on disk, or of image_buffer (bytes or a seekable stream)"""
     try:
         print(f"\n{'='*60}")
         print(f"🔍 Processing image file: {image_path}")
         print(f"{'='*60}")
         
-        if not os.path.exists(image_path):
-            print(f"❌ File does not exist!")
+        if image_buffer is not None:
+            if isinstance(image_buffer, (bytes, bytearray)):
+                image_buffer = BytesIO(image_buffer)
+            print(f"✅ Buffered, size: {image_buffer.seek(0, os.SEEK_END)} bytes")
+            
+            def open_image():
+                image_buffer.seek(0)
+                return image_buffer
+        elif not os.path.exists(image_path):
+            print("❌ File does not exist!")
             return None
+        else:
+            print(f"✅ File exists, size: {os.path.getsize(image_path)} bytes")
+            open_image = lambda: image_path
         
-        print(f"✅ File exists, size: {os.path.getsize(image_path)} bytes")
-        
-        locator = ExifGeoLocator(image_path)
+        locator = ExifGeoLocator(open_image())
         
         if locator.lat and locator.lon:
             print(f"✅ SUCCESS: GPS found at {locator.lat}, {locator.lon}")
             
             try:
-                img = Image.open(image_path)
-                img.thumbnail((200, 200), Image.Resampling.LANCZOS)
+                thumb, img_mimetype = make_thumbnail(open_image())
+                img_str = base64.b64encode(thumb).decode()
                 
-                from io import BytesIO
-                buffer = BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
-                img_str = base64.b64encode(buffer.getvalue()).decode()
-                
-                print(f"✅ Created thumbnail")
+                print(f"✅ Created thumbnail ({len(thumb)} bytes)")
             except Exception as e:
                 print(f"⚠️ Could not create thumbnail: {e}")
-                img_str = None
+                img_str, img_mimetype = None, None
             
             return {
                 'coords': (locator.lat, locator.lon),
                 'metadata': locator.metadata,
-                'address': locator.reverse_geocode(),
-                'image_data': img_str
+                'address': locator.reverse_geocode() if with_address else None,
+                'image_data': img_str,
+                'image_mimetype': img_mimetype
             }
         else:
-            print(f"❌ FAILED: No valid GPS coordinates extracted")
+            print("❌ FAILED: No valid GPS coordinates extracted")
         
         return None
     except Exception as e:
         print(f"❌ EXCEPTION: Error extracting GPS data: {e}")
         return None
 
+# === Streaming Uploads ===
+class UploadMemoryBudget:
+    """Bytes that the uploads of one request hold in memory, capped at limit"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+    
+    def reserve(self, size):
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        return True
+    
+    def release(self, size):
+        self.used -= size
+
+class PhotoUploadStream:
+    """Write target for one uploaded photo, filled chunk by chunk by werkzeug's multipart parser.
+    
+    Only the header stays in memory, charged to the request's
+    UploadMemoryBudget, and it is parsed again only once enough bytes have
+    arrived for the read that came up short last time. As soon as the header
+    has been parsed the photo leaves memory: photos with GPS (for the
+    thumbnail) and photos whose header could not be read (for the Pillow
+    fallback) go to a temporary file, photos without GPS are counted and
+    dropped.
+    """
+    
+    def __init__(self, filename=None, budget=None):
+        self.filename = filename
+        self.budget = budget or UploadMemoryBudget(upload_memory_bytes)
+        self.size = 0
+        self.record = None
+        self.decided = False
+        self.head = bytearray()
+        self.parse_at = 0
+        self.spool = None
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.size > upload_file_max_bytes:
+            raise RequestEntityTooLarge(f"{self.filename} is larger than {upload_file_max_bytes // (1024 * 1024)}MB")
+        if not self.decided and not self.budget.reserve(len(data)):
+            # the request is out of memory for headers: keep everything for Pillow
+            self.decide(None)
+        if self.decided:
+            if self.spool is not None:
+                self.spool.write(data)
+        else:
+            self.head += data
+            if len(self.head) >= self.parse_at:
+                self.read_header(final=False)
+        return len(data)
+    
+    def read_header(self, final):
+        src = ByteSource(self.head)
+        record = read_photo_geo(src)
+        if src.short_read and not final:
+            self.parse_at = src.read_end
+            if self.parse_at <= upload_header_bytes:
+                return
+            # a header that does not fit the window is as good as unreadable
+            record = None
+        self.decide(record)
+    
+    def decide(self, record):
+        self.decided = True
+        self.record = record
+        if record is None or record.lat is not None:
+            self.spool = tempfile.TemporaryFile()
+            self.spool.write(self.head)
+        self.budget.release(len(self.head))
+        self.head = None
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        # werkzeug rewinds the container once the part is complete
+        if not self.decided:
+            self.read_header(final=True)
+        return self.spool.seek(offset, whence) if self.spool is not None else 0
+    
+    def read(self, size=-1):
+        return self.spool.read(size) if self.spool is not None else b''
+    
+    def close(self):
+        if not self.decided:
+            self.budget.release(len(self.head))
+            self.decided, self.head = True, None
+        if self.spool is not None:
+            self.spool.close()
+    
+    def gps_data(self, filename):
+        """The get_gps_from_image result for this upload, None when it has no GPS"""
+        if self.record is None:
+            return get_gps_from_image(filename, with_address=False, image_buffer=self.spool) if self.spool else None
+        if self.record.lat is None:
+            print(f"❌ {filename}: no GPS in EXIF header, {self.size} bytes discarded")
+            return None
+        try:
+            self.spool.seek(0)
+            thumb, mimetype = make_thumbnail(self.spool)
+            image_data = base64.b64encode(thumb).decode()
+        except Exception as e:
+            print(f"⚠️ Could not create thumbnail for {filename}: {e}")
+            image_data, mimetype = None, None
+        return {
+            'coords': (self.record.lat, self.record.lon),
+            'metadata': self.record.metadata,
+            'address': None,
+            'image_data': image_data,
+            'image_mimetype': mimetype
+        }
+
+class PhotoUploadRequest(Request):
+    upload_budget = None
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not stream_uploads:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if self.upload_budget is None:
+            self.upload_budget = UploadMemoryBudget(upload_memory_bytes)
+        return PhotoUploadStream(filename, self.upload_budget)
+
+app.request_class = PhotoUploadRequest
+app.config['MAX_CONTENT_LENGTH'] = upload_request_max_bytes
+# offline mode posts a lat and a lon field per point
+app.config['MAX_FORM_PARTS'] = 2 * max_form_points + 16
+
+def process_image(upload):
+    filename, data = upload
+    if isinstance(data, PhotoUploadStream):
+        gps_data = data.gps_data(filename)
+    else:
+        gps_data = get_gps_from_image(filename, with_address=False, image_buffer=data)
+    gps_data = gps_data or {}
+    return {
+        'filename': filename,
+        'coords': gps_data.get('coords'),
+        'metadata': gps_data.get('metadata'),
+        'address': None,
+        'image_data': gps_data.get('image_data'),
+        'image_mimetype': gps_data.get('image_mimetype')
+    }
+
+def process_images(uploads):
+    """Read GPS, metadata and thumbnails for (filename, bytes or PhotoUploadStream) uploads on the image pool.
+    
+    Results keep the upload order. Pillow drops the GIL while decoding and
+    resampling, so threads scale with cores without pickling every photo
+    across to a process pool.
+    """
+    images_data = list(image_pool.map(process_image, uploads))
+    
+    # one batched reverse-geocode for the whole upload instead of one lookup per photo
+    located = [img for img in images_data if img['coords']]
+    for img, address in zip(located, reverse_geocode_many([img['coords'] for img in located])):
+        img['address'] = address
+    return images_data
+
+# === Photo Library Ingestion ===
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.heic', '.heif', '.tif', '.tiff', '.png', '.webp'}
+
+def locate_photo_batch(entries):
+    """Runs in a worker process: one photo_library row per (path, size, mtime_ns)"""
+    rows = []
+    with contextlib.redirect_stdout(StringIO()):
+        for path, size, mtime_ns in entries:
+            try:
+                locator = ExifGeoLocator(path)
+                lat, lon, metadata = locator.lat, locator.lon, locator.metadata or {}
+            except Exception:
+                lat, lon, metadata = None, None, {}
+            rows.append((path, size, mtime_ns, lat, lon) + tuple(
+                str(metadata.get(key, 'Unknown')) for key in ('make', 'camera', 'datetime', 'width', 'height', 'altitude')
+            ))
+    return rows
+
+def walk_photos(root):
+    """(path, size, mtime_ns) of every photo under root"""
+    pending = [root]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in PHOTO_EXTENSIONS:
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+        except OSError as e:
+            print(f"⚠️ Skipping {e.filename}: {e.strerror}")
+
+def ingest_photos(root, dest, workers, batch_size=256):
+    """Index the GPS position and metadata of every photo under root into a SQLite store.
+    
+    The store doubles as the manifest: a file whose size and mtime match its
+    row is skipped, so re-runs only read new or changed photos. Rows for files
+    that disappeared are removed. Photos without GPS are kept with NULL
+    coordinates so they are not re-read either.
+    """
+    root = os.path.abspath(root)
+    conn = sqlite3.connect(dest)
+    conn.execute("""CREATE TABLE IF NOT EXISTS photos (
+        path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, lat REAL, lon REAL,
+        make TEXT, camera TEXT, taken TEXT, width TEXT, height TEXT, altitude TEXT
+    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS photos_lat_lon ON photos (lat, lon) WHERE lat IS NOT NULL")
+    prefix = os.path.join(root, '')
+    manifest = {
+        path: (size, mtime_ns) for path, size, mtime_ns in
+        conn.execute("SELECT path, size, mtime_ns FROM photos WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+    }
+    print(f"📚 Ingesting photos under {root} into {dest} ({len(manifest)} already indexed)")
+    
+    started = time.time()
+    last_report = started
+    seen = 0
+    processed = 0
+    located = 0
+    
+    def store(rows):
+        nonlocal processed, located
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        processed += len(rows)
+        located += sum(1 for row in rows if row[3] is not None)
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        batch = []
+        for path, size, mtime_ns in walk_photos(root):
+            seen += 1
+            if manifest.pop(path, None) == (size, mtime_ns):
+                continue
+            batch.append((path, size, mtime_ns))
+            if len(batch) < batch_size:
+                continue
+            in_flight.add(pool.submit(locate_photo_batch, batch))
+            batch = []
+            # bound the queue so a huge tree is not walked far ahead of the workers
+            if len(in_flight) >= workers * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    store(future.result())
+            if time.time() - last_report >= 5:
+                last_report = time.time()
+                print(f"⏱️ {seen} files scanned, {processed} read ({processed / (last_report - started):.0f} files/s)")
+        if batch:
+            in_flight.add(pool.submit(locate_photo_batch, batch))
+        for future in as_completed(in_flight):
+            store(future.result())
+    
+    # whatever is left in the manifest was not found on this walk
+    with conn:
+        conn.executemany("DELETE FROM photos WHERE path=?", ((path,) for path in manifest))
+    total, with_gps = conn.execute("SELECT COUNT(*), COUNT(lat) FROM photos").fetchone()
+    conn.close()
+    
+    elapsed = time.time() - started
+    print(f"✅ {seen} files scanned in {elapsed:.1f}s: {processed} read ({processed / max(elapsed, 1e-9):.0f} files/s), "
+          f"{located} with GPS, {seen - processed} unchanged, {len(manifest)} removed")
+    print(f"🗺️ {dest} now holds {total} photos, {with_gps} with GPS")
+
+# === Lazy Photo Markers ===
+# thumbnails and popup bodies of photo markers, served by id instead of being inlined into the map
+photo_cache = LRUByteCache(photo_cache_bytes)
+
+def publish_thumbnail(thumbnail, mimetype):
+    """Keep a thumbnail for /photos/<id>; returns its URL.
+    
+    Ids are content hashes, so a URL never changes what it points to and
+    browsers may cache it indefinitely.
+    """
+    thumbnail_id = hashlib.sha1(thumbnail).hexdigest()[:20]
+    photo_cache.put(('thumbnail', thumbnail_id), (thumbnail, mimetype), len(thumbnail))
+    return f"{request.host_url}photos/{thumbnail_id}"
+
+def publish_popup(popup_html):
+    """Keep a popup body for /popups/<id>; returns its URL"""
+    body = popup_html.encode('utf-8')
+    popup_id = hashlib.sha1(body).hexdigest()[:20]
+    photo_cache.put(('popup', popup_id), body, len(body))
+    return f"{request.host_url}popups/{popup_id}"
+
+class LazyPopups(MacroElement):
+    """Fills popups holding a data-src placeholder from the server the first time they open"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.on('popupopen', function (e) {
+                var holder = e.popup.getElement().querySelector('.lazy-popup[data-src]');
+                if (!holder) { return; }
+                var src = holder.getAttribute('data-src');
+                holder.removeAttribute('data-src');
+                fetch(src).then(function (response) {
+                    if (!response.ok) { throw new Error(response.status); }
+                    return response.text();
+                }).then(function (html) {
+                    holder.innerHTML = html;
+                    e.popup.update();
+                }).catch(function () {
+                    holder.innerHTML = '<p style="font-size: 12px;">⚠️ Details are no longer available, submit the photos again.</p>';
+                });
+            });
+        {% endmacro %}
+    """)
+    
+    def __init__(self):
+        super().__init__()
+        self._name = 'LazyPopups'
+
+# === Server-side Clustering ===
+# 256px tiles split into 64px cells, so a zoom's cells nest four to one inside the next zoom's
+CLUSTER_CELL_BITS = 2
+MAX_MERCATOR_LAT = 85.05112878
+
+def mercator_xy(lat, lon):
+    """Web Mercator position of each point in [0, 1) x [0, 1), y growing southwards"""
+    sin = np.sin(np.radians(np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)))
+    x = (np.asarray(lon) + 180.0) / 360.0 % 1.0
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return x, np.clip(y, 0.0, np.nextafter(1.0, 0.0))
+
+def mercator_lat_lon(x, y):
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y)))), x * 360.0 - 180.0
+
+class ClusterIndex:
+    """Grid clusters of one point set for every zoom, built once.
+
+    Level max_zoom + 1 holds the points themselves; each level above merges
+    the cells of the one below (cell >> 1), so building costs one sort per
+    zoom. Levels stay sorted by (row, column), which makes a viewport query
+    one searchsorted per visible row of cells.
+    """
+
+    def __init__(self, coords, max_zoom=None):
+        self.max_zoom = cluster_max_zoom if max_zoom is None else max_zoom
+        lat, lon = as_lat_lon(coords)
+        self.points = len(lat)
+        x, y = mercator_xy(lat, lon)
+        bits = self.max_zoom + 1 + CLUSTER_CELL_BITS
+        keys = (np.floor(y * (1 << bits)).astype(np.int64) << bits) | np.floor(x * (1 << bits)).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        count = np.ones(self.points, dtype=np.int32)
+        self.levels = [None] * (self.max_zoom + 2)
+        self.levels[-1] = (keys[order], lat[order], lon[order], count)
+        x, y, keys = x[order], y[order], keys[order]
+
+        for zoom in range(self.max_zoom, -1, -1):
+            bits -= 1
+            parents = ((keys >> (bits + 2)) << bits) | ((keys & ((2 << bits) - 1)) >> 1)
+            order = np.argsort(parents, kind='stable')
+            parents = parents[order]
+            starts = np.flatnonzero(np.diff(parents, prepend=-1))
+            weights = count[order]
+            count = np.add.reduceat(weights, starts)
+            # centroids are averaged in Mercator so they sit where the members are drawn
+            x = np.add.reduceat(x[order] * weights, starts) / count
+            y = np.add.reduceat(y[order] * weights, starts) / count
+            keys = parents[starts]
+            self.levels[zoom] = (keys, *mercator_lat_lon(x, y), count)
+        self.peaks = [int(level[3].max()) if len(level[3]) else 1 for level in self.levels]
+        self.nbytes = sum(a.nbytes for level in self.levels for a in level)
+
+    def select(self, zoom, top, bottom, left, right):
+        """Positions in level zoom of the cells in rows top..bottom and columns left..right.
+
+        Columns wrap around the antimeridian, so left may exceed right or
+        fall outside the grid.
+        """
+        keys = self.levels[zoom][0]
+        bits = zoom + CLUSTER_CELL_BITS
+        size = 1 << bits
+        rows = np.arange(max(top, 0), min(bottom, size - 1) + 1, dtype=np.int64) << bits
+        first, last = left % size, right % size
+        if left <= right and right - left + 1 >= size:
+            columns = [(0, size - 1)]
+        elif first <= last:
+            columns = [(first, last)]
+        else:
+            columns = [(first, size - 1), (0, last)]
+
+        spans = []
+        for first, last in columns:
+            starts = np.searchsorted(keys, rows | first)
+            ends = np.searchsorted(keys, rows | last, side='right')
+            spans.extend(np.arange(a, b) for a, b in zip(starts.tolist(), ends.tolist()) if b > a)
+        return np.concatenate(spans) if spans else np.zeros(0, dtype=np.int64)
+
+    def query(self, west, south, east, north, zoom):
+        """[[lat, lon, count], ...] for the cells of zoom overlapping the box"""
+        zoom = min(max(int(zoom), 0), self.max_zoom + 1)
+        size = 1 << (zoom + CLUSTER_CELL_BITS)
+        (left, right), (top, bottom) = mercator_xy(np.array([north, south]), np.array([west, east]))
+        if east - west >= 360:
+            left, right = 0.0, 1.0
+        hits = self.select(zoom, int(top * size), int(bottom * size), int(left * size), int(right * size))
+        _, lat, lon, count = self.levels[zoom]
+        return [list(c) for c in zip(np.round(lat[hits], 6).tolist(), np.round(lon[hits], 6).tolist(), count[hits].tolist())]
+
+    def stats(self):
+        return {
+            'points': self.points,
+            'levels': [len(level[0]) for level in self.levels],
+            'bytes': self.nbytes
+        }
+
+cluster_indexes = LRUByteCache(cluster_cache_bytes)
+
+def publish_clusters(coords):
+    """Build (or reuse) the ClusterIndex of coords; returns (dataset id, index).
+    
+    Callers use the returned index rather than looking the id up again, as a
+    concurrent publish may already have evicted it from the cache.
+    """
+    points = np.ascontiguousarray(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    dataset_id = hashlib.sha1(points.tobytes()).hexdigest()[:20]
+    index = cluster_indexes.get(dataset_id)
+    if index is None:
+        started = time.perf_counter()
+        index = ClusterIndex(points)
+        cluster_indexes.put(dataset_id, index, index.nbytes)
+        print(f"🧩 Clustered {index.points} points over {len(index.levels)} zoom levels in {time.perf_counter() - started:.2f}s")
+    return dataset_id, index
+
+class ClusterLayer(Layer):
+    """Markers for one published dataset, fetched from /clusters for the visible box on every move"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.featureGroup();
+            (function (layer, map) {
+                var generation = 0;
+                function clusterIcon(count) {
+                    var size = count < 100 ? 36 : count < 10000 ? 44 : 52;
+                    var label = count < 10000 ? count : Math.round(count / 1000) + 'k';
+                    return L.divIcon({
+                        className: '',
+                        iconSize: [size, size],
+                        html: '<div style="width:' + size + 'px;height:' + size + 'px;line-height:' + size + 'px;border-radius:50%;'
+                            + 'background:linear-gradient(135deg,#667eea,#764ba2);color:white;font:700 12px Inter,sans-serif;'
+                            + 'text-align:center;box-shadow:0 4px 12px rgba(102,126,234,0.5);">' + label + '</div>'
+                    });
+                }
+                function refresh() {
+                    if (!map.hasLayer(layer)) { return; }
+                    var bounds = map.getBounds(), zoom = map.getZoom(), current = ++generation;
+                    fetch({{ this.url|tojson }} + '&bbox=' + [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(',') + '&z=' + zoom)
+                        .then(function (response) { return response.json(); })
+                        .then(function (data) {
+                            // a later move already asked for a newer view
+                            if (current !== generation) { return; }
+                            layer.clearLayers();
+                            data.clusters.forEach(function (c) {
+                                if (c[2] > 1) {
+                                    L.marker([c[0], c[1]], {icon: clusterIcon(c[2])})
+                                        .on('click', function () { map.setView([c[0], c[1]], Math.min(zoom + 2, map.getMaxZoom())); })
+                                        .addTo(layer);
+                                } else {
+                                    L.marker([c[0], c[1]]).bindPopup(
+                                        "<div style='font-family: Inter, sans-serif; width: 200px;'>"
+                                        + "<h4 style='margin: 0 0 10px 0; color: #667eea;'>📍 Location</h4>"
+                                        + "<p style='margin: 5px 0; font-size: 13px;'><strong>Coordinates:</strong> " + c[0] + ", " + c[1] + "</p></div>"
+                                    ).addTo(layer);
+                                }
+                            });
+                        });
+                }
+                map.on('moveend', refresh);
+                layer.on('add', refresh);
+            })({{ this.get_name() }}, {{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, dataset_id, name='Locations'):
+        super().__init__(name=name, overlay=True)
+        self._name = 'ClusterLayer'
+        self.url = f"{request.host_url}clusters?dataset={dataset_id}"
+
+def benchmark_clusters(points=1000000):
+    """Index build time and viewport query cost for a large synthetic point set"""
+    rng = np.random.default_rng(0)
+    centres = rng.uniform([-50, -120], [60, 140], (50, 2))
+    coords = centres[rng.integers(0, 50, points)] + rng.normal(0, 1.5, (points, 2))
+    started = time.perf_counter()
+    index = ClusterIndex(coords)
+    print(f"⏱️ build: {time.perf_counter() - started:.2f}s for {points} points, {index.nbytes / 1024 / 1024:.1f}MB")
+    for zoom in (2, 6, 10, 14, index.max_zoom + 1):
+        lat, lon = coords[0]
+        # roughly a 1280x800 viewport centred on a dense area
+        half_lon = 1280 / 2 * 360 / (256 * 2 ** zoom)
+        half_lat = min(800 / 2 * 360 / (256 * 2 ** zoom), 80)
+        started = time.perf_counter()
+        clusters = index.query(lon - half_lon, max(lat - half_lat, -85), lon + half_lon, min(lat + half_lat, 85), zoom)
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"   zoom {zoom:>2}: {len(clusters):>6} markers, {len(json.dumps(clusters)) / 1024:7.1f}KB in {elapsed:.1f}ms")
+
+# === Heatmap Tiles ===
+TILE_SIZE = 256
+HEATMAP_GRADIENT = {0.0: '#4facfe', 0.5: '#f093fb', 1.0: '#f5576c'}
+HEATMAP_MAX_ZOOM = 22
+# heat is binned from the cluster level this many zooms deeper: 8px cells, finer than the blur can show
+HEATMAP_DETAIL_ZOOMS = 3
+
+heatmap_tiles = LRUByteCache(heatmap_cache_bytes)
+heatmap_flights = SingleFlight()
+
+def heatmap_palette():
+    stops = sorted(HEATMAP_GRADIENT)
+    colors = np.array([[int(HEATMAP_GRADIENT[s][i:i + 2], 16) for i in (1, 3, 5)] for s in stops], dtype=np.float64)
+    levels = np.linspace(0.0, 1.0, 256)
+    return np.column_stack([np.interp(levels, stops, colors[:, c]) for c in range(3)]).astype(np.uint8)
+
+HEATMAP_PALETTE = heatmap_palette()
+
+def blur_matrix(size, margin, sigma):
+    """(size, size + 2 * margin) matrix applying a 1-D Gaussian with peak 1 and cropping the margin"""
+    offsets = np.arange(size + 2 * margin)[None, :] - (np.arange(size)[:, None] + margin)
+    return np.exp(-0.5 * (offsets / sigma) ** 2)
+
+def render_heatmap_tile(index, z, x, y, radius=None):
+    """PNG for heatmap tile z/x/y of a ClusterIndex.
+
+    Only the cells of one cluster level around the tile are binned, so the
+    cost is bounded by the tile size rather than the point count. The
+    density is blurred with two matrix products, scaled by the zoom's peak
+    and colored with the same gradient as folium's HeatMap.
+    """
+    radius = radius or heatmap_radius
+    sigma = radius / 2
+    margin = int(math.ceil(3 * sigma))
+    width = TILE_SIZE + 2 * margin
+    world = TILE_SIZE * 2 ** z
+
+    level = min(z + HEATMAP_DETAIL_ZOOMS, index.max_zoom + 1)
+    cell = world / (1 << (level + CLUSTER_CELL_BITS))
+    left, top = x * TILE_SIZE - margin, y * TILE_SIZE - margin
+    hits = index.select(
+        level,
+        int(top // cell), int((top + width) // cell),
+        int(left // cell), int((left + width) // cell)
+    )
+    if not len(hits):
+        return None
+    _, lat, lon, count = index.levels[level]
+    px, py = mercator_xy(lat[hits], lon[hits])
+    # nearest copy of each point around the antimeridian
+    px = (px * world - left - width / 2 + world / 2) % world - world / 2 + width / 2
+    py = py * world - top
+    inside = (px >= 0) & (px < width) & (py >= 0) & (py < width)
+    if not inside.any():
+        return None
+    cells = py[inside].astype(np.int64) * width + px[inside].astype(np.int64)
+    grid = np.bincount(cells, weights=count[hits][inside], minlength=width * width).reshape(width, width)
+
+    blur = blur_matrix(TILE_SIZE, margin, sigma)
+    density = blur @ grid @ blur.T
+    # scaled by the fullest 16px cell of the zoom, so each zoom's hottest spot is red
+    heat = np.clip(density / index.peaks[min(z + 2, index.max_zoom + 1)], 0.0, 1.0)
+    # min_opacity keeps a lone point visible next to a dense cluster, fading out with its kernel
+    alpha = heat + heatmap_min_opacity * np.minimum(density, 1.0) * (1.0 - heat)
+    rgba = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    rgba[..., :3] = HEATMAP_PALETTE[(alpha * 255).astype(np.uint8)]
+    rgba[..., 3] = (alpha * 255).astype(np.uint8)
+    return encode_png(Image.fromarray(rgba, 'RGBA'))
+
+EMPTY_HEATMAP_TILE = (encode_png(Image.new('RGBA', (TILE_SIZE, TILE_SIZE))), 'empty')
+
+def load_heatmap_tile(dataset_id, z, x, y):
+    """(data, etag) for a heatmap tile, None for an unknown dataset; cached per dataset and zoom"""
+    key = (dataset_id, z, x, y)
+    tile = heatmap_tiles.get(key)
+    if tile is not None:
+        return tile
+    index = cluster_indexes.get(dataset_id)
+    if index is None:
+        return None
+
+    def render():
+        data = render_heatmap_tile(index, z, x, y)
+        if data is None:
+            # most of the world is empty; those tiles share one transparent PNG
+            heatmap_tiles.put(key, EMPTY_HEATMAP_TILE, 64)
+            return EMPTY_HEATMAP_TILE
+        tile = (data, hashlib.md5(data).hexdigest())
+        heatmap_tiles.put(key, tile, len(data))
+        return tile
+
+    return heatmap_flights.run(key, render)
+
+def add_heatmap_layer(m, dataset_id):
+    folium.raster_layers.TileLayer(
+        tiles=f"{request.host_url}heatmap/{dataset_id}/{{z}}/{{x}}/{{y}}.png",
+        attr='Heatmap',
+        name='Heatmap',
+        overlay=True,
+        control=True,
+        max_zoom=HEATMAP_MAX_ZOOM
+    ).add_to(m)
+
+def benchmark_heatmap(points=1000000):
+    """Render cost of heatmap tiles for a large synthetic point set"""
+    rng = np.random.default_rng(0)
+    coords = np.column_stack([rng.normal(36.75, 1.5, points), rng.normal(3.06, 1.5, points)])
+    started = time.perf_counter()
+    index = ClusterIndex(coords)
+    print(f"⏱️ index: {time.perf_counter() - started:.2f}s for {points} points")
+    for zoom in (4, 8, 12, 16):
+        x, y = lat_lon_to_tile(36.75, 3.06, zoom)
+        started = time.perf_counter()
+        sizes = [len(render_heatmap_tile(index, zoom, x + dx, y + dy) or b'') for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        elapsed = (time.perf_counter() - started) * 1000 / 9
+        print(f"   zoom {zoom:>2}: {elapsed:6.1f}ms per tile, {sum(sizes) / 9 / 1024:5.1f}KB average PNG")
+    html = folium.Map(location=[36.75, 3.06]).add_child(HeatMap(coords[:100000].tolist())).get_root().render()
+    print(f"   folium HeatMap embeds {len(html) / 1024 / 1024:.1f}MB of HTML per 100k points; tiles embed none")
+
 html_form = """
 <!DOCTYPE html>
 <html lang="en">
@@ -838,12 +4260,138 @@ def test_location():
     </html>
     """
 
+# deeper than any tile source; checked before 2 ** z so a huge z cannot make each request build a huge integer
+MAX_TILE_ZOOM = 30
+
+TILE_MIMETYPES = {'webp': 'image/webp', 'png8': 'image/png', 'png': 'image/png'}
+
+@app.route("/tiles/<int:z>/<int:x>/<int:y>.png")
+def serve_tile(z, x, y):
+    """Serve one offline tile with a strong ETag and 304 revalidation.
+    
+    Directory tiles are tagged by size and mtime whether they come from the
+    tile cache or from disk, and cache misses are streamed with send_file
+    (sendfile under servers that provide wsgi.file_wrapper). Recompressed
+    files older than their PNG are passed over. MBTiles and synthesized
+    tiles are tagged by their content hash.
+    """
+    if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    # match the literal type: old Safari sends image/* but cannot decode WebP
+    accepts_webp = 'image/webp' in request.headers.get('Accept', '')
+    encodings = ('webp', 'png8', 'png') if accepts_webp else ('png8', 'png')
+    
+    if not isinstance(tile_store, DirectoryTileStore) or not tile_index.contains(z, x, y):
+        for encoding in encodings:
+            tile = load_tile(z, x, y, encoding)
+            if tile is not None:
+                return tile_response(*tile, mimetype=TILE_MIMETYPES[encoding])
+        abort(404)
+    
+    for encoding in encodings:
+        path = tile_store.path(z, x, y, encoding)
+        if encoding == 'png':
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+        else:
+            # a .webp/.png8 older than its PNG predates a tile update: the PNG is served until recompress_tiles redoes it
+            current = recompressed_stats(tile_store.path(z, x, y), path)
+            if current is None:
+                continue
+            st = current[1]
+        etag = tile_etag(st)
+        tile = tile_cache.get((z, x, y) if encoding == 'png' else (z, x, y, encoding))
+        if tile is not None and tile[1] == etag:
+            return tile_response(*tile, mimetype=TILE_MIMETYPES[encoding])
+        
+        response = send_file(
+            path,
+            mimetype=TILE_MIMETYPES[encoding],
+            conditional=True,
+            etag=etag,
+            last_modified=st.st_mtime,
+            max_age=tile_max_age
+        )
+        response.cache_control.public = True
+        response.vary.add('Accept')
+        return response
+    abort(404)
+
+def immutable_response(data, etag, mimetype):
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    # the saved map is opened from file://, so its fetch() calls are cross-origin
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response.make_conditional(request)
+
+@app.route("/photos/<thumbnail_id>")
+def photo_thumbnail(thumbnail_id):
+    entry = photo_cache.get(('thumbnail', thumbnail_id))
+    if entry is None:
+        abort(404)
+    data, mimetype = entry
+    return immutable_response(data, thumbnail_id, mimetype)
+
+@app.route("/popups/<popup_id>")
+def photo_popup(popup_id):
+    body = photo_cache.get(('popup', popup_id))
+    if body is None:
+        abort(404)
+    return immutable_response(body, popup_id, 'text/html')
+
+@app.route("/clusters")
+def clusters():
+    """Clusters and single points of a published dataset inside bbox=west,south,east,north at zoom z"""
+    dataset_id = request.args.get('dataset', '')
+    index = cluster_indexes.get(dataset_id)
+    if index is None:
+        abort(404)
+    try:
+        west, south, east, north = (float(v) for v in request.args.get('bbox', '').split(','))
+        zoom = int(request.args.get('z', ''))
+    except ValueError:
+        abort(400)
+    body = json.dumps({'zoom': zoom, 'clusters': index.query(west, south, east, north, zoom)}, separators=(',', ':'))
+    return immutable_response(body, hashlib.sha1(request.query_string).hexdigest()[:20], 'application/json')
+
+@app.route("/heatmap/<dataset_id>/<int:z>/<int:x>/<int:y>.png")
+def heatmap_tile(dataset_id, z, x, y):
+    """Serve one heatmap tile of a published dataset"""
+    if z > HEATMAP_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    tile = load_heatmap_tile(dataset_id, z, x, y)
+    if tile is None:
+        abort(404)
+    return tile_response(*tile)
+
+@app.route("/stats")
+def stats():
+    """Runtime counters for sizing caches on the tile host"""
+    return jsonify({
+        'tile_cache': tile_cache.stats(),
+        'tile_index': tile_index.stats(),
+        'tile_prefetch': tile_prefetcher.stats(),
+        'geocode_cache': geocode_cache.stats(),
+        'gazetteer': gazetteer.stats() if gazetteer else None,
+        'connectivity': connectivity.stats(),
+        'roads': road_network.stats() if road_network else None,
+        'photo_cache': photo_cache.stats(),
+        'cluster_indexes': cluster_indexes.stats(),
+        'heatmap_tiles': heatmap_tiles.stats()
+    })
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         mode = request.form.get("mode")
         coords = []
         distances = []
+        dataset_id = cluster_index = None
         
         is_online = check_internet_connection()
         use_cluster = request.form.get("cluster") == "1"
@@ -855,38 +4403,35 @@ def index():
             lats = request.form.getlist("lat")
             lons = request.form.getlist("lon")
             coords = [(float(lat), float(lon)) for lat, lon in zip(lats, lons) if lat and lon]
+            if len(coords) > cluster_threshold:
+                dataset_id, cluster_index = publish_clusters(coords)
 
-            if zoom_levels:
+            if tile_index.zoom_levels():
+                location, zoom_start = clamp_to_tiles([28.0, 3.0], 5)
                 m = folium.Map(
-                    location=[28.0, 3.0],
-                    zoom_start=5,
+                    location=location,
+                    zoom_start=zoom_start,
                     tiles=None,
-                    min_zoom=min(map(int, zoom_levels)),
-                    max_zoom=max(map(int, zoom_levels)),
-                    max_bounds=True
+                    **offline_map_options()
                 )
-                folium.raster_layers.TileLayer(
-                    tiles=f'file:///{tile_folder}/{{z}}/{{x}}/{{y}}.png',
-                    attr='Offline Tiles',
-                    name='Offline Map',
-                    overlay=False,
-                    control=False,
-                    min_zoom=min(map(int, zoom_levels)),
-                    max_zoom=max(map(int, zoom_levels))
-                ).add_to(m)
+                add_offline_tile_layer(m)
+                prefetch_points = coords
+                if cluster_index:
+                    # the clusters at zoom_start cover the same tiles as a million points, at a fraction of the cost
+                    prefetch_points = [c[:2] for c in cluster_index.query(-180, -90, 180, 90, zoom_start)]
+                tile_prefetcher.prefetch([location] + prefetch_points, zoom_start)
             else:
                 m = folium.Map(location=[28.0, 3.0], zoom_start=5)
 
         elif mode == "online":
             places = request.form.getlist("place")
-            geolocator = Nominatim(user_agent="smart_map_ui")
             user_location_data = get_user_location()
             
-            for place in places:
-                if place.strip():
-                    location = geolocator.geocode(place)
-                    if location:
-                        coords.append((location.latitude, location.longitude))
+            for place, location, error in geocode_places(places):
+                if location:
+                    coords.append(location)
+                elif not error:
+                    print(f"⚠️ Place not found: {place}")
             
             if user_location_data and coords:
                 user_location = (user_location_data[0], user_location_data[1])
@@ -899,7 +4444,7 @@ def index():
                     popup=f"""
                     <div style='font-family: Inter, sans-serif; width: 200px;'>
                         <h4 style='margin: 0 0 10px 0; color: #667eea;'>📍 Your Location</h4>
-                        <p style='margin: 5px 0; font-size: 13px;'><strong>{location_name}</strong></p>
+                        <p style='margin: 5px 0; font-size: 13px;'><strong>{escape(location_name)}</strong></p>
                     </div>
                     """,
                     icon=folium.Icon(color='red', icon='home', prefix='fa')
@@ -911,10 +4456,10 @@ def index():
                 else:
                     map_obj = m
                 
-                for idx, (lat, lon) in enumerate(coords):
-                    distance = geodesic(user_location, (lat, lon)).kilometers
-                    distances.append(distance)
-                    
+                # every distance in one vectorized call instead of one geodesic per marker
+                distances = distances_from(user_location, coords)
+                routes = route_many(user_location, coords)
+                for idx, ((lat, lon), distance, route) in enumerate(zip(coords, distances, routes)):
                     folium.Marker(
                         location=[lat, lon],
                         popup=f"""
@@ -922,26 +4467,26 @@ def index():
                             <h4 style='margin: 0 0 10px 0; color: #667eea;'>📍 Location #{idx+1}</h4>
                             <p style='margin: 5px 0; font-size: 13px;'><strong>Coordinates:</strong> {lat:.4f}, {lon:.4f}</p>
                             <p style='margin: 5px 0; font-size: 13px;'><strong>🚗 Distance:</strong> {distance:.2f} km</p>
-                            <p style='margin: 5px 0; font-size: 13px;'><strong>⏱️ Est. Drive:</strong> {int(distance / 60 * 60)} min</p>
+                            <p style='margin: 5px 0; font-size: 13px;'><strong>⏱️ Drive:</strong> {describe_drive(distance, route)}</p>
                         </div>
                         """,
                         icon=folium.Icon(color='blue', icon='info-sign')
                     ).add_to(map_obj)
                     
-                    folium.PolyLine(
-                        locations=[user_location, [lat, lon]],
+                    add_line(
+                        m,
+                        route[2] if route else [user_location, [lat, lon]],
                         color='#667eea',
                         weight=3,
                         opacity=0.7,
                         popup=f"Distance: {distance:.2f} km"
-                    ).add_to(m)
+                    )
             else:
                 m = folium.Map(location=[28.0, 3.0], zoom_start=5)
 
         elif mode == "image":
             if 'images' in request.files:
                 image_files = request.files.getlist('images')
-                images_data = []
                 user_location_data = get_user_location()
                 user_location = None
                 location_name = "Unknown Location"
@@ -950,34 +4495,18 @@ def index():
                     user_location = (user_location_data[0], user_location_data[1])
                     location_name = user_location_data[2]
                 
-                for idx, image_file in enumerate(image_files):
-                    if image_file.filename != '':
-                        import tempfile
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-                            image_file.save(tmp_file.name)
-                            gps_data = get_gps_from_image(tmp_file.name)
-                        try:
-                            os.remove(tmp_file.name)
-                        except:
-                            pass
-                        
-                        if gps_data:
-                            images_data.append({
-                                'filename': image_file.filename,
-                                'coords': gps_data['coords'],
-                                'metadata': gps_data['metadata'],
-                                'address': gps_data['address'],
-                                'image_data': gps_data.get('image_data')
-                            })
-                            coords.append(gps_data['coords'])
-                        else:
-                            images_data.append({
-                                'filename': image_file.filename,
-                                'coords': None,
-                                'metadata': None,
-                                'address': None,
-                                'image_data': None
-                            })
+                images_data = process_images([
+                    (image_file.filename, image_file.stream if stream_uploads else image_file.read())
+                    for image_file in image_files if image_file.filename != ''
+                ])
+                coords = [img['coords'] for img in images_data if img['coords']]
+                
+                if user_location and coords:
+                    distances = distances_from(user_location, coords)
+                    routes = route_many(user_location, coords)
+                    for img, distance, route in zip((img for img in images_data if img['coords']), distances, routes):
+                        img['distance'] = distance
+                        img['route'] = route
                 
                 if coords:
                     center_lat = sum(c[0] for c in coords) / len(coords)
@@ -985,17 +4514,10 @@ def index():
                     
                     if is_online:
                         m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
-                    elif zoom_levels:
+                    elif tile_index.zoom_levels():
                         m = folium.Map(location=[center_lat, center_lon], zoom_start=12, tiles=None)
-                        folium.raster_layers.TileLayer(
-                            tiles=f'file:///{tile_folder}/{{z}}/{{x}}/{{y}}.png',
-                            attr='Offline Tiles',
-                            name='Offline Map',
-                            overlay=False,
-                            control=False,
-                            min_zoom=min(map(int, zoom_levels)),
-                            max_zoom=max(map(int, zoom_levels))
-                        ).add_to(m)
+                        add_offline_tile_layer(m)
+                        tile_prefetcher.prefetch([(center_lat, center_lon)] + coords, 12)
                     else:
                         m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
                     
@@ -1005,24 +4527,29 @@ def index():
                             popup=f"""
                             <div style='font-family: Inter, sans-serif; width: 200px;'>
                                 <h4 style='margin: 0 0 10px 0; color: #667eea;'>📍 Your Location</h4>
-                                <p style='margin: 5px 0; font-size: 13px;'><strong>{location_name}</strong></p>
+                                <p style='margin: 5px 0; font-size: 13px;'><strong>{escape(location_name)}</strong></p>
                             </div>
                             """,
                             icon=folium.Icon(color='red', icon='home', prefix='fa')
                         ).add_to(m)
                     
+                    LazyPopups().add_to(m)
+                    
                     if use_cluster:
                         marker_cluster = MarkerCluster(name='Photos').add_to(m)
                         map_obj = marker_cluster
                     else:
                         map_obj = m
                     
+                    # EXIF fields, file names and addresses are untrusted: every one is escaped before it
+                    # reaches popup HTML, which /popups serves from this server's own origin
                     for idx, img_data in enumerate(images_data):
                         if img_data['coords']:
                             lat, lon = img_data['coords']
                             metadata = img_data['metadata']
                             address = img_data['address']
                             image_data = img_data.get('image_data')
+                            thumbnail_url = publish_thumbnail(base64.b64decode(image_data), img_data['image_mimetype']) if image_data else None
                             
                             popup_html = f"""
                             <div style='font-family: Inter, sans-serif; width: 300px; max-height: 500px; overflow-y: auto;'>
@@ -1031,37 +4558,38 @@ def index():
                             if image_data:
                                 popup_html += f"""
                                 <div style='margin-bottom: 12px; text-align: center;'>
-                                    <img src='data:image/jpeg;base64,{image_data}' 
+                                    <img src='{thumbnail_url}' 
                                          style='max-width: 100%; border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.2);'>
                                 </div>
                                 """
                             
                             popup_html += f"""
                                 <h4 style='margin: 0 0 12px 0; color: #00f2fe; border-bottom: 2px solid #00f2fe; padding-bottom: 8px;'>
-                                    📷 {img_data['filename']}
+                                    📷 {escape(img_data['filename'])}
                                 </h4>
                                 <div style='background: rgba(79,172,254,0.1); padding: 10px; border-radius: 8px; margin-bottom: 10px;'>
                                     <p style='margin: 5px 0; font-size: 12px;'><strong>📍 Coordinates:</strong> {lat:.6f}, {lon:.6f}</p>
                             """
                             
                             if address:
-                                popup_html += f"<p style='margin: 5px 0; font-size: 12px;'><strong>🌍 Location:</strong> {address[:100]}...</p>"
+                                popup_html += f"<p style='margin: 5px 0; font-size: 12px;'><strong>🌍 Location:</strong> {escape(address[:100])}...</p>"
                             
                             if user_location:
-                                distance = geodesic(user_location, (lat, lon)).kilometers
-                                distances.append(distance)
+                                distance = img_data['distance']
+                                route = img_data['route']
                                 popup_html += f"""
                                 <p style='margin: 5px 0; font-size: 12px;'><strong>🚗 Distance from you:</strong> {distance:.2f} km</p>
-                                <p style='margin: 5px 0; font-size: 12px;'><strong>⏱️ Est. Drive:</strong> {int(distance / 60 * 60)} min</p>
+                                <p style='margin: 5px 0; font-size: 12px;'><strong>⏱️ Drive:</strong> {describe_drive(distance, route)}</p>
                                 """
                                 
-                                folium.PolyLine(
-                                    locations=[user_location, [lat, lon]],
+                                add_line(
+                                    m,
+                                    route[2] if route else [user_location, [lat, lon]],
                                     color='#00f2fe',
                                     weight=3,
                                     opacity=0.6,
                                     popup=f"Distance: {distance:.2f} km"
-                                ).add_to(m)
+                                )
                             
                             popup_html += "</div>"
                             
@@ -1071,22 +4599,27 @@ def index():
                                     <h5 style='margin: 0 0 8px 0; color: #667eea;'>📸 Camera Info</h5>
                                 """
                                 if metadata.get('make') != 'Unknown' and metadata.get('camera') != 'Unknown':
-                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Camera:</strong> {metadata['make']} {metadata['camera']}</p>"
+                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Camera:</strong> {escape(str(metadata['make']))} {escape(str(metadata['camera']))}</p>"
                                 if metadata.get('datetime') != 'Unknown':
-                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Date:</strong> {metadata['datetime']}</p>"
+                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Date:</strong> {escape(str(metadata['datetime']))}</p>"
                                 if metadata.get('width') != 'Unknown' and metadata.get('height') != 'Unknown':
-                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Resolution:</strong> {metadata['width']} x {metadata['height']}</p>"
+                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Resolution:</strong> {escape(str(metadata['width']))} x {escape(str(metadata['height']))}</p>"
                                 if metadata.get('altitude') != 'Unknown':
-                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Altitude:</strong> {metadata['altitude']}</p>"
+                                    popup_html += f"<p style='margin: 3px 0; font-size: 11px;'><strong>Altitude:</strong> {escape(str(metadata['altitude']))}</p>"
                                 popup_html += "</div>"
                             
                             popup_html += "</div>"
+                            # only a placeholder goes into the map; LazyPopups fetches the body when it opens
+                            lazy_popup = folium.Popup(
+                                f"<div class='lazy-popup' data-src='{publish_popup(popup_html)}' style='font-family: Inter, sans-serif; width: 300px; font-size: 12px;'>⏳ Loading {escape(img_data['filename'])}...</div>",
+                                max_width=320
+                            )
                             
                             if image_data:
                                 icon_html = f"""
                                 <div style='position: relative;'>
-                                    <div style='width: 60px; height: 60px; border-radius: 50%; overflow: hidden; border: 3px solid #00f2fe; box-shadow: 0 4px 12px rgba(0,242,254,0.5); background: white;'>
-                                        <img src='data:image/jpeg;base64,{image_data}' style='width: 100%; height: 100%; object-fit: cover;'>
+                                    <div style='width: 60px; height: 60px; border-radius: 50%; overflow: hidden; border: 3px solid #00f2fe; box-shadow: 0 4px 12px rgba(0,242,254,0.5); background: linear-gradient(135deg, #4facfe, #00f2fe);'>
+                                        <img src='{thumbnail_url}' loading='lazy' style='width: 100%; height: 100%; object-fit: cover;'>
                                     </div>
                                     <div style='position: absolute; bottom: -5px; right: -5px; background: #00f2fe; border-radius: 50%; width: 20px; height: 20px; display: flex; align-items: center; justify-content: center; box-shadow: 0 2px 8px rgba(0,0,0,0.3);'>
                                         <i class='fa fa-camera' style='color: white; font-size: 10px;'></i>
@@ -1096,13 +4629,13 @@ def index():
                                 custom_icon = folium.DivIcon(html=icon_html)
                                 folium.Marker(
                                     location=[lat, lon],
-                                    popup=folium.Popup(popup_html, max_width=320),
+                                    popup=lazy_popup,
                                     icon=custom_icon
                                 ).add_to(map_obj)
                             else:
                                 folium.Marker(
                                     location=[lat, lon],
-                                    popup=folium.Popup(popup_html, max_width=320),
+                                    popup=lazy_popup,
                                     icon=folium.Icon(color='green', icon='camera', prefix='fa')
                                 ).add_to(map_obj)
                 else:
@@ -1140,7 +4673,9 @@ def index():
             </html>
             """
 
-        if mode == "offline":
+        if mode == "offline" and dataset_id:
+            ClusterLayer(dataset_id).add_to(m)
+        elif mode == "offline":
             for lat, lon in coords:
                 folium.Marker(
                     location=[lat, lon], 
@@ -1153,9 +4688,8 @@ def index():
                 ).add_to(m)
 
         if use_heatmap and coords:
-            HeatMap(coords, name='Heatmap', min_opacity=0.3, radius=25, blur=35, gradient={
-                0.0: '#4facfe', 0.5: '#f093fb', 1.0: '#f5576c'
-            }).add_to(m)
+            # the server bins and colors the points per tile, so the page stays small however many there are
+            add_heatmap_layer(m, dataset_id or publish_clusters(coords)[0])
         
         if use_measure:
             MeasureControl(position='topleft', primary_length_unit='kilometers').add_to(m)
@@ -1168,8 +4702,9 @@ def index():
         map_file = "map_result.html"
         m.save(map_file)
         
-        total_distance = sum(distances) if distances else 0
-        avg_distance = total_distance / len(distances) if distances else 0
+        summary = distance_summary(distances)
+        total_distance = summary['total']
+        avg_distance = summary['mean']
         
         webbrowser.open_new_tab('file://' + os.path.realpath(map_file))
         
@@ -1210,8 +4745,40 @@ def index():
 
     return render_template_string(html_form)
 
-if __name__ == "__main__":
-    import threading
+services_lock = threading.Lock()
+services_open = False
+
+def open_services():
+    """Open the tile store, geocoding databases and road network, once.
+    
+    This is kept out of import: process-pool workers (recompress-tiles,
+    ingest-photos) re-import this module under spawn and must not repeat it.
+    """
+    global tile_store, tile_index, geocode_cache, gazetteer, reverse_geocoder, road_network, services_open
+    with services_lock:
+        if services_open:
+            return
+        tile_store = open_tile_store()
+        tile_index = open_tile_index(tile_store)
+        geocode_cache = GeocodeCache(geocode_cache_path, geocode_cache_entries, geocode_cache_ttl, geocode_negative_ttl)
+        gazetteer = open_gazetteer()
+        reverse_geocoder = open_reverse_geocoder()
+        road_network = open_road_network()
+        services_open = True
+
+@app.before_request
+def ensure_services():
+    # also covers serving app from a WSGI server, where run_server() never runs
+    open_services()
+
+def run_server():
+    open_services()
+    if tile_index_refresh > 0:
+        tile_index.start_watcher(tile_index_refresh)
+    connectivity.check()
+    connectivity.start()
+    # detect the server location before the first request needs it
+    threading.Thread(target=get_user_location, name='ip-location-warmup', daemon=True).start()
     
     def open_browser():
         webbrowser.open('http://127.0.0.1:5000')
@@ -1220,4 +4787,101 @@ if __name__ == "__main__":
     
     print("🚀 Starting Smart Map Viewer Pro...")
     print("🌐 Opening browser at http://127.0.0.1:5000")
-    app.run(port=5000, debug=False, use_reloader=False) 
\ No newline at end of file
+    app.run(port=5000, debug=False, use_reloader=False)
+
+def main(argv=None):
+    import argparse
+    
+    # a frozen build's spawned workers must run their task, not start another server
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Smart Map Viewer Pro")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="run the web app (default)")
+    
+    importer = commands.add_parser('import-mbtiles', help="pack the tiles/ tree into an MBTiles file")
+    importer.add_argument('--source', default=tile_folder)
+    importer.add_argument('--dest', default=mbtiles_path)
+    importer.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    importer.add_argument('--dedup', action='store_true', help="store each distinct tile image once (content-addressed)")
+    
+    report = commands.add_parser('dedup-report', help="report how many tiles in the tiles/ tree are byte-identical")
+    report.add_argument('--source', default=tile_folder)
+    report.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    
+    bench = commands.add_parser('bench-tiles', help="compare tile lookups on the directory tree and the MBTiles file")
+    bench.add_argument('--source', default=tile_folder)
+    bench.add_argument('--packed', default=mbtiles_path)
+    bench.add_argument('--samples', type=int, default=2000)
+    
+    recompress = commands.add_parser('recompress-tiles', help="recompress the tiles/ tree to WebP or palette PNG")
+    recompress.add_argument('--source', default=tile_folder)
+    recompress.add_argument('--format', choices=['webp', 'png8'], default='webp')
+    recompress.add_argument('--quality', type=int, default=80, help="WebP quality (100 = lossless) or PNG palette size as a percentage of 256 colours")
+    recompress.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    
+    gazetteer_build = commands.add_parser('build-gazetteer', help="build the offline geocoder index from a GeoNames TSV dump")
+    gazetteer_build.add_argument('source', help="GeoNames dump such as cities500.txt or allCountries.txt")
+    gazetteer_build.add_argument('--countries', help="countryInfo.txt, for country names as qualifiers")
+    gazetteer_build.add_argument('--admin1', help="admin1CodesASCII.txt, for region names as qualifiers")
+    gazetteer_build.add_argument('--dest', default=gazetteer_path)
+    
+    exif_bench = commands.add_parser('bench-exif', help="compare the EXIF header parser with the Pillow path")
+    exif_bench.add_argument('--count', type=int, default=200)
+    
+    ingest = commands.add_parser('ingest-photos', help="index the GPS positions of a photo library")
+    ingest.add_argument('source', help="directory tree of photos")
+    ingest.add_argument('--dest', default=os.path.join(base_path, 'photo_library.sqlite'))
+    ingest.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    
+    roads = commands.add_parser('import-roads', help="build the offline routing graph from an OSM XML extract")
+    roads.add_argument('source', help=".osm, .osm.gz or .osm.bz2 extract")
+    roads.add_argument('--dest', default=roads_path)
+    roads.add_argument('--landmarks', type=int, default=8)
+    
+    cluster_bench = commands.add_parser('bench-clusters', help="time the clustering index on a large synthetic point set")
+    cluster_bench.add_argument('--points', type=int, default=1000000)
+    
+    heatmap_bench = commands.add_parser('bench-heatmap', help="time heatmap tile rendering on a large synthetic point set")
+    heatmap_bench.add_argument('--points', type=int, default=1000000)
+    
+    line_bench = commands.add_parser('bench-lines', help="compare map size for a long route drawn plain and encoded")
+    line_bench.add_argument('--vertices', type=int, default=20000)
+    
+    distance_bench = commands.add_parser('bench-distances', help="time batch distance computation")
+    distance_bench.add_argument('--count', type=int, default=100000)
+    
+    thumb_bench = commands.add_parser('bench-thumbnails', help="time thumbnail generation on large synthetic JPEGs")
+    thumb_bench.add_argument('--count', type=int, default=10)
+    
+    args = parser.parse_args(argv)
+    if args.command == 'import-mbtiles':
+        import_tiles_to_mbtiles(args.source, args.dest, workers=args.workers, dedup=args.dedup)
+    elif args.command == 'dedup-report':
+        dedup_report(args.source, workers=args.workers)
+    elif args.command == 'recompress-tiles':
+        recompress_tiles(args.source, args.format, args.quality, args.workers)
+    elif args.command == 'build-gazetteer':
+        build_gazetteer(args.source, args.dest, countries_file=args.countries, admin1_file=args.admin1)
+    elif args.command == 'bench-exif':
+        benchmark_exif(count=args.count)
+    elif args.command == 'ingest-photos':
+        ingest_photos(args.source, args.dest, args.workers)
+    elif args.command == 'import-roads':
+        import_roads(args.source, args.dest, args.landmarks)
+    elif args.command == 'bench-clusters':
+        benchmark_clusters(points=args.points)
+    elif args.command == 'bench-heatmap':
+        benchmark_heatmap(points=args.points)
+    elif args.command == 'bench-lines':
+        benchmark_lines(vertices=args.vertices)
+    elif args.command == 'bench-distances':
+        benchmark_distances(count=args.count)
+    elif args.command == 'bench-thumbnails':
+        benchmark_thumbnails(count=args.count)
+    elif args.command == 'bench-tiles':
+        benchmark_tile_stores(args.source, args.packed, samples=args.samples)
+    else:
+        run_server()
+
+if __name__ == "__main__":
+    main()
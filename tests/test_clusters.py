@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+PARIS, TOKYO, NEW_YORK = (48.8566, 2.3522), (35.6762, 139.6503), (40.7128, -74.006)
+
+
+@pytest.fixture
+def dataset(monkeypatch):
+    rng = np.random.default_rng(0)
+    coords = np.concatenate([
+        np.array(PARIS) + rng.normal(0, 0.01, (100, 2)),
+        np.array(TOKYO) + rng.normal(0, 0.01, (50, 2)),
+        np.array([NEW_YORK])
+    ])
+    monkeypatch.setattr(map_app, 'services_open', True)
+    dataset_id, index = map_app.publish_clusters(coords.tolist())
+    return dataset_id, index, map_app.app.test_client()
+
+
+def get_clusters(client, dataset_id, bbox, z, **headers):
+    return client.get('/clusters', query_string={'dataset': dataset_id, 'bbox': ','.join(map(str, bbox)), 'z': z}, headers=headers)
+
+
+def test_clusters_cover_every_point_once_per_zoom(dataset):
+    dataset_id, index, client = dataset
+    for z in (0, 3, 8, index.max_zoom + 1):
+        response = get_clusters(client, dataset_id, (-180, -85, 180, 85), z)
+        assert response.status_code == 200 and response.mimetype == 'application/json'
+        body = json.loads(response.data)
+        assert body['zoom'] == z
+        assert sum(count for _lat, _lon, count in body['clusters']) == 151
+    # the deepest level holds the points themselves
+    assert len(json.loads(get_clusters(client, dataset_id, (-180, -85, 180, 85), index.max_zoom + 1).data)['clusters']) == 151
+    # at zoom 0 each city collapses into one cluster near its centre
+    clusters = json.loads(get_clusters(client, dataset_id, (-180, -85, 180, 85), 0).data)['clusters']
+    assert sorted(count for _lat, _lon, count in clusters) == [1, 50, 100]
+    paris = next(c for c in clusters if c[2] == 100)
+    assert paris[0] == pytest.approx(PARIS[0], abs=0.01) and paris[1] == pytest.approx(PARIS[1], abs=0.01)
+
+
+def test_clusters_only_return_the_viewport(dataset):
+    dataset_id, _index, client = dataset
+    clusters = json.loads(get_clusters(client, dataset_id, (1.5, 48.0, 3.5, 49.5), 10).data)['clusters']
+    assert sum(count for _lat, _lon, count in clusters) == 100
+    # a box across the antimeridian holding Tokyo
+    clusters = json.loads(get_clusters(client, dataset_id, (130, 30, 190, 40), 5).data)['clusters']
+    assert sum(count for _lat, _lon, count in clusters) == 50
+
+
+def test_cluster_responses_revalidate_and_reject_bad_requests(dataset):
+    dataset_id, _index, client = dataset
+    response = get_clusters(client, dataset_id, (-180, -85, 180, 85), 2)
+    assert get_clusters(client, dataset_id, (-180, -85, 180, 85), 2, **{'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert get_clusters(client, 'unknown', (-180, -85, 180, 85), 2).status_code == 404
+    assert client.get('/clusters', query_string={'dataset': dataset_id, 'bbox': '1,2,3', 'z': 2}).status_code == 400
+    assert client.get('/clusters', query_string={'dataset': dataset_id, 'bbox': '1,2,3,4', 'z': 'x'}).status_code == 400
+
+
+def test_heatmap_tiles(dataset):
+    dataset_id, _index, client = dataset
+    x, y = map_app.lat_lon_to_tile(*PARIS, 6)
+    response = client.get(f'/heatmap/{dataset_id}/6/{x}/{y}.png')
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    alpha = np.asarray(Image.open(BytesIO(response.data)).convert('RGBA'))[:, :, 3]
+    assert alpha.max() > 0
+    assert client.get(f'/heatmap/{dataset_id}/6/{x}/{y}.png', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    # empty ocean: the shared transparent tile
+    empty = client.get(f'/heatmap/{dataset_id}/6/0/63.png')
+    assert empty.status_code == 200 and empty.data == map_app.EMPTY_HEATMAP_TILE[0]
+    assert np.asarray(Image.open(BytesIO(empty.data)).convert('RGBA'))[:, :, 3].max() == 0
+
+    assert client.get('/heatmap/unknown/6/0/0.png').status_code == 404
+    assert client.get(f'/heatmap/{dataset_id}/6/64/0.png').status_code == 404
+    assert client.get(f'/heatmap/{dataset_id}/1000000/0/0.png').status_code == 404
@@ -0,0 +1,115 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+class Probe:
+    """Stands in for the network: answers from a script, then repeats the last answer"""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+
+
+def monitor_with(probe, interval=1.0, max_backoff=3.0):
+    monitor = map_app.ConnectivityMonitor([('192.0.2.1', 53)], interval, max_backoff, 0.1)
+    monitor.probe = probe
+    return monitor
+
+
+def test_listeners_see_each_transition_once(capsys):
+    monitor = monitor_with(Probe(True, False, False, True, True))
+    seen = []
+    monitor.subscribe(seen.append)
+    assert [monitor.check() for _ in range(5)] == [True, False, False, True, True]
+    assert seen == [True, False, True]
+
+    stats = monitor.stats()
+    assert stats['online'] is True
+    assert stats['probes'] == 5 and stats['failed_probes'] == 2
+    assert [t['online'] for t in stats['transitions']] == [True, False, True]
+    assert stats['last_change'] == stats['transitions'][-1]['time']
+    out = capsys.readouterr().out
+    assert out.count('No internet connection') == 1 and out.count('Internet connection detected') == 2
+
+
+def test_a_failing_listener_does_not_stop_the_others(capsys):
+    monitor = monitor_with(Probe(False))
+    seen = []
+
+    def broken(online):
+        raise RuntimeError('listener exploded')
+
+    monitor.subscribe(broken)
+    monitor.subscribe(seen.append)
+    assert monitor.check() is False
+    assert seen == [False]
+    assert 'Connectivity listener failed: listener exploded' in capsys.readouterr().out
+
+
+def test_the_watcher_backs_off_while_offline(monkeypatch):
+    # online -> offline -> online -> offline, the first answer for is_online and the rest for the thread
+    monitor = monitor_with(Probe(True, False, False, False, True, False))
+    seen = []
+    monitor.subscribe(seen.append)
+    delays, released, parked = [], threading.Event(), threading.Event()
+    real_sleep = time.sleep
+
+    def sleep(seconds):
+        if threading.current_thread().name != 'connectivity-monitor':
+            return real_sleep(seconds)
+        delays.append(seconds)
+        released.wait(5)
+        if len(delays) == 6:
+            parked.set()
+            threading.Event().wait()
+
+    monkeypatch.setattr(map_app.time, 'sleep', sleep)
+    assert monitor.is_online() is True
+    released.set()
+    assert parked.wait(5)
+    # doubling from the interval, capped at max_backoff, reset by the first good probe
+    assert delays == [1.0, 2.0, 3.0, 3.0, 1.0, 2.0]
+    assert seen == [True, False, True, False]
+    assert monitor.is_online() is False
+    # a second start does not add another watcher
+    monitor.start()
+    real_sleep(0.05)
+    assert len(delays) == 6
+
+
+def test_is_online_probes_only_once_until_the_watcher_runs(monkeypatch):
+    probe = Probe(False)
+    monitor = monitor_with(probe, interval=3600)
+    assert monitor.is_online() is False
+    assert monitor.is_online() is False
+    assert probe.calls == 1
+
+
+def test_probe_tries_each_target(monkeypatch):
+    tried = []
+
+    class Connection:
+        def close(self):
+            pass
+
+    def create_connection(address, timeout):
+        tried.append(address)
+        if address[0] != 'reachable':
+            raise OSError('unreachable')
+        return Connection()
+
+    monkeypatch.setattr(map_app.socket, 'create_connection', create_connection)
+    targets = map_app.parse_probe_targets('down:53, reachable:443, never:53, bad, :80')
+    assert targets == [('down', 53), ('reachable', 443), ('never', 53)]
+    assert map_app.ConnectivityMonitor(targets, 1, 1, 0.1).probe() is True
+    assert tried == [('down', 53), ('reachable', 443)]
+    assert map_app.ConnectivityMonitor([('down', 53)], 1, 1, 0.1).probe() is False
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from geopy.distance import geodesic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+ALGIERS = (36.75, 3.06)
+
+
+def random_points(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(-89, 89, count), rng.uniform(-180, 180, count)])
+
+
+def test_vincenty_matches_geopy():
+    points = np.vstack([random_points(500), [
+        ALGIERS, (0.0, 3.06), (0.0, 90.0), (90.0, 0.0), (-90.0, 0.0), (-36.75, 3.06), (-36.75, -176.94)
+    ]])
+    km = map_app.vincenty_km(ALGIERS[0], ALGIERS[1], points[:, 0], points[:, 1])
+    reference = np.array([geodesic(ALGIERS, tuple(p)).kilometers for p in points])
+    # well under a millimetre
+    assert np.abs(km - reference).max() < 1e-6
+    assert km[500] == 0.0
+
+
+def test_nearly_antipodal_pairs_fall_back_to_geopy(monkeypatch):
+    calls = []
+
+    def counted(*args):
+        calls.append(args)
+        return geodesic(*args)
+
+    monkeypatch.setattr(map_app, 'geodesic', counted)
+    lat2 = np.array([0.5, 10.0, 0.0])
+    lon2 = np.array([179.7, 20.0, 180.0])
+    km = map_app.vincenty_km(np.array([-0.5, 0.0, 0.0]), np.array([0.0, 0.0, 0.0]), lat2, lon2)
+    # Vincenty does not converge for the first and last pair; the ordinary pair never reaches geopy
+    assert [call[0] for call in calls] == [(-0.5, 0.0), (0.0, 0.0)]
+    assert km[0] == pytest.approx(geodesic((-0.5, 0.0), (0.5, 179.7)).kilometers, abs=1e-9)
+    assert km[2] == pytest.approx(geodesic((0.0, 0.0), (0.0, 180.0)).kilometers, abs=1e-9)
+    assert km[1] == pytest.approx(geodesic((0.0, 0.0), (10.0, 20.0)).kilometers, abs=1e-9)
+
+
+def test_distances_from_defaults_to_haversine(monkeypatch):
+    points = random_points(2000, seed=1)
+    reference = np.array([geodesic(ALGIERS, tuple(p)).kilometers for p in points])
+    monkeypatch.setattr(map_app, 'distance_method', 'haversine')
+    km = map_app.distances_from(ALGIERS, points.tolist())
+    assert km.shape == (2000,)
+    np.testing.assert_allclose(km, map_app.haversine_km(ALGIERS[0], ALGIERS[1], points[:, 0], points[:, 1]))
+    # within the 0.5% the README promises
+    assert (np.abs(km - reference) <= 0.005 * reference + 1e-9).all()
+    assert np.abs(map_app.distances_from(ALGIERS, points, method='ellipsoid') - reference).max() < 1e-6
+
+    monkeypatch.setattr(map_app, 'distance_method', 'ellipsoid')
+    assert np.abs(map_app.distances_from(ALGIERS, points) - reference).max() < 1e-6
+
+
+def test_distance_matrix_and_empty_inputs():
+    origins, points = random_points(3, seed=2), random_points(4, seed=3)
+    matrix = map_app.distance_matrix(origins, points, method='ellipsoid')
+    assert matrix.shape == (3, 4)
+    assert matrix[2, 1] == pytest.approx(geodesic(tuple(origins[2]), tuple(points[1])).kilometers, abs=1e-6)
+
+    assert map_app.distances_from(ALGIERS, []).shape == (0,)
+    assert map_app.distances_from(ALGIERS, [], method='ellipsoid').shape == (0,)
+    assert map_app.distance_matrix(origins, []).shape == (3, 0)
+
+
+def test_distance_summary():
+    summary = map_app.distance_summary([4.0, 1.0, 10.0, 5.0])
+    assert summary == {'count': 4, 'total': 20.0, 'mean': 5.0, 'median': 4.5, 'min': 1.0, 'max': 10.0}
+    assert map_app.distance_summary(np.array([])) == {'count': 0, 'total': 0.0, 'mean': 0.0, 'median': 0.0, 'min': 0.0, 'max': 0.0}
+    assert map_app.distance_summary([]) == map_app.distance_summary(np.array([]))
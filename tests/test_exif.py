@@ -0,0 +1,140 @@
+import contextlib
+import os
+import sys
+from io import BytesIO, StringIO
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def tagged_exif(gps=None, **ifd0):
+    exif = Image.Exif()
+    exif[0x010F] = ifd0.get('make', 'Canon')
+    exif[0x0110] = ifd0.get('model', 'EOS R5')
+    exif[0x0132] = '2024:05:01 10:00:00'
+    if gps is not None:
+        exif.get_ifd(0x8825).update(gps)
+    return exif
+
+
+def jpeg(exif):
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), 'gray').save(buffer, format='JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+def heic(exif):
+    pillow_heif = pytest.importorskip('pillow_heif')
+    pillow_heif.register_heif_opener()
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), 'gray').save(buffer, format='HEIF', exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def pillow_reference(data):
+    """(lat, lon, altitude) decoded with Pillow's own EXIF reader"""
+    gps = Image.open(BytesIO(data)).getexif().get_ifd(0x8825)
+
+    def decimal(dms, ref):
+        if not dms or ref not in ('N', 'S', 'E', 'W'):
+            return None
+        value = float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+        return -value if ref in ('S', 'W') else value
+
+    lat, lon = decimal(gps.get(2), gps.get(1)), decimal(gps.get(4), gps.get(3))
+    if lat is None or lon is None:
+        lat = lon = None
+    altitude = 'Unknown'
+    if 6 in gps:
+        below = gps.get(5) in (b'\x01', 1)
+        altitude = f"{-float(gps[6]) if below else float(gps[6]):.1f}m"
+    return lat, lon, altitude
+
+
+GPS_CASES = [
+    {1: 'N', 2: (35.0, 41.0, 22.2), 3: 'E', 4: (139.0, 41.0, 30.1), 5: b'\x00', 6: 40.5},
+    {1: 'S', 2: (33.0, 52.0, 4.5), 3: 'W', 4: (70.0, 40.0, 1.25), 5: b'\x01', 6: 12.5},
+    {1: 'N', 2: (0.0, 0.0, 0.0), 3: 'W', 4: (0.0, 0.0, 0.5)},
+    # no latitude ref: not a usable position, but the altitude is still read
+    {2: (10.0, 0.0, 0.0), 3: 'E', 4: (20.0, 0.0, 0.0), 6: 7.0},
+]
+
+
+@pytest.mark.parametrize('container', [jpeg, heic])
+@pytest.mark.parametrize('gps', GPS_CASES)
+def test_header_parser_matches_pillow(container, gps):
+    data = container(tagged_exif(gps))
+    record = map_app.read_photo_geo(data)
+    lat, lon, altitude = pillow_reference(data)
+
+    assert record.lat == pytest.approx(lat) if lat is not None else record.lat is None
+    assert record.lon == pytest.approx(lon) if lon is not None else record.lon is None
+    assert record.metadata['altitude'] == altitude
+    assert record.metadata['make'] == 'Canon' and record.metadata['camera'] == 'EOS R5'
+    assert record.metadata['datetime'] == '2024:05:01 10:00:00'
+
+
+@pytest.mark.parametrize('gps', GPS_CASES)
+def test_header_parser_matches_the_pillow_locator(gps):
+    data = jpeg(tagged_exif(gps))
+    record = map_app.read_photo_geo(BytesIO(data))
+    with contextlib.redirect_stdout(StringIO()):
+        locator = map_app.ExifGeoLocator(BytesIO(data), fast=False)
+    if locator.lat is None:
+        assert record.lat is None and record.lon is None
+    else:
+        assert (record.lat, record.lon) == pytest.approx((locator.lat, locator.lon))
+
+
+@pytest.mark.parametrize('container', [jpeg, heic])
+def test_photos_without_gps(container):
+    record = map_app.read_photo_geo(container(tagged_exif()))
+    assert record.lat is None and record.lon is None
+    assert record.metadata['altitude'] == 'Unknown' and record.metadata['camera'] == 'EOS R5'
+
+
+def test_jpeg_without_exif_and_unknown_containers():
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='JPEG')
+    record = map_app.read_photo_geo(buffer.getvalue())
+    assert record.lat is None and record.metadata == map_app.EMPTY_PHOTO_METADATA
+
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='PNG')
+    assert map_app.read_photo_geo(buffer.getvalue()) is None
+    # a truncated JPEG reads as having no GPS; streaming uploads tell the two apart via ByteSource.short_read
+    assert map_app.read_photo_geo(b'\xff\xd8\xff\xe1\x00').lat is None
+    assert map_app.read_photo_geo(b'') is None
+
+
+def test_the_header_parser_reads_paths_and_streams_in_place(tmp_path):
+    data = jpeg(tagged_exif(GPS_CASES[0]))
+    path = tmp_path / 'photo.jpg'
+    path.write_bytes(data)
+    assert map_app.read_photo_geo(str(path)).lat == pytest.approx(35.68950)
+
+    stream = BytesIO(b'prefix' + data)
+    stream.seek(6)
+    assert map_app.read_photo_geo(stream).lon == pytest.approx(139.69169)
+    # the caller's stream is left where it was
+    assert stream.tell() == 6
+
+
+@pytest.mark.parametrize('length', [0, 1])
+def test_segments_too_short_for_their_length_field(tmp_path, length):
+    data = jpeg(tagged_exif(GPS_CASES[0]))
+    # a bogus APP1 in front of the real one; length 1 used to read the rest of the file as one segment
+    corrupt = data[:2] + b'\xff\xe1' + length.to_bytes(2, 'big') + data[2:]
+    path = tmp_path / 'corrupt.jpg'
+    path.write_bytes(corrupt)
+    for source in (corrupt, str(path), BytesIO(corrupt)):
+        src = map_app.ByteSource(source)
+        try:
+            assert map_app.find_jpeg_exif(src) is None
+        finally:
+            src.close()
+        record = map_app.read_photo_geo(source)
+        assert record.lat is None and record.lon is None
@@ -0,0 +1,205 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def test_offline_mode_without_gazetteer_stays_offline(monkeypatch):
+    def network(*args, **kwargs):
+        raise AssertionError("offline mode went to the network")
+
+    monkeypatch.setattr(map_app, 'geocoder_mode', 'offline')
+    monkeypatch.setattr(map_app, 'gazetteer', None)
+    monkeypatch.setattr(map_app, 'reverse_geocoder', None)
+    monkeypatch.setattr(map_app, 'geocode_place', network)
+    monkeypatch.setattr(map_app, 'reverse_geocode_coords', network)
+    assert map_app.resolve_place('Tokyo, Japan') is None
+    assert map_app.reverse_geocode_many([(35.68, 139.69), (48.85, 2.35)]) == [None, None]
+
+
+@pytest.mark.parametrize('mode, online, cached_only', [
+    ('offline-first', False, True), ('offline-first', True, False),
+    ('online-first', False, True), ('online', False, False)
+])
+def test_without_gazetteer_only_the_cache_is_used_while_offline(monkeypatch, mode, online, cached_only):
+    calls = []
+    monkeypatch.setattr(map_app, 'geocoder_mode', mode)
+    monkeypatch.setattr(map_app, 'gazetteer', None)
+    monkeypatch.setattr(map_app, 'reverse_geocoder', None)
+    monkeypatch.setattr(map_app.connectivity, 'is_online', lambda: online)
+    monkeypatch.setattr(map_app, 'geocode_place', lambda place, cached_only=False: calls.append(cached_only) or (35.68, 139.69))
+    monkeypatch.setattr(map_app, 'reverse_geocode_coords', lambda lat, lon, cached_only=False: calls.append(cached_only) or 'Tokyo')
+    assert map_app.resolve_place('Tokyo, Japan') == (35.68, 139.69)
+    assert map_app.reverse_geocode_many([(35.68, 139.69), (48.85, 2.35)]) == ['Tokyo', 'Tokyo']
+    assert calls == [cached_only] * 3
+
+
+def geonames_row(place_id, name, lat, lon, country, admin1, population, alternates='', feature_class='P'):
+    fields = [str(place_id), name, name, alternates, str(lat), str(lon), feature_class, 'PPL', country, '', admin1,
+              '', '', '', str(population), '', '0', 'UTC', '2024-01-01']
+    return '\t'.join(fields) + '\n'
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    cities, countries, admin1 = tmp_path / 'cities.txt', tmp_path / 'countryInfo.txt', tmp_path / 'admin1.txt'
+    cities.write_text(''.join([
+        '# comment lines and short rows are skipped\n',
+        'not\ta\tplace\n',
+        geonames_row(1, 'Paris', 48.8534, 2.3488, 'FR', '11', 2138551, 'Lutetia,Parigi'),
+        geonames_row(2, 'Paris', 33.6609, -95.5555, 'US', 'TX', 24171),
+        geonames_row(3, 'Paris', 36.302, -88.3267, 'US', 'TN', 10156),
+        geonames_row(4, 'Saint-Étienne', 45.4339, 4.39, 'FR', '84', 171057),
+        geonames_row(5, 'Mont Blanc', 45.8326, 6.8652, 'FR', '84', 0, feature_class='T'),
+    ]), encoding='utf-8')
+    countries.write_text('#ISO\tISO3\tISO-Numeric\tfips\tCountry\n'
+                         'FR\tFRA\t250\tFR\tFrance\n'
+                         'US\tUSA\t840\tUS\tUnited States\n', encoding='utf-8')
+    admin1.write_text('FR.11\tÎle-de-France\tIle-de-France\t3012874\n'
+                      'FR.84\tAuvergne-Rhône-Alpes\tAuvergne-Rhone-Alpes\t11071625\n'
+                      'US.TX\tTexas\tTexas\t4736286\n'
+                      'US.TN\tTennessee\tTennessee\t4662168\n', encoding='utf-8')
+    dest = str(tmp_path / 'gazetteer.sqlite')
+    map_app.build_gazetteer(str(cities), dest, countries_file=str(countries), admin1_file=str(admin1))
+    return map_app.Gazetteer(dest)
+
+
+def test_gazetteer_lookup(gazetteer):
+    assert gazetteer.stats()['places'] == 5
+    # the most populous match wins unless a qualifier narrows it down
+    assert gazetteer.lookup('Paris') == (48.8534, 2.3488)
+    assert gazetteer.lookup('paris, texas') == (33.6609, -95.5555)
+    assert gazetteer.lookup('Paris, Tennessee, United States') == (36.302, -88.3267)
+    assert gazetteer.lookup('Paris, US') == (33.6609, -95.5555)
+    assert gazetteer.lookup('Paris, USA') == (33.6609, -95.5555)
+    assert gazetteer.lookup('Paris, Texas, France') is None
+    # alternate names, accents, case and punctuation
+    assert gazetteer.lookup('Lutetia') == (48.8534, 2.3488)
+    assert gazetteer.lookup('SAINT ETIENNE,  auvergne-rhone-alpes') == (45.4339, 4.39)
+    assert gazetteer.lookup('Atlantis') is None
+    assert gazetteer.lookup(' , ') is None
+
+
+def test_reverse_geocoder_labels_from_the_gazetteer(gazetteer):
+    reverse = map_app.ReverseGeocoder(gazetteer, max_km=50)
+    # only populated places are candidates: the summit is not a label
+    assert len(reverse.grid) == 4
+    assert reverse.reverse_many([(48.86, 2.35), (45.44, 4.40), (45.8326, 6.8652), (0.0, 0.0)]) == [
+        'Paris, Île-de-France, France', 'Saint-Étienne, Auvergne-Rhône-Alpes, France', None, None
+    ]
+    assert reverse.reverse_many([]) == []
+
+
+def test_spatial_grid_nearest_matches_brute_force_up_to_the_poles():
+    rng = np.random.default_rng(1)
+    lat, lon = rng.uniform(-60, 70, 20000), rng.uniform(-180, 180, 20000)
+    grid = map_app.SpatialGrid(lat, lon, cell_deg=0.01)
+    qlat = np.concatenate([rng.uniform(-89.9, 89.9, 100), [90.0, -90.0, 89.999, 85.0]])
+    qlon = np.concatenate([rng.uniform(-180, 180, 100), [0.0, 180.0, -179.99, 10.0]])
+
+    index, km = grid.nearest(qlat, qlon)
+    expected = map_app.haversine_km(qlat[:, None], qlon[:, None], lat[None, :], lon[None, :])
+    assert np.allclose(km, expected.min(axis=1))
+    assert (index == expected.argmin(axis=1)).all()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_geocode_cache_ttls_and_negative_entries(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(map_app.time, 'time', clock)
+    path = str(tmp_path / 'cache.sqlite')
+    cache = map_app.GeocodeCache(path, max_entries=100, ttl=100, negative_ttl=10)
+    cache.put('fwd:paris', [48.85, 2.35])
+    cache.put('fwd:nowhere', None)
+    assert cache.get('fwd:paris') == [48.85, 2.35]
+    # a cached 'not found' is None, not a miss
+    assert cache.get('fwd:nowhere') is None
+    assert cache.get('fwd:unknown') is map_app.GeocodeCache.MISSING
+
+    clock.now += 11
+    assert cache.get('fwd:nowhere') is map_app.GeocodeCache.MISSING
+    # shared across instances and restarts
+    assert map_app.GeocodeCache(path, 100, 100, 10).get('fwd:paris') == [48.85, 2.35]
+    clock.now += 90
+    assert cache.get('fwd:paris') is map_app.GeocodeCache.MISSING
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 3
+
+
+def test_geocode_cache_evicts_least_recently_used(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(map_app.time, 'time', clock)
+    cache = map_app.GeocodeCache(str(tmp_path / 'cache.sqlite'), max_entries=3, ttl=1000, negative_ttl=1000)
+    for i in range(99):
+        clock.now += 1
+        cache.put(f'key{i}', i)
+    cache.get('key0')
+    # the 100th put sweeps the table down to max_entries
+    cache.put('key99', 99)
+    assert cache.stats()['entries'] == 3 and cache.stats()['evictions'] == 97
+    assert cache.get('key0') == 0 and cache.get('key99') == 99 and cache.get('key98') == 98
+    assert cache.get('key50') is map_app.GeocodeCache.MISSING
+
+
+def test_geocode_place_caches_answers_but_not_errors(monkeypatch, tmp_path):
+    calls = []
+
+    class Geolocator:
+        def geocode(self, place):
+            calls.append(place)
+            if place == 'flaky':
+                raise map_app.GeocoderTimedOut('slow')
+            return None if place == 'atlantis' else type('Location', (), {'latitude': 1.0, 'longitude': 2.0})()
+
+    monkeypatch.setattr(map_app, 'geocode_cache', map_app.GeocodeCache(str(tmp_path / 'cache.sqlite'), 100, 100, 100))
+    monkeypatch.setattr(map_app, 'geolocator', Geolocator())
+    monkeypatch.setattr(map_app, 'geocode_limiter', map_app.RateLimiter(1000))
+    for _ in range(2):
+        assert map_app.geocode_place('Paris,  France') == (1.0, 2.0)
+        assert map_app.geocode_place('atlantis') is None
+    assert calls == ['Paris,  France', 'atlantis']
+    for _ in range(2):
+        try:
+            map_app.geocode_place('flaky')
+        except map_app.GeocoderTimedOut:
+            pass
+    assert calls.count('flaky') == 2
+    assert map_app.geocode_place('elsewhere', cached_only=True) is None and 'elsewhere' not in calls
+
+
+def test_rate_limiter_spaces_calls_across_threads():
+    limiter = map_app.RateLimiter(20)
+    started = map_app.time.monotonic()
+    stamps = []
+    threads = [map_app.threading.Thread(target=lambda: (limiter.acquire(), stamps.append(map_app.time.monotonic()))) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the sixth caller cannot get through before five intervals have passed
+    assert len(stamps) == 6 and max(stamps) - started >= 5 * limiter.interval * 0.95
+
+
+def test_geocode_places_looks_up_duplicates_once_and_isolates_failures(monkeypatch):
+    calls = []
+
+    def resolve(place):
+        calls.append(place)
+        if place == 'broken':
+            raise ValueError('service error')
+        return (len(place), 0.0)
+
+    monkeypatch.setattr(map_app, 'resolve_place', resolve)
+    results = map_app.geocode_places(['Rome', 'rome ', 'broken', '', 'Oslo'])
+    assert sorted(calls) == ['Oslo', 'Rome', 'broken']
+    assert results == [('Rome', (4, 0.0), None), ('rome ', (4, 0.0), None), ('broken', None, 'service error'), ('Oslo', (4, 0.0), None)]
@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+TOKYO = (35.68, 139.69, 'Tokyo, Tokyo, Japan')
+PARIS = (48.85, 2.35, 'Paris, Île-de-France, France')
+
+
+def provider(result=None, delay=0.0, error=None, calls=None):
+    def locate():
+        if calls is not None:
+            calls.append(locate)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    return locate
+
+
+def test_the_first_usable_answer_wins(monkeypatch):
+    monkeypatch.setattr(map_app, 'ip_location_providers', [
+        ('slow', provider(PARIS, delay=1.0)),
+        ('broken', provider(error=ConnectionError('refused'))),
+        ('empty', provider(None)),
+        ('fast', provider(TOKYO, delay=0.05))
+    ])
+    started = time.perf_counter()
+    assert map_app.race_ip_location() == TOKYO
+    # the slow provider is not waited for
+    assert time.perf_counter() - started < 0.5
+
+
+def test_no_location_when_every_provider_fails(monkeypatch, capsys):
+    monkeypatch.setattr(map_app, 'ip_location_providers', [
+        ('broken', provider(error=ConnectionError('refused'))),
+        ('timeout', provider(error=TimeoutError('timed out'))),
+        ('empty', provider(None))
+    ])
+    assert map_app.race_ip_location() is None
+    out = capsys.readouterr().out
+    assert '❌ broken failed: refused' in out and '❌ timeout failed: timed out' in out
+    assert 'Could not detect location' in out
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def located(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(map_app.time, 'time', clock)
+    monkeypatch.setattr(map_app, 'user_location_override', None)
+    monkeypatch.setattr(map_app, 'user_location_state', {'value': None, 'fetched': 0.0, 'refreshing': False})
+    monkeypatch.setattr(map_app, 'user_location_ttl', 3600)
+    monkeypatch.setattr(map_app, 'user_location_retry', 60)
+    return clock
+
+
+def wait_for_refresh():
+    deadline = time.monotonic() + 5
+    while map_app.user_location_state['refreshing'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not map_app.user_location_state['refreshing']
+
+
+def test_user_location_is_memoized_until_its_ttl(monkeypatch, located):
+    calls = []
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('tokyo', provider(TOKYO, calls=calls))])
+    assert map_app.get_user_location() == TOKYO
+    located.now += 3599
+    assert map_app.get_user_location() == TOKYO
+    assert len(calls) == 1
+
+    # past the TTL the stale answer comes back at once and a background refresh replaces it
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('paris', provider(PARIS, delay=0.1, calls=calls))])
+    located.now += 2
+    assert map_app.get_user_location() == TOKYO
+    wait_for_refresh()
+    assert len(calls) == 2
+    assert map_app.get_user_location() == PARIS
+
+
+def test_a_failed_refresh_keeps_the_last_answer(monkeypatch, located):
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('tokyo', provider(TOKYO))])
+    assert map_app.get_user_location() == TOKYO
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('broken', provider(error=ConnectionError('down')))])
+    located.now += 3601
+    assert map_app.get_user_location() == TOKYO
+    wait_for_refresh()
+    assert map_app.get_user_location() == TOKYO
+
+
+def test_no_location_is_retried_sooner(monkeypatch, located):
+    calls = []
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('empty', provider(None, calls=calls))])
+    assert map_app.get_user_location() is None
+    located.now += 59
+    assert map_app.get_user_location() is None
+    assert len(calls) == 1
+    located.now += 2
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('tokyo', provider(TOKYO, calls=calls))])
+    # nothing to serve in the meantime, so this call waits for the race
+    assert map_app.get_user_location() == TOKYO
+    assert len(calls) == 2
+
+
+def test_concurrent_first_calls_share_one_race(monkeypatch, located):
+    calls = []
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('tokyo', provider(TOKYO, delay=0.2, calls=calls))])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(map_app.get_user_location())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [TOKYO] * 5 and len(calls) == 1
+
+
+def test_configured_location_skips_detection(monkeypatch, located):
+    monkeypatch.setattr(map_app, 'ip_location_providers', [('never', provider(error=AssertionError('called')))])
+    monkeypatch.setattr(map_app, 'user_location_override', map_app.parse_location_override('36.75, 3.06, Algiers'))
+    assert map_app.get_user_location() == (36.75, 3.06, 'Algiers')
+    assert map_app.parse_location_override('36.75,3.06') == (36.75, 3.06, 'Configured Location')
+    assert map_app.parse_location_override('north') is None
@@ -0,0 +1,221 @@
+import os
+import re
+import sqlite3
+import sys
+from io import BytesIO
+
+import folium
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+RED, BLUE = (220, 30, 30), (30, 30, 220)
+
+
+def split_image(size, mode='RGB'):
+    """Red on the left half, blue on the right"""
+    img = Image.new(mode, size, BLUE)
+    img.paste(RED, (0, 0, size[0] // 2, size[1]))
+    return img
+
+
+def jpeg_bytes(img, orientation=None):
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90, exif=exif)
+    return buffer.getvalue()
+
+
+def colour_at(img, x, y):
+    return np.asarray(img.convert('RGB'))[y, x].astype(int)
+
+
+def close_to(colour, expected):
+    return np.abs(colour - np.array(expected)).max() < 40
+
+
+@pytest.mark.parametrize('encoding', ['jpeg', 'webp'])
+def test_thumbnails_of_a_large_jpeg(encoding):
+    data, mimetype = map_app.make_thumbnail(BytesIO(jpeg_bytes(split_image((6000, 4000)))), size=200, encoding=encoding)
+    assert mimetype == f'image/{encoding}'
+    thumb = Image.open(BytesIO(data))
+    assert thumb.format == encoding.upper()
+    assert thumb.size == (200, 133)
+    assert close_to(colour_at(thumb, 20, 66), RED) and close_to(colour_at(thumb, 180, 66), BLUE)
+
+
+def test_thumbnails_follow_exif_orientation():
+    # orientation 6: the camera was turned clockwise, so the stored left edge is the top of the picture
+    data, _mimetype = map_app.make_thumbnail(BytesIO(jpeg_bytes(split_image((6000, 4000)), orientation=6)), size=200)
+    thumb = Image.open(BytesIO(data))
+    assert thumb.size == (133, 200)
+    assert close_to(colour_at(thumb, 66, 20), RED) and close_to(colour_at(thumb, 66, 180), BLUE)
+
+    # orientation 3: upside down
+    data, _mimetype = map_app.make_thumbnail(BytesIO(jpeg_bytes(split_image((6000, 4000)), orientation=3)), size=200)
+    thumb = Image.open(BytesIO(data))
+    assert thumb.size == (200, 133)
+    assert close_to(colour_at(thumb, 20, 66), BLUE) and close_to(colour_at(thumb, 180, 66), RED)
+
+
+def test_thumbnails_of_other_formats():
+    buffer = BytesIO()
+    split_image((3000, 1000), mode='RGBA').save(buffer, format='PNG')
+    buffer.seek(0)
+    data, mimetype = map_app.make_thumbnail(buffer, size=100)
+    thumb = Image.open(BytesIO(data))
+    assert mimetype == 'image/jpeg' and thumb.format == 'JPEG' and thumb.mode == 'RGB'
+    assert thumb.size == (100, 33)
+    assert close_to(colour_at(thumb, 10, 16), RED) and close_to(colour_at(thumb, 90, 16), BLUE)
+
+    # smaller than the target: kept at its own size
+    buffer = BytesIO()
+    Image.new('L', (80, 60), 128).save(buffer, format='PNG')
+    buffer.seek(0)
+    thumb = Image.open(BytesIO(map_app.make_thumbnail(buffer, size=200)[0]))
+    assert thumb.size == (80, 60) and thumb.mode == 'L'
+
+
+def gps_photo(lat=None, lon=None):
+    exif = Image.Exif()
+    exif[0x010f] = 'Test Make'
+    exif[0x0110] = 'Test Camera'
+    if lat is not None:
+        exif.get_ifd(0x8825).update({1: 'N' if lat >= 0 else 'S', 2: (abs(lat), 0.0, 0.0), 3: 'E' if lon >= 0 else 'W', 4: (abs(lon), 0.0, 0.0)})
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), RED).save(buffer, format='JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def library(tmp_path):
+    root = tmp_path / 'photos'
+    (root / 'trip' / 'day 2').mkdir(parents=True)
+    (root / 'paris.jpg').write_bytes(gps_photo(48.5, 2.25))
+    (root / 'trip' / 'tokyo.JPG').write_bytes(gps_photo(35.5, 139.75))
+    (root / 'trip' / 'day 2' / 'south.jpeg').write_bytes(gps_photo(-33.5, -70.5))
+    (root / 'no_gps.jpg').write_bytes(gps_photo())
+    (root / 'trip' / 'broken.jpg').write_bytes(b'not a photo')
+    (root / 'notes.txt').write_text('not a photo either')
+    return root, str(tmp_path / 'library.db')
+
+
+def indexed(dest):
+    conn = sqlite3.connect(dest)
+    rows = {os.path.basename(path): (lat, lon, make, camera) for path, lat, lon, make, camera in
+            conn.execute("SELECT path, lat, lon, make, camera FROM photos")}
+    conn.close()
+    return rows
+
+
+def test_ingest_photos_indexes_a_mixed_directory(library):
+    root, dest = library
+    map_app.ingest_photos(str(root), dest, workers=2, batch_size=2)
+    rows = indexed(dest)
+    assert set(rows) == {'paris.jpg', 'tokyo.JPG', 'south.jpeg', 'no_gps.jpg', 'broken.jpg'}
+    assert rows['paris.jpg'] == (pytest.approx(48.5), pytest.approx(2.25), 'Test Make', 'Test Camera')
+    assert rows['south.jpeg'][:2] == (pytest.approx(-33.5), pytest.approx(-70.5))
+    # kept without coordinates so the next run does not read them again
+    assert rows['no_gps.jpg'][:2] == (None, None) and rows['no_gps.jpg'][3] == 'Test Camera'
+    assert rows['broken.jpg'] == (None, None, 'Unknown', 'Unknown')
+
+
+def test_ingest_photos_reruns_only_read_changes(library, capsys):
+    root, dest = library
+    map_app.ingest_photos(str(root), dest, workers=2, batch_size=2)
+    assert '5 files scanned' in capsys.readouterr().out
+    first = indexed(dest)
+
+    map_app.ingest_photos(str(root), dest, workers=2)
+    out = capsys.readouterr().out
+    assert '(5 already indexed)' in out and '0 read' in out and '5 unchanged, 0 removed' in out
+    assert indexed(dest) == first
+
+    # a photo that gained GPS is read again, a deleted one is dropped
+    (root / 'no_gps.jpg').write_bytes(gps_photo(1.5, 2.5))
+    (root / 'paris.jpg').unlink()
+    map_app.ingest_photos(str(root), dest, workers=2)
+    out = capsys.readouterr().out
+    assert '1 read' in out and '3 unchanged, 1 removed' in out
+    rows = indexed(dest)
+    assert 'paris.jpg' not in rows and rows['no_gps.jpg'][:2] == (pytest.approx(1.5), pytest.approx(2.5))
+    assert {name: row for name, row in rows.items() if name != 'no_gps.jpg'} == {
+        name: row for name, row in first.items() if name not in ('no_gps.jpg', 'paris.jpg')
+    }
+
+
+def test_lazy_popups_listen_on_their_map():
+    m = folium.Map(location=[36.0, 3.0])
+    map_app.LazyPopups().add_to(m)
+    html = m.get_root().render()
+    assert f"{m.get_name()}.on('popupopen'" in html
+    assert "querySelector('.lazy-popup[data-src]')" in html
+
+
+def test_published_photos_and_popups_are_served_by_id():
+    client = map_app.app.test_client()
+    thumbnail = map_app.make_thumbnail(BytesIO(jpeg_bytes(split_image((400, 300)))))[0]
+    with map_app.app.test_request_context('/', base_url='http://localhost:5000/'):
+        thumbnail_url = map_app.publish_thumbnail(thumbnail, 'image/jpeg')
+        popup_url = map_app.publish_popup("<p>Café</p>")
+    assert thumbnail_url.startswith('http://localhost:5000/photos/')
+    assert popup_url.startswith('http://localhost:5000/popups/')
+
+    for url, body, mimetype in ((thumbnail_url, thumbnail, 'image/jpeg'), (popup_url, "<p>Café</p>".encode(), 'text/html')):
+        response = client.get(url)
+        assert response.status_code == 200 and response.data == body and response.mimetype == mimetype
+        # the saved map is opened from file://, so its requests are cross-origin
+        assert response.headers['Access-Control-Allow-Origin'] == '*'
+        assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 3600
+        assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    assert client.get('/photos/0123456789abcdef0123').status_code == 404
+    assert client.get('/popups/0123456789abcdef0123').status_code == 404
+
+
+def test_photo_maps_fetch_escaped_popups(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(map_app, 'services_open', True)
+    monkeypatch.setattr(map_app, 'check_internet_connection', lambda: True)
+    monkeypatch.setattr(map_app, 'get_user_location', lambda: None)
+    monkeypatch.setattr(map_app, 'reverse_geocode_many', lambda coords: ['<i>Rue</i> & Co'] * len(coords))
+    monkeypatch.setattr(map_app.webbrowser, 'open_new_tab', lambda url: None)
+
+    exif = Image.Exif()
+    exif[0x010f] = '<b>Make</b>'
+    exif[0x0110] = "Cam' onmouseover='alert(1)"
+    exif.get_ifd(0x8825).update({1: 'N', 2: (48.5, 0.0, 0.0), 3: 'E', 4: (2.25, 0.0, 0.0)})
+    buffer = BytesIO()
+    split_image((1200, 900)).save(buffer, format='JPEG', exif=exif)
+    client = map_app.app.test_client()
+    response = client.post('/', data={'mode': 'image', 'images': [
+        (BytesIO(buffer.getvalue()), '<script>alert(1)</script>.jpg'),
+        (BytesIO(gps_photo()), 'no_gps.jpg')
+    ]})
+    assert response.status_code == 200
+
+    html = (tmp_path / 'map_result.html').read_text(encoding='utf-8')
+    # the map only carries a placeholder and URLs, the popup body and thumbnail are fetched on demand
+    popup_ids = re.findall(r'popups/([0-9a-f]{20})', html)
+    assert len(set(popup_ids)) == 1
+    assert re.search(r'photos/[0-9a-f]{20}', html)
+    assert 'base64' not in html and '<script>alert(1)' not in html and '<b>Make' not in html
+
+    popup = client.get(f'/popups/{popup_ids[0]}')
+    assert popup.status_code == 200 and popup.headers['Access-Control-Allow-Origin'] == '*'
+    body = popup.data.decode('utf-8')
+    assert '&lt;script&gt;alert(1)&lt;/script&gt;.jpg' in body and '<script>' not in body
+    assert '&lt;b&gt;Make&lt;/b&gt;' in body and 'Cam&#x27; onmouseover=&#x27;alert(1)' in body
+    assert '&lt;i&gt;Rue&lt;/i&gt; &amp; Co' in body
+    assert '48.500000, 2.250000' in body
+
+    thumbnail_id = re.search(r'photos/([0-9a-f]{20})', body).group(1)
+    thumbnail = client.get(f'/photos/{thumbnail_id}')
+    assert thumbnail.status_code == 200 and thumbnail.mimetype == 'image/jpeg'
+    assert thumbnail.headers['Access-Control-Allow-Origin'] == '*'
+    assert max(Image.open(BytesIO(thumbnail.data)).size) == map_app.thumbnail_size
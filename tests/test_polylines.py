@@ -0,0 +1,110 @@
+import math
+import os
+import sys
+
+import folium
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def decode_polyline(encoded, precision=5):
+    """Reference decoder written straight from Google's description of the format"""
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    points = np.cumsum(np.array(values).reshape(-1, 2), axis=0) / 10 ** precision
+    return [tuple(p) for p in points.tolist()]
+
+
+def test_encode_polyline_matches_the_reference_vector():
+    # the worked example from Google's encoded polyline algorithm format page
+    points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert map_app.encode_polyline(points) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@') == points
+
+
+@pytest.mark.parametrize('precision', [5, 6])
+def test_encode_polyline_round_trips(precision):
+    rng = np.random.default_rng(0)
+    points = (np.array([-33.9, 151.2]) + rng.normal(0, 1, (500, 2)).cumsum(axis=0) * 0.01).tolist()
+    points += [(0.0, 0.0), (-89.99999, -179.99999), (89.99999, 179.99999)]
+    decoded = decode_polyline(map_app.encode_polyline(points, precision), precision)
+    assert np.abs(np.array(decoded) - np.array(points)).max() <= 0.5 / 10 ** precision + 1e-12
+
+
+def test_line_importance():
+    # a straight line: every interior vertex can go
+    importance = map_app.line_importance([(36.0, 3.0 + i * 0.001) for i in range(5)])
+    assert importance[0] == importance[-1] == np.inf
+    assert importance[1:-1] == pytest.approx(0.0, abs=1e-6)
+
+    # one apex 0.01 degrees of latitude off the chord, with a small bump on its flank
+    points = [(36.0, 3.0), (36.0005, 3.005), (36.01, 3.01), (36.0, 3.02)]
+    importance = map_app.line_importance(points)
+    assert importance[2] == pytest.approx(0.01 * 110540.0)
+    assert 0 < importance[1] < importance[2]
+    assert map_app.line_importance([(36.0, 3.0), (36.1, 3.1)]).tolist() == [np.inf, np.inf]
+
+
+def douglas_peucker(points, tolerance):
+    """Indices kept by the textbook recursive simplification, in the metres line_importance uses"""
+    points = np.asarray(points)
+    y = points[:, 0] * 110540.0
+    x = points[:, 1] * 111320.0 * np.cos(np.radians(points[:, 0].mean()))
+    kept = {0, len(points) - 1}
+
+    def simplify(first, last):
+        if last - first < 2:
+            return
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        d = np.abs((x[first + 1:last] - x[first]) * dy - (y[first + 1:last] - y[first]) * dx) / math.hypot(dx, dy)
+        if d.max() > tolerance:
+            split = first + 1 + int(d.argmax())
+            kept.add(split)
+            simplify(first, split)
+            simplify(split, last)
+
+    simplify(0, len(points) - 1)
+    return sorted(kept)
+
+
+def test_one_importance_pass_serves_every_tolerance():
+    rng = np.random.default_rng(1)
+    points = (np.array([36.75, 3.06]) + rng.normal(0, 1, (2000, 2)).cumsum(axis=0) * 0.0005).tolist()
+    importance = map_app.line_importance(points)
+    for tolerance in (1.0, 10.0, 100.0, 1000.0):
+        assert np.flatnonzero(importance > tolerance).tolist() == douglas_peucker(points, tolerance)
+
+
+def test_line_min_zooms():
+    # the ends are always drawn; a vertex on the chord never is
+    assert map_app.line_min_zooms([(36.0, 3.0), (36.0, 3.01), (36.0, 3.02)]).tolist() == [0, map_app.MAX_LINE_ZOOM + 1, 0]
+
+    points = [(36.0, 3.0), (36.0005, 3.005), (36.01, 3.01), (36.0, 3.02)]
+    zooms = map_app.line_min_zooms(points, tolerance_px=1)
+    importance = map_app.line_importance(points)
+    assert zooms[0] == zooms[-1] == 0
+    # the apex appears at the first zoom where it is more than a pixel off the chord
+    metres_per_px = map_app.WEB_MERCATOR_M_PER_PX * math.cos(math.radians(np.mean([p[0] for p in points])))
+    assert importance[2] / (metres_per_px / 2 ** zooms[2]) >= 1 > importance[2] / (metres_per_px / 2 ** (zooms[2] - 1))
+    assert zooms[1] > zooms[2]
+    # four times the tolerance holds a vertex back two zoom levels
+    assert (map_app.line_min_zooms(points, tolerance_px=4)[1:3] >= zooms[1:3] + 2).all()
+
+
+def test_the_decoder_is_emitted_once_per_map():
+    m = folium.Map(location=[36.0, 3.0])
+    for i in range(3):
+        map_app.EncodedPolyLine([(36.0, 3.0), (36.1 + i * 0.01, 3.1), (36.2, 3.3)], color='red').add_to(m)
+    html = m.get_root().render()
+    assert html.count('function decodeMapPolyline') == 1
+    assert html.count('decodeMapPolyline(') == 4
+    assert html.index('function decodeMapPolyline') < html.index('encoded_poly_line')
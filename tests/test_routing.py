@@ -0,0 +1,89 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def write_grid_osm(path, size=30, step=0.005):
+    """A size x size grid of two-way residential streets starting at 36N 3E"""
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<osm version="0.6">\n')
+        for row in range(size):
+            for col in range(size):
+                f.write(f'<node id="{row * size + col + 1}" lat="{36 + row * step:.7f}" lon="{3 + col * step:.7f}"/>\n')
+        way_id = 1
+        for row in range(size):
+            refs = ''.join(f'<nd ref="{row * size + col + 1}"/>' for col in range(size))
+            f.write(f'<way id="{way_id}">{refs}<tag k="highway" v="residential"/></way>\n')
+            way_id += 1
+        for col in range(size):
+            refs = ''.join(f'<nd ref="{row * size + col + 1}"/>' for row in range(size))
+            f.write(f'<way id="{way_id}">{refs}<tag k="highway" v="residential"/></way>\n')
+            way_id += 1
+        f.write('</osm>\n')
+
+
+def grid_network(tmp_path, size=30):
+    source = os.path.join(tmp_path, 'grid.osm')
+    write_grid_osm(source, size)
+    map_app.import_roads(source, os.path.join(tmp_path, 'roads'), landmarks=4)
+    return map_app.RoadNetwork(os.path.join(tmp_path, 'roads'))
+
+
+def assert_shortest(network, origin, points, routes):
+    nodes, snap_km = network.grid.nearest(
+        np.array([origin[0]] + [p[0] for p in points]),
+        np.array([origin[1]] + [p[1] for p in points]),
+        max_km=map_app.route_snap_km
+    )
+    times = map_app.shortest_times(network.indptr, network.targets, network.seconds, int(nodes[0]))
+    for i, route in enumerate(routes):
+        access = (snap_km[0] + snap_km[i + 1]) / map_app.route_access_kmh * 3600
+        assert abs(route[0] - access - times[nodes[i + 1]]) < 1e-3
+        assert route[2][0] == origin and route[2][-1] == points[i]
+
+
+def test_route_many_matches_dijkstra(tmp_path):
+    network = grid_network(tmp_path)
+    origin, points = (36.01, 3.01), [(36.1, 3.1), (36.05, 3.12)]
+    assert_shortest(network, origin, points, network.route_many(origin, points))
+
+
+def test_spread_out_points_do_not_search_the_whole_graph(tmp_path):
+    network = grid_network(tmp_path, size=80)
+    # markers on every side of the origin: a bound toward the nearest of them says nothing about the rest
+    origin = (36.2, 3.2)
+    points = [(36.2 + dlat, 3.2 + dlon) for dlat in (-0.18, 0, 0.18) for dlon in (-0.18, 0, 0.18) if dlat or dlon]
+    routes = network.route_many(origin, points)
+    assert_shortest(network, origin, points, routes)
+    # the old single search toward all of them settled nearly every junction
+    assert network.stats()['settled_per_search'] < len(network) / 2
+
+
+def test_route_many_stops_at_the_settled_budget(tmp_path, monkeypatch):
+    network = grid_network(tmp_path)
+    monkeypatch.setattr(map_app, 'route_max_settled', 50)
+    origin, points = (36.01, 3.01), [(36.012, 3.012), (36.14, 3.14)]
+    near, far = network.route_many(origin, points)
+    # the far marker is left to the straight-line estimate
+    assert near is not None and far is None
+    assert network.stats()['settled_per_search'] == 50
+
+
+def test_route_many_without_reachable_points(tmp_path):
+    network = grid_network(tmp_path)
+    # the origin snaps to the grid but the marker is nowhere near a road
+    assert network.route_many((36.1, 3.1), [(10.0, 10.0)]) == [None]
+
+
+def test_import_roads_without_driveable_roads(tmp_path, capsys):
+    source = os.path.join(tmp_path, 'paths.osm')
+    with open(source, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<osm version="0.6">\n<node id="1" lat="36" lon="3"/><node id="2" lat="36.01" lon="3"/>\n'
+                '<way id="1"><nd ref="1"/><nd ref="2"/><tag k="highway" v="footway"/></way>\n</osm>\n')
+    map_app.import_roads(source, os.path.join(tmp_path, 'roads'))
+    assert 'No driveable roads' in capsys.readouterr().out
+    assert not os.path.exists(os.path.join(tmp_path, 'roads'))
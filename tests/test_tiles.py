@@ -0,0 +1,297 @@
+import os
+import sqlite3
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def write_tile(root, z, x, y, color, encoding='png'):
+    os.makedirs(os.path.join(root, str(z), str(x)), exist_ok=True)
+    Image.new('RGB', (256, 256), color).save(os.path.join(root, str(z), str(x), f'{y}.{encoding}'))
+
+
+@pytest.fixture
+def tile_tree(tmp_path):
+    root = str(tmp_path / 'tiles')
+    write_tile(root, 3, 2, 1, 'red')
+    write_tile(root, 3, 2, 2, 'blue')
+    write_tile(root, 3, 2, 2, 'blue', encoding='webp')
+    return root
+
+
+def use_store(monkeypatch, store, cache_bytes=1 << 20):
+    index = map_app.TileIndex(store, os.path.join(os.path.dirname(str(getattr(store, 'root', store.path))), 'index.sqlite'))
+    index.refresh()
+    monkeypatch.setattr(map_app, 'services_open', True)
+    monkeypatch.setattr(map_app, 'tile_store', store)
+    monkeypatch.setattr(map_app, 'tile_index', index)
+    monkeypatch.setattr(map_app, 'tile_cache', map_app.LRUByteCache(cache_bytes))
+    return map_app.app.test_client()
+
+
+def stores(tile_tree):
+    packed = os.path.join(os.path.dirname(tile_tree), 'tiles.mbtiles')
+    map_app.import_tiles_to_mbtiles(tile_tree, packed, workers=2)
+    return [map_app.DirectoryTileStore(tile_tree), map_app.MBTilesTileStore(packed)]
+
+
+def test_tile_etag_and_revalidation(monkeypatch, tile_tree):
+    for store in stores(tile_tree):
+        client = use_store(monkeypatch, store)
+        response = client.get('/tiles/3/2/1.png')
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+        assert Image.open(BytesIO(response.data)).getpixel((0, 0)) == (255, 0, 0)
+        etag = response.headers['ETag']
+        assert 'public' in response.headers['Cache-Control']
+
+        revalidated = client.get('/tiles/3/2/1.png', headers={'If-None-Match': etag})
+        assert revalidated.status_code == 304
+        # cached now; the tag must not change
+        assert client.get('/tiles/3/2/1.png').headers['ETag'] == etag
+
+
+def test_missing_tiles_and_absurd_zooms_are_404(monkeypatch, tile_tree):
+    for store in stores(tile_tree):
+        client = use_store(monkeypatch, store)
+        assert client.get('/tiles/3/7/7.png').status_code == 404
+        assert client.get('/tiles/3/8/0.png').status_code == 404
+        assert client.get('/tiles/1000000000/0/0.png').status_code == 404
+
+
+def test_webp_is_served_only_when_accepted(monkeypatch, tile_tree):
+    client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    webp = client.get('/tiles/3/2/2.png', headers={'Accept': 'image/webp,*/*'})
+    assert webp.status_code == 200 and webp.mimetype == 'image/webp'
+    assert 'Accept' in webp.headers['Vary']
+    assert client.get('/tiles/3/2/2.png', headers={'Accept': 'image/*'}).mimetype == 'image/png'
+    # no .webp for this tile: PNG even when WebP is accepted
+    assert client.get('/tiles/3/2/1.png', headers={'Accept': 'image/webp'}).mimetype == 'image/png'
+
+
+def test_directory_etag_does_not_depend_on_the_cache(monkeypatch, tile_tree):
+    etags = []
+    for cache_bytes in (0, 1 << 20):
+        client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree), cache_bytes)
+        # warm the cache the way the prefetcher does, then request the tile
+        map_app.load_tile(3, 2, 1)
+        response = client.get('/tiles/3/2/1.png')
+        etags.append(response.headers['ETag'])
+        assert client.get('/tiles/3/2/1.png', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert etags[0] == etags[1]
+
+
+def test_cache_miss_streams_the_file(monkeypatch, tile_tree):
+    client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    # send_file adds Last-Modified; the in-memory response does not
+    assert 'Last-Modified' in client.get('/tiles/3/2/1.png').headers
+    assert map_app.tile_cache.stats()['entries'] == 0
+    map_app.load_tile(3, 2, 1)
+    assert 'Last-Modified' not in client.get('/tiles/3/2/1.png').headers
+    assert map_app.tile_cache.stats()['hits'] == 1
+
+
+def test_missing_tiles_are_synthesized_from_an_ancestor(monkeypatch, tile_tree):
+    client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    response = client.get('/tiles/4/4/2.png')
+    assert response.status_code == 200
+    assert Image.open(BytesIO(response.data)).convert('RGB').getpixel((128, 128)) == (255, 0, 0)
+
+
+def test_dedup_import_stores_each_image_once(monkeypatch, tmp_path, capsys):
+    root = str(tmp_path / 'tiles')
+    # a sea of identical tiles with a few distinct ones
+    for x in range(4):
+        for y in range(4):
+            write_tile(root, 2, x, y, 'blue')
+    write_tile(root, 2, 1, 1, 'red')
+    write_tile(root, 2, 2, 3, 'green')
+    write_tile(root, 3, 5, 5, 'red')
+    packed = str(tmp_path / 'tiles.mbtiles')
+    map_app.import_tiles_to_mbtiles(root, packed, workers=2, dedup=True)
+
+    conn = sqlite3.connect(packed)
+    assert conn.execute("SELECT COUNT(*) FROM map").fetchone()[0] == 17
+    assert conn.execute("SELECT COUNT(*) FROM images").fetchone()[0] == 3
+    conn.close()
+    assert '17 tiles share 3 unique images' in capsys.readouterr().out
+
+    store = map_app.MBTilesTileStore(packed)
+    assert store.deduplicated
+    client = use_store(monkeypatch, store)
+    etags = {}
+    for z, x, y in [(2, x, y) for x in range(4) for y in range(4)] + [(3, 5, 5)]:
+        response = client.get(f'/tiles/{z}/{x}/{y}.png')
+        with open(os.path.join(root, str(z), str(x), f'{y}.png'), 'rb') as f:
+            assert response.status_code == 200 and response.data == f.read()
+        etags.setdefault(response.headers['ETag'], set()).add((z, x, y))
+    # one tag and one cache entry per image, however many coordinates share it
+    assert sorted(map(len, etags.values())) == [1, 2, 14]
+    assert map_app.tile_cache.stats()['entries'] == 3
+
+    map_app.dedup_report(root, workers=2)
+    assert '17 tiles, 3 unique images' in capsys.readouterr().out
+    # a plain import into the deduplicated file is refused
+    map_app.import_tiles_to_mbtiles(root, packed, workers=2)
+    assert 'already uses the deduplicated layout' in capsys.readouterr().out
+
+
+def test_synthesized_tiles_give_way_to_imported_ones(monkeypatch, tile_tree):
+    packed = stores(tile_tree)[1]
+    client = use_store(monkeypatch, packed)
+    assert Image.open(BytesIO(client.get('/tiles/4/4/2.png').data)).convert('RGB').getpixel((128, 128)) == (255, 0, 0)
+
+    # a real tile lands in the MBTiles file; the watcher's next refresh picks it up
+    buffer = BytesIO()
+    Image.new('RGB', (256, 256), 'green').save(buffer, format='PNG')
+    conn = sqlite3.connect(packed.path)
+    with conn:
+        conn.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)", (4, 4, (1 << 4) - 1 - 2, buffer.getvalue()))
+    conn.close()
+    map_app.tile_index.refresh()
+    assert Image.open(BytesIO(client.get('/tiles/4/4/2.png').data)).convert('RGB').getpixel((128, 128)) == (0, 128, 0)
+
+
+def test_encoding_misses_stay_out_of_the_tile_cache(monkeypatch, tile_tree):
+    use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    monkeypatch.setattr(map_app, 'encoding_misses', map_app.LRUByteCache(1 << 20))
+    for _ in range(3):
+        assert map_app.load_tile(3, 2, 1, 'webp') is None
+        assert map_app.load_tile(3, 2, 1, 'png8') is None
+    stats = map_app.tile_cache.stats()
+    assert stats['entries'] == 0 and stats['hits'] == 0
+    assert map_app.encoding_misses.stats()['entries'] == 2
+
+
+def test_prefetch_keys_are_deduplicated_and_capped(monkeypatch, tile_tree):
+    use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    prefetcher = map_app.TilePrefetcher(1, 1 << 20, 2, 10000)
+    keys = prefetcher.keys_for([(50.0, 10.0)], 3)
+    # 5x5 tiles at zoom 3 and 4; zoom 2 is the whole 4x4 world
+    assert len(keys) == len(set(keys)) == 25 + 16 + 25
+    assert keys[0] == (3, *map_app.lat_lon_to_tile(50.0, 10.0, 3))
+    assert prefetcher.keys_for([(50.0, 10.0), (50.1, 10.1)] * 1000, 3) == keys
+
+    # capped, every point still gets its own tile before any point gets a ring
+    points = [(lat, lon) for lat in (-60.0, -20.0, 20.0, 60.0) for lon in (-150.0, -60.0, 30.0, 120.0)]
+    prefetcher.max_tiles = 40
+    keys = prefetcher.keys_for(points, 3)
+    assert len(keys) == len(set(keys)) == 40
+    assert keys[:16] == [(3, *map_app.lat_lon_to_tile(lat, lon, 3)) for lat, lon in points]
+
+
+def test_prefetch_stops_at_its_byte_budget(monkeypatch, tile_tree):
+    use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    prefetcher = map_app.TilePrefetcher(1, 1, 2, 50)
+    submitted = []
+    submit = prefetcher._pool.submit
+    monkeypatch.setattr(prefetcher._pool, 'submit', lambda *args: submitted.append(args) or submit(*args))
+    prefetcher.prefetch([map_app.tile_to_lat_lon(3, 2.5, 1.5)], 3)
+    prefetcher._pool.shutdown(wait=True)
+    assert len(submitted) == 50
+    # the first tile used up the one-byte budget; the other queued tiles were skipped
+    stats = prefetcher.stats()
+    assert stats['tiles_warmed'] == 1 and stats['bytes_read'] == map_app.tile_cache.stats()['resident_bytes']
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = map_app.LRUByteCache(100)
+    cache.put('a', b'a', 40)
+    cache.put('b', b'b', 40)
+    assert cache.get('a') == b'a'
+    cache.put('c', b'c', 40)
+    # 'b' was used least recently
+    assert cache.get('b') is None and cache.get('a') == b'a' and cache.get('c') == b'c'
+    cache.put('a', b'A', 10)
+    cache.put('huge', b'x', 101)
+    stats = cache.stats()
+    assert cache.get('huge') is None
+    assert stats['entries'] == 2 and stats['resident_bytes'] == 50 and stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1
+
+
+def test_tile_index_refreshes_changed_columns_only(tmp_path, tile_tree):
+    store = map_app.DirectoryTileStore(tile_tree)
+    index_path = str(tmp_path / 'index.sqlite')
+    index = map_app.TileIndex(store, index_path)
+    assert index.refresh() == 1 and index.generation == 1
+    assert index.contains(3, 2, 1) and index.contains(3, 2, 2) and not index.contains(3, 2, 3)
+    assert index.zoom_levels() == [3] and index.tile_count() == 2
+
+    assert index.refresh() == 0 and index.generation == 1
+    write_tile(tile_tree, 3, 5, 0, 'green')
+    assert index.refresh() == 1 and index.generation == 2
+    assert index.contains(3, 5, 0) and index.tile_count() == 3
+
+    index.save()
+    reloaded = map_app.TileIndex(store, index_path)
+    reloaded.load()
+    assert reloaded.refresh() == 0 and reloaded.tile_count() == 3
+
+
+def test_encoding_misses_are_forgotten_after_a_refresh(monkeypatch, tile_tree):
+    client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    assert map_app.load_tile(3, 2, 1, 'webp') is None
+    write_tile(tile_tree, 3, 2, 1, 'red', encoding='webp')
+    assert map_app.load_tile(3, 2, 1, 'webp') is None
+    map_app.tile_index.refresh()
+    assert map_app.load_tile(3, 2, 1, 'webp') is not None
+    assert client.get('/tiles/3/2/1.png', headers={'Accept': 'image/webp'}).mimetype == 'image/webp'
+
+
+def age(path, seconds):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - int(seconds * 1e9)))
+
+
+def test_recompress_tiles_keeps_the_pngs_and_skips_done_tiles(tile_tree, capsys):
+    png = os.path.join(tile_tree, '3', '2', '1.png')
+    with open(png, 'rb') as f:
+        original = f.read()
+    map_app.recompress_tiles(tile_tree, 'webp', 80, workers=1)
+    map_app.recompress_tiles(tile_tree, 'png8', 80, workers=1)
+    assert 'Checked 2 tiles' in capsys.readouterr().out
+    with open(png, 'rb') as f:
+        assert f.read() == original
+    webp = Image.open(os.path.join(tile_tree, '3', '2', '1.webp'))
+    assert webp.format == 'WEBP' and webp.convert('RGB').getpixel((128, 128))[0] > 250
+    png8 = Image.open(os.path.join(tile_tree, '3', '2', '1.png8'))
+    assert png8.format == 'PNG' and png8.convert('RGB').getpixel((0, 0)) == (255, 0, 0)
+
+    # a rerun only redoes the tile whose PNG is newer than its output
+    write_tile(tile_tree, 3, 2, 1, 'green')
+    age(os.path.join(tile_tree, '3', '2', '1.webp'), 10)
+    done = os.stat(os.path.join(tile_tree, '3', '2', '2.webp')).st_mtime_ns
+    assert map_app.recompress_column(tile_tree, 3, 2, 'webp', 80)[:3] == (3, 2, 2)
+    assert os.stat(os.path.join(tile_tree, '3', '2', '2.webp')).st_mtime_ns == done
+    assert Image.open(os.path.join(tile_tree, '3', '2', '1.webp')).convert('RGB').getpixel((128, 128))[1] > 100
+
+
+def test_recompress_column_reports_bad_tiles_and_carries_on(tile_tree, capsys):
+    with open(os.path.join(tile_tree, '3', '2', '0.png'), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n not really')
+    z, x, count, _bytes_in, _bytes_out, failed = map_app.recompress_column(tile_tree, 3, 2, 'png8', 80)
+    assert (count, failed) == (2, 1)
+    assert 'Could not recompress' in capsys.readouterr().out
+    names = sorted(os.listdir(os.path.join(tile_tree, '3', '2')))
+    assert names == ['0.png', '1.png', '1.png8', '2.png', '2.png8', '2.webp']
+
+
+def test_recompressed_tiles_older_than_their_png_are_not_served(monkeypatch, tile_tree):
+    client = use_store(monkeypatch, map_app.DirectoryTileStore(tile_tree))
+    assert client.get('/tiles/3/2/2.png', headers={'Accept': 'image/webp'}).mimetype == 'image/webp'
+    # the tile was updated after the .webp was made
+    write_tile(tile_tree, 3, 2, 2, 'green')
+    age(os.path.join(tile_tree, '3', '2', '2.webp'), 10)
+    response = client.get('/tiles/3/2/2.png', headers={'Accept': 'image/webp'})
+    assert response.mimetype == 'image/png'
+    assert Image.open(BytesIO(response.data)).getpixel((0, 0)) == (0, 128, 0)
+    assert map_app.load_tile(3, 2, 2, 'webp') is None
+
+    map_app.recompress_column(tile_tree, 3, 2, 'webp', 80)
+    assert client.get('/tiles/3/2/2.png', headers={'Accept': 'image/webp'}).mimetype == 'image/webp'
@@ -0,0 +1,70 @@
+import os
+import sys
+from io import BytesIO
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import map_app
+
+
+def photo(lat=None, lon=None, size=(480, 360)):
+    """A noisy JPEG of roughly 100KB, GPS-tagged when lat/lon are given"""
+    exif = Image.Exif()
+    exif[0x0110] = 'Test Camera'
+    if lat is not None:
+        gps = exif.get_ifd(0x8825)
+        gps.update({1: 'N' if lat >= 0 else 'S', 2: (abs(lat), 0.0, 0.0), 3: 'E' if lon >= 0 else 'W', 4: (abs(lon), 0.0, 0.0)})
+    buffer = BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, format='JPEG', quality=95, exif=exif)
+    return buffer.getvalue()
+
+
+def test_streamed_uploads_keep_gps_and_leave_memory(monkeypatch):
+    monkeypatch.setattr(map_app, 'upload_memory_bytes', 256 * 1024)
+    photos = [(f'{i}.jpg', photo(10 + i, -20 - i) if i % 2 == 0 else photo()) for i in range(40)]
+    total = sum(len(data) for _name, data in photos)
+    assert total > 10 * map_app.upload_memory_bytes
+
+    with map_app.app.test_request_context('/', method='POST', data={
+        'mode': 'image',
+        'images': [(BytesIO(data), name) for name, data in photos]
+    }):
+        uploads = map_app.request.files.getlist('images')
+        assert len(uploads) == len(photos)
+        assert map_app.request.upload_budget.peak <= map_app.upload_memory_bytes
+        assert map_app.request.upload_budget.used == 0
+
+        for i, upload in enumerate(uploads):
+            stream = upload.stream
+            assert isinstance(stream, map_app.PhotoUploadStream)
+            assert stream.head is None and stream.size == len(photos[i][1])
+            if i % 2 == 0:
+                # kept for the thumbnail, on disk rather than in memory
+                assert stream.spool.fileno() >= 0
+            else:
+                assert stream.spool is None
+
+        results = [map_app.process_image((upload.filename, upload.stream)) for upload in uploads]
+    for i, result in enumerate(results):
+        if i % 2 == 0:
+            assert result['coords'] == (10 + i, -20 - i)
+            assert result['image_data']
+        else:
+            assert result['coords'] is None
+
+
+def test_header_is_parsed_once_it_has_arrived():
+    data = photo(35.5, 139.25)
+    stream = map_app.PhotoUploadStream('a.jpg')
+    parses = []
+    read_header = stream.read_header
+    stream.read_header = lambda final: parses.append(final) or read_header(final)
+    for start in range(0, len(data), 16):
+        stream.write(data[start:start + 16])
+    stream.seek(0)
+
+    assert stream.record.lat == 35.5 and stream.record.lon == 139.25
+    # once per segment the parser waited for, not once per 16-byte chunk
+    assert 1 < len(parses) < 10
+    assert stream.read() == data